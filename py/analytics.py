@@ -0,0 +1,313 @@
+import json, time, threading
+from array import array
+from decimal import Decimal, ROUND_HALF_UP
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+from . import archive
+from logging_utils import logger
+
+CACHE_SIZE = 16
+
+_cache = OrderedDict()   # (start_date, end_date, data_version) -> result
+_cache_lock = threading.Lock()
+
+class LineItems:
+    """
+    Completed line items for a date range as parallel columns, one entry per
+    cart_item row. Numeric columns are arrays; names and types stay lists.
+    """
+    def __init__(self):
+        self.cart_id = array('q')
+        self.product_id = array('q')
+        self.quantity = array('q')
+        self.price = array('d')
+        self.product_discount = array('d')
+        self.cart_discount = array('d')
+        self.sale_date = []
+        self.product_name = []
+        self.product_discount_type = []
+        self.cart_discount_type = []
+
+    def __len__(self):
+        return len(self.cart_id)
+
+# completed-cart columns the figures are computed from
+CART_COLUMNS = ('cart_status', 'order_date', 'cart_discount', 'cart_discount_type')
+ITEM_COLUMNS = ('cart_id', 'product_id', 'product_name', 'quantity', 'price', 'product_discount', 'product_discount_type')
+
+def create_version_table(cursor):
+    """
+    analytics_version and the triggers that bump it when a cart is
+    completed, or a completed cart is added, deleted, voided or otherwise
+    edited, or its items change. Open carts never bump it, so the cache
+    keeps hitting during service.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS analytics_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO analytics_version (id, version) VALUES (1, 0)")
+
+    bump = "UPDATE analytics_version SET version = version + 1 WHERE id = 1;"
+    completed = "(SELECT cart_status FROM cart WHERE cart_id = {row}.cart_id) = 'completed'"
+    cart_changed = " OR ".join(f"OLD.{column} IS NOT NEW.{column}" for column in CART_COLUMNS)
+    item_changed = " OR ".join(f"OLD.{column} IS NOT NEW.{column}" for column in ITEM_COLUMNS)
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS analytics_cart_insert AFTER INSERT ON cart
+        WHEN NEW.cart_status = 'completed'
+        BEGIN {bump} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS analytics_cart_delete AFTER DELETE ON cart
+        WHEN OLD.cart_status = 'completed'
+        BEGIN {bump} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS analytics_cart_update
+        AFTER UPDATE OF {", ".join(CART_COLUMNS)} ON cart
+        WHEN (OLD.cart_status = 'completed' OR NEW.cart_status = 'completed') AND ({cart_changed})
+        BEGIN {bump} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS analytics_item_insert AFTER INSERT ON cart_item
+        WHEN {completed.format(row='NEW')}
+        BEGIN {bump} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS analytics_item_delete AFTER DELETE ON cart_item
+        WHEN {completed.format(row='OLD')}
+        BEGIN {bump} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS analytics_item_update
+        AFTER UPDATE OF {", ".join(ITEM_COLUMNS)} ON cart_item
+        WHEN ({item_changed}) AND ({completed.format(row='OLD')} OR {completed.format(row='NEW')})
+        BEGIN {bump} END
+    ''')
+
+def data_version(cursor):
+    """Changes whenever a cart is completed or refunded, or a completed one edited or removed."""
+    cursor.execute('''
+        SELECT (SELECT MAX(id) FROM refunds),
+               (SELECT value FROM settings WHERE key = 'archive_horizon'),
+               (SELECT version FROM analytics_version WHERE id = 1)
+    ''')
+    return cursor.fetchone()
+
+def load_line_items(cursor, start_date, end_date):
+    """One scan of the range's completed carts and items."""
+    end_exclusive = (datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+    cursor.execute('''
+        SELECT c.cart_id, DATE(c.order_date), c.cart_discount_type, c.cart_discount,
+               ci.product_id, ci.product_name, ci.quantity, ci.price,
+               ci.product_discount_type, ci.product_discount
+        FROM all_cart c
+        JOIN all_cart_item ci ON ci.cart_id = c.cart_id
+        WHERE c.cart_status = 'completed'
+          AND c.order_date >= ? AND c.order_date < ?
+        ORDER BY c.cart_id
+    ''', (start_date, end_exclusive))
+    items = LineItems()
+    for (cart_id, sale_date, cart_disc_type, cart_disc, product_id, product_name,
+         quantity, price, disc_type, disc) in cursor:
+        items.cart_id.append(cart_id)
+        items.sale_date.append(sale_date)
+        items.cart_discount_type.append(cart_disc_type)
+        items.cart_discount.append(cart_disc or 0)
+        items.product_id.append(product_id or 0)
+        items.product_name.append(product_name)
+        items.quantity.append(int(quantity or 0))
+        items.price.append(price or 0)
+        items.product_discount_type.append(disc_type)
+        items.product_discount.append(disc or 0)
+    return items
+
+def popular_products(items, limit=20):
+    quantity = defaultdict(int)
+    revenue = defaultdict(float)
+    carts = defaultdict(set)
+    for i in range(len(items)):
+        key = (items.product_id[i], items.product_name[i])
+        quantity[key] += items.quantity[i]
+        revenue[key] += items.quantity[i] * items.price[i]
+        carts[key].add(items.cart_id[i])
+    top = sorted(quantity, key=quantity.get, reverse=True)[:limit]
+    return [{
+        'product_id': product_id,
+        'product_name': product_name,
+        'total_quantity_sold': quantity[(product_id, product_name)],
+        'number_of_orders': len(carts[(product_id, product_name)]),
+        'total_revenue': revenue[(product_id, product_name)]
+    } for product_id, product_name in top]
+
+def product_revenue(items, limit=20):
+    net = defaultdict(float)
+    for i in range(len(items)):
+        price = items.price[i]
+        if items.product_discount_type[i] == 'fixed':
+            price -= items.product_discount[i]
+        elif items.product_discount_type[i] == 'percentage':
+            price -= price * (items.product_discount[i] / 100)
+        net[(items.product_id[i], items.product_name[i])] += items.quantity[i] * price
+    top = sorted(net, key=net.get, reverse=True)[:limit]
+    return [{'product_id': product_id, 'product_name': product_name, 'net_revenue': net[(product_id, product_name)]}
+            for product_id, product_name in top]
+
+def cart_totals(items):
+    """{cart_id: (sale_date, subtotal, cart_discount_type, cart_discount)}, shared by the per-order metrics."""
+    totals = {}
+    for i in range(len(items)):
+        cart_id = items.cart_id[i]
+        line = items.quantity[i] * items.price[i]
+        if cart_id in totals:
+            sale_date, subtotal, disc_type, disc = totals[cart_id]
+            totals[cart_id] = (sale_date, subtotal + line, disc_type, disc)
+        else:
+            totals[cart_id] = (items.sale_date[i], line, items.cart_discount_type[i], items.cart_discount[i])
+    return totals
+
+def sales_trends(totals):
+    revenue = defaultdict(float)
+    orders = defaultdict(int)
+    for sale_date, subtotal, _, _ in totals.values():
+        revenue[sale_date] += subtotal
+        orders[sale_date] += 1
+    return [{'sale_date': sale_date, 'daily_revenue': revenue[sale_date], 'orders_count': orders[sale_date]}
+            for sale_date in sorted(revenue)]
+
+def average_order_value(totals):
+    if not totals:
+        return 0
+    return sum(subtotal for _, subtotal, _, _ in totals.values()) / len(totals)
+
+def _round2(value):
+    # SQLite's ROUND goes half away from zero; Python's round() doesn't
+    return float(Decimal(repr(value)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
+
+def discount_usage(totals):
+    groups = {}
+    for _, subtotal, disc_type, disc in totals.values():
+        if disc_type == 'percentage' and disc > 0:
+            applied = _round2(subtotal * (disc / 100.0))
+        elif disc_type == 'fixed' and disc > 0:
+            applied = _round2(disc)
+        else:
+            applied = 0
+        group = groups.setdefault(disc_type, [0, 0.0, 0.0])
+        group[0] += 1
+        group[1] += subtotal
+        group[2] += applied
+    usage = [{
+        'cart_discount_type': disc_type,
+        'order_count': count,
+        'avg_discount_amount': applied / count,
+        'gross_sales': gross,
+        'total_discounts_applied': applied,
+        'net_sales': gross - applied
+    } for disc_type, (count, gross, applied) in groups.items() if applied > 0]
+    return sorted(usage, key=lambda row: row['total_discounts_applied'], reverse=True)
+
+def products_bought_together(items, limit=10):
+    """
+    Line pairs within a cart with product1_id < product2_id, as the old
+    self-join counted them, built per basket from product counts instead
+    of pairing every row with every other row.
+    """
+    pairs = defaultdict(int)
+    basket = defaultdict(int)
+    current = None
+    for i in range(len(items) + 1):
+        cart_id = items.cart_id[i] if i < len(items) else None
+        if cart_id != current:
+            products = sorted(basket.items())
+            for a in range(len(products)):
+                (id_a, name_a), count_a = products[a]
+                for b in range(a + 1, len(products)):
+                    (id_b, name_b), count_b = products[b]
+                    if id_a < id_b:
+                        pairs[(id_a, name_a, id_b, name_b)] += count_a * count_b
+            basket.clear()
+            current = cart_id
+        if cart_id is not None:
+            basket[(items.product_id[i], items.product_name[i] or '')] += 1
+    top = sorted(pairs, key=pairs.get, reverse=True)[:limit]
+    return [{
+        'product1_id': id_a, 'product1_name': name_a,
+        'product2_id': id_b, 'product2_name': name_b,
+        'times_bought_together': pairs[(id_a, name_a, id_b, name_b)]
+    } for id_a, name_a, id_b, name_b in top]
+
+def refund_summary(cursor, start_date, end_date):
+    refunds = list(cursor.execute('''
+        SELECT
+            COUNT(*) as refund_count,
+            SUM(amount) as total_refunded,
+            AVG(amount) as avg_refund,
+            (
+                SELECT json_group_array(json_object(
+                    'refund_date', timestamp,
+                    'order_id', cart_id,
+                    'amount', amount
+                ))
+                FROM all_refunds
+                ORDER BY timestamp DESC
+                LIMIT 10
+            ) as details
+        FROM all_refunds
+        WHERE timestamp BETWEEN ? AND ?
+    ''', (start_date, end_date)).fetchone())
+    return {
+        "refund_count": refunds[0],
+        "total_refunded": refunds[1],
+        "avg_refund": refunds[2],
+        "details": json.loads(refunds[3]) if refunds[3] else []
+    }
+
+def sales_analytics(start_date, end_date):
+    """
+    Same result as the old per-metric queries, computed from one load of the
+    range. Cached per (range, data version); 'timings_ms' holds per-metric times.
+    """
+    conn, cursor = archive.history_connection(start_date)
+    try:
+        key = (start_date, end_date, data_version(cursor))
+        with _cache_lock:
+            if key in _cache:
+                _cache.move_to_end(key)
+                return _cache[key]
+
+        timings = {}
+        def timed(name, fn, *args):
+            mark = time.perf_counter()
+            value = fn(*args)
+            timings[name] = round((time.perf_counter() - mark) * 1000, 2)
+            return value
+
+        items = timed('load', load_line_items, cursor, start_date, end_date)
+        totals = timed('cart_totals', cart_totals, items)
+        result = {
+            "date_range": {
+                "start_date": start_date,
+                "end_date": end_date
+            },
+            "popular_products": timed('popular_products', popular_products, items),
+            "product_revenue": timed('product_revenue', product_revenue, items),
+            "sales_trends": timed('sales_trends', sales_trends, totals),
+            "average_order_value": timed('average_order_value', average_order_value, totals),
+            "discount_usage": timed('discount_usage', discount_usage, totals),
+            "products_bought_together": timed('products_bought_together', products_bought_together, items),
+            "refunds": timed('refunds', refund_summary, cursor, start_date, end_date),
+            "timings_ms": timings
+        }
+        logger.info(f"Sales analytics {start_date}..{end_date} over {len(items)} lines: " +
+                    ", ".join(f"{name} {ms}ms" for name, ms in timings.items()))
+
+        with _cache_lock:
+            _cache[key] = result
+            while len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+        return result
+    finally:
+        conn.close()
@@ -12,17 +12,20 @@ import psutil
 if getattr(sys, 'frozen', False):
     os.environ['ESCPOS_CAPABILITIES_FILE'] = os.path.join(sys._MEIPASS, 'escpos', "capabilities.json")
 
-from flask import Flask, render_template, render_template_string, request, jsonify, redirect, url_for, send_file
+from flask import Flask, render_template, render_template_string, request, jsonify, redirect, url_for, send_file, Response, session
 from flask_cors import CORS, cross_origin
-import database, requests, json, secrets, config, helpers, webview, threading, sys, time, data_directory, wmi, urllib.parse, subprocess
+import database, requests, json, secrets, config, helpers, webview, threading, sys, time, data_directory, wmi, urllib.parse, subprocess, queue
 from logging_utils import logger, log_error, logs_folder
 from pos import pos_bp
 from pos import database as posdb
+from pos import async_settings, floor_state, menu_push, archive, shift_totals, option_index, retention, cart_batch, cart_snapshot, serialize
+import storefront_queue, orders_client, token_manager
 from datetime import datetime
 from os import path
 from waitress import serve
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from print_helpers_escpos import print_online_receipt, print_online_total
+from escposprint import print_pos_totals
 from teya_sdk_api import kill_teya_sdk
 
 if getattr(sys, 'frozen', False):
@@ -154,6 +157,7 @@ def token():
             if jwt:
                 database.create_tables()  # Create the table if it doesn't exist
                 database.insert_token(url, jwt)
+                token_manager.add(url, jwt)
                 return jsonify({'success': True, 'message': 'URL added successfully'})
             else:
                 result_message = 'JWT not found in the response'
@@ -223,15 +227,24 @@ def process_order(order, printed_order_ids):
 
 def fetch_orders(url, token, printed_order_ids):
     headers_template = {'Content-Type': 'application/json'}
+    token = token_manager.get(url) or token
 
-    while True:
+    # one retry after a 401; the token manager makes concurrent fetches share a single refresh
+    for attempt in range(2):
         headers = {**headers_template, 'Authorization': f'Bearer {token}'}
         full_url = f"https://{url}/app/v1/orders.php"
 
         try:
-            response = requests.post(full_url, json={}, headers=headers)
-            response.raise_for_status()
-            orders = response.json()
+            orders = None
+            if orders_client.use_v2(url):
+                try:
+                    orders = orders_client.fetch_orders_v2(url, token)
+                except orders_client.V2Unavailable:
+                    orders = None
+            if orders is None:
+                response = requests.post(full_url, json={}, headers=headers, timeout=(3.05, 15))
+                response.raise_for_status()
+                orders = response.json()
 
             filtered_orders = []
             for order in orders:
@@ -242,15 +255,13 @@ def fetch_orders(url, token, printed_order_ids):
             return filtered_orders
 
         except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 401:  # Unauthorized error
-                token_info = helpers.refresh_token()
-                if token_info:
-                    token = token_info[1]
+            if e.response.status_code == 401 and attempt == 0:  # Unauthorized error
+                token = token_manager.on_unauthorized(url, token)
+                if token:
                     logger.info(f"Token refreshed. Retrying...")
                     continue  # Retry with new token
-                else:
-                    logger.error("Token refresh failed.")
-                    return [{'error': 'Token refresh failed'}]
+                logger.error("Token refresh failed.")
+                return [{'error': 'Token refresh failed'}]
             else:
                 logger.error(f"HTTP error for {url}: {str(e)}")
                 return [{'error': f'HTTP error: {str(e)}'}]
@@ -261,7 +272,7 @@ def fetch_orders(url, token, printed_order_ids):
 
 @app.route('/refresh_token', methods=['GET'])
 def refresh_token_route():
-    token = helpers.refresh_token()  # Call the refresh_token function here
+    token = token_manager.refresh_all()
     #print(token)
     if token:
         return jsonify({'token': token})
@@ -281,20 +292,13 @@ def update_order(id, status, orderFor, siteUrl):
         "orderFor": orderFor
     }
     
-    headers = {
-        "Content-Type": "application/json"
-    }
-    
+    # delivered by the storefront queue so a slow or offline site doesn't hold up the till
     try:
-        response = requests.post(fullUrl, json=data, headers=headers)
-        
-        if response.status_code == 200:
-            return jsonify({"message": "Order updated successfully"})
-        else:
-            return jsonify({"message": f"Failed to update order. Status code: {response.status_code}"})
-    except requests.exceptions.RequestException as e:
-        logger.info("Update orders exception")
-        log_error(f'Error: {str(e)}')
+        command_id = storefront_queue.enqueue(url, 'update_order', id, fullUrl, data)
+        # delivery happens later; /storefront_queue/<command_id> reports whether the site accepted it
+        return jsonify({"message": "Order update queued", "queued": True, "command_id": command_id})
+    except Exception as e:
+        log_error(f'Error queueing order update: {str(e)}')
         return jsonify({"message": f"Error: {str(e)}"})
 
 @app.route('/acknowledge_cancel/<id>/<path:siteUrl>', methods=['POST'])
@@ -306,22 +310,34 @@ def acknowledge_cancel(id, siteUrl):
         "id": id,
         "seen": True
     }
-    headers = {
-        "Content-Type": "application/json"
-    }
     
     try:
-        response = requests.post(fullUrl, json=data, headers=headers)
-        
-        if response.status_code == 200:
-            return jsonify({"message": "Acknowledged successfully"})
-        else:
-            return jsonify({"message": f"Failed to acknowledge. Status code: {response.status_code}"})
-    except requests.exceptions.RequestException as e:
-        logger.info("Update orders exception")
-        log_error(f'Error: {str(e)}')
+        command_id = storefront_queue.enqueue(url, 'acknowledge_cancel', id, fullUrl, data)
+        return jsonify({"message": "Acknowledgement queued", "queued": True, "command_id": command_id})
+    except Exception as e:
+        log_error(f'Error queueing acknowledgement: {str(e)}')
         return jsonify({"message": f"Error: {str(e)}"})
 
+@app.route('/storefront_queue')
+def storefront_backlog():
+    return jsonify(storefront_queue.backlog())
+
+@app.route('/storefront_queue/<int:command_id>')
+def storefront_command_status(command_id):
+    status = storefront_queue.command_status(command_id)
+    if status is None:
+        return jsonify({"message": "Command not found"}), 404
+    return jsonify(status)
+
+@app.route('/storefront_queue/retry/<int:command_id>', methods=['POST'])
+def storefront_retry(command_id):
+    result = storefront_queue.retry_failed(command_id)
+    if result == 'queued':
+        return jsonify({"message": "Queued for retry"})
+    if result == 'superseded':
+        return jsonify({"message": "A newer update for this order is already queued or sent; this one was dropped"})
+    return jsonify({"message": "Command not found or already queued"}), 404
+
 @app.route('/manual_print', methods=['POST'])
 def manuel_print():
     order_data = request.json
@@ -512,10 +528,182 @@ def get_logs():
         as_attachment=True  # Forces the browser to download the file
     )
 
+@app.route('/order_history_page')
+def order_history_page():
+    try:
+        page = posdb.get_order_history_page(
+            request.args.get('start_date'), request.args.get('end_date'),
+            request.args.get('payment_method'), request.args.get('cursor'),
+            min(int(request.args.get('limit', 50)), 500)
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(page)
+
+@app.route('/order_history_export')
+def order_history_export():
+    start_date, end_date = request.args.get('start_date'), request.args.get('end_date')
+    if bool(start_date) != bool(end_date):
+        return jsonify({'error': 'Both start_date and end_date must be provided, or neither'}), 400
+    return Response(
+        posdb.order_history_ndjson(start_date, end_date, request.args.get('payment_method')),
+        mimetype='application/x-ndjson',
+        headers={'Content-Disposition': 'attachment; filename=order_history.ndjson'}
+    )
+
+@app.route('/x_read')
+def x_read():
+    totals = shift_totals.x_read(request.args.get('date'))
+    if totals is None:
+        return jsonify({'error': 'Could not read shift totals'}), 500
+    return jsonify(totals)
+
+@app.route('/z_report', methods=['POST'])
+def close_z_report():
+    data = request.get_json(silent=True) or {}
+    report = shift_totals.close_day(data.get('date'), session.get('employee_id', 0))
+    if report is None:
+        return jsonify({'error': 'Could not close the day'}), 500
+    return jsonify(report)
+
+@app.route('/z_reports')
+def z_reports():
+    try:
+        limit = max(1, min(int(request.args.get('limit', 30)), 365))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(shift_totals.list_z_reports(limit))
+
+@app.route('/z_report/<int:report_id>/print', methods=['POST'])
+def reprint_z_report(report_id):
+    report = shift_totals.get_z_report(report_id)
+    if report is None:
+        return jsonify({'error': 'Z report not found'}), 404
+    totals = dict(report['totals'], printed_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    print_pos_totals(totals)
+    return jsonify({'message': 'Print request received'})
+
+@app.route('/option_templates')
+def option_templates():
+    search = option_index.search_product_templates if request.args.get('kind') == 'products' else option_index.search_option_templates
+    try:
+        page = search(request.args.get('q', ''), request.args.get('cursor'), request.args.get('limit', option_index.PAGE_SIZE))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(page)
+
+@app.route('/scan_to_cart', methods=['POST'])
+def scan_to_cart():
+    data = request.get_json(silent=True) or {}
+    try:
+        cart_id = int(data['cartId'])
+        quantity = int(data.get('quantity', 1))
+    except (KeyError, ValueError, TypeError) as e:
+        return jsonify({'error': f'Invalid request: {e}'}), 400
+    result, status = posdb.scan_item_to_cart(cart_id, str(data.get('barcode', '')), quantity)
+    return serialize.response(result, status)
+
+@app.route('/cart/<int:cart_id>/snapshot')
+async def cart_snapshot_view(cart_id):
+    snapshot = cart_snapshot.get(cart_id)
+    if snapshot is None:
+        return serialize.response({'error': 'Cart not found'}, 404)
+    # the till's Card button needs the vendor; it isn't cart content, so it goes in the ETag beside the version
+    vendor = await async_settings.get_active_payment_vendor()
+    snapshot['card_vendor'] = vendor['vendor_name']
+    # clients send the ETag back as If-None-Match and get a 304 while neither has changed
+    response = serialize.response(snapshot)
+    response.set_etag(f"{snapshot['version']}-{vendor['vendor_name']}")
+    return response.make_conditional(request)
+
+@app.route('/cart/<int:cart_id>/batch', methods=['POST'])
+def cart_batch_update(cart_id):
+    data = request.get_json(silent=True) or {}
+    result, status = cart_batch.apply(cart_id, data.get('operations'))
+    response = serialize.response(result, status)
+    if status == 200:
+        response.set_etag(result['version'])
+    return response
+
+@app.route('/retention_jobs/<int:job_id>')
+def retention_job(job_id):
+    job = retention.job_status(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/retention/purge_inactive', methods=['POST'])
+def purge_inactive_customers():
+    data = request.get_json(silent=True) or {}
+    try:
+        job_id = retention.queue_inactive_purge(data['years'], data.get('mode', 'anonymise'))
+    except (KeyError, ValueError, TypeError) as e:
+        return jsonify({'error': f'Invalid request: {e}'}), 400
+    return jsonify({'job_id': job_id}), 202
+
+@app.route('/floor_snapshot')
+def floor_snapshot():
+    return jsonify(floor_state.snapshot())
+
+# each floor_events stream holds a waitress thread; ending it this often frees the
+# thread and the browser reconnects with Last-Event-ID
+FLOOR_STREAM_SECONDS = 300
+
+@app.route('/floor_events')
+def floor_events():
+    """
+    Server-sent table changes. Clients reconnect with Last-Event-ID and get the
+    missed events, or a full 'snapshot' event when those are no longer held.
+    Streams end after FLOOR_STREAM_SECONDS.
+    """
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('since')
+
+    def sse(event, data, event_id=None):
+        message = f"id: {event_id}\n" if event_id is not None else ""
+        return message + f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    def stream():
+        subscriber = floor_state.subscribe()
+        ends_at = time.monotonic() + FLOOR_STREAM_SECONDS
+        try:
+            yield "retry: 3000\n\n"
+            backlog = floor_state.events_since(int(last_id)) if last_id and last_id.isdigit() else None
+            if backlog is None:
+                snapshot = floor_state.snapshot()
+                sent = snapshot['version']
+                yield sse('snapshot', snapshot, sent)
+            else:
+                sent = int(last_id)
+                for event in backlog:
+                    sent = event['version']
+                    yield sse(event['type'], event, sent)
+
+            while time.monotonic() < ends_at:
+                if subscriber.overflowed:
+                    subscriber.overflowed = False
+                    snapshot = floor_state.snapshot()
+                    sent = snapshot['version']
+                    yield sse('snapshot', snapshot, sent)
+                try:
+                    event = subscriber.queue.get(timeout=15)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if event['version'] <= sent:
+                    continue
+                sent = event['version']
+                yield sse(event['type'], event, sent)
+        finally:
+            floor_state.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 def run_flask_app():
     global flask_app_running
     if not flask_app_running:
-        serve(app, host='0.0.0.0', port=5000, threads=6)
+        # floor_events streams hold a thread each, leave room for handhelds
+        serve(app, host='0.0.0.0', port=5000, threads=16)
         flask_app_running = True
 
 def on_closed():
@@ -595,6 +783,11 @@ if __name__ == '__main__':
     check_single_instance()
     helpers.reservation_prints()
     helpers.start_sync_thread(config.LICENCE_BASE_URL)
+    token_manager.start_refresher()
+    storefront_queue.start_worker()
+    menu_push.start_push_worker(token_manager.tokens)
+    archive.start_archiver()
+    retention.start_worker()
     helpers.initialize_license_system(config.LICENCE_BASE_URL)
     threading.Thread(target=run_flask_app).start()
     webview.settings['OPEN_EXTERNAL_LINKS_IN_BROWSER'] = False
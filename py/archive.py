@@ -0,0 +1,235 @@
+import os, re, json, sqlite3, threading
+from datetime import datetime, timedelta
+from . import database
+from logging_utils import logger, log_error
+
+ARCHIVE_FILE = "pos_archive.db"
+# closed carts older than this many days move to the archive; 0 turns archiving off
+DEFAULT_AFTER_DAYS = 90
+CHUNK_SIZE = 500
+CLOSED_STATUSES = ('completed', 'refunded', 'partial_refund')
+# table -> column holding the cart id; read through the all_<table> views
+ARCHIVED_TABLES = {
+    'cart': 'cart_id',
+    'cart_item': 'cart_id',
+    'cart_payments': 'cart_id',
+    'cart_dining_tables': 'cart_id',
+    'refunds': 'cart_id',
+    'kitchen_orders': 'order_id'
+}
+
+def archive_path():
+    return os.path.join(database.data_dir, ARCHIVE_FILE)
+
+def _get_setting(cursor, key):
+    cursor.execute("SELECT value FROM main.settings WHERE key = ?", (key,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def _set_setting(cursor, key, value):
+    cursor.execute("INSERT INTO main.settings (key, value) VALUES (?, ?) "
+                   "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                   (key, value))
+
+def _columns(cursor, schema, table):
+    cursor.execute(f'PRAGMA {schema}.table_info("{table}")')
+    return [row[1] for row in cursor.fetchall()]
+
+def _live_tables(cursor):
+    cursor.execute("SELECT name, sql FROM main.sqlite_master WHERE type = 'table'")
+    return {name: sql for name, sql in cursor.fetchall() if name in ARCHIVED_TABLES}
+
+def _ensure_archive_schema(cursor):
+    """Create archive tables from the live definitions and add any columns added since."""
+    for table, sql in _live_tables(cursor).items():
+        create = re.sub(r'^CREATE TABLE\s+("?)(\w+)\1', f'CREATE TABLE IF NOT EXISTS archive."{table}"', sql, count=1)
+        cursor.execute(create)
+        archived = set(_columns(cursor, 'archive', table))
+        cursor.execute(f'PRAGMA main.table_info("{table}")')
+        for _, column, column_type, _, default, _ in cursor.fetchall():
+            if column not in archived:
+                try:
+                    default_sql = f" DEFAULT {default}" if default is not None else ""
+                    cursor.execute(f'ALTER TABLE archive."{table}" ADD COLUMN "{column}" {column_type}{default_sql}')
+                except sqlite3.OperationalError:
+                    # ADD COLUMN only takes constant defaults; archived rows carry their values anyway
+                    cursor.execute(f'ALTER TABLE archive."{table}" ADD COLUMN "{column}" {column_type}')
+        key = ARCHIVED_TABLES[table]
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS archive.idx_archive_{table}_{key} ON "{table}"({key})')
+    cursor.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_cart_charge_updated ON cart(cart_charge_updated, cart_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_cart_customer ON cart(customer_id)")
+
+def archive_closed_carts(after_days=None, chunk_size=CHUNK_SIZE):
+    """
+    Move closed carts last charged more than after_days ago, with their
+    items, payments, tables, refunds and kitchen rows, into pos_archive.db.
+    Each chunk is copied and deleted in one transaction across both files.
+    Returns the number of carts moved.
+    """
+    conn = None
+    moved = 0
+    try:
+        conn, cursor = database.get_database_connection()
+        if after_days is None:
+            after_days = int(_get_setting(cursor, 'archive_after_days') or DEFAULT_AFTER_DAYS)
+        if after_days <= 0:
+            return 0
+        cutoff = (datetime.now() - timedelta(days=after_days)).strftime('%Y-%m-%d %H:%M:%S')
+
+        cursor.execute("ATTACH DATABASE ? AS archive", (archive_path(),))
+        _ensure_archive_schema(cursor)
+        conn.commit()
+        tables = {table: ARCHIVED_TABLES[table] for table in _live_tables(cursor)}
+        columns = {table: ", ".join(f'"{c}"' for c in _columns(cursor, 'main', table)) for table in tables}
+
+        conn.isolation_level = None
+        while True:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(f'''
+                SELECT cart_id, cart_charge_updated FROM main.cart
+                WHERE cart_status IN ({",".join("?" * len(CLOSED_STATUSES))})
+                  AND cart_charge_updated < ?
+                ORDER BY cart_id
+                LIMIT ?
+            ''', (*CLOSED_STATUSES, cutoff, chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                cursor.execute("COMMIT")
+                break
+            ids = json.dumps([row[0] for row in rows])
+            for table, key in tables.items():
+                cursor.execute(f'''
+                    INSERT INTO archive."{table}" ({columns[table]})
+                    SELECT {columns[table]} FROM main."{table}"
+                    WHERE {key} IN (SELECT value FROM json_each(?))
+                ''', (ids,))
+                cursor.execute(f'DELETE FROM main."{table}" WHERE {key} IN (SELECT value FROM json_each(?))', (ids,))
+            # newest charge time in the archive; history reads starting after it skip the attach
+            horizon = max(str(row[1]) for row in rows)
+            if horizon > (_get_setting(cursor, 'archive_horizon') or ''):
+                _set_setting(cursor, 'archive_horizon', horizon)
+            cursor.execute("COMMIT")
+            moved += len(rows)
+
+        if moved:
+            logger.info(f"Archived {moved} closed carts older than {after_days} days")
+        return moved
+    except sqlite3.Error as e:
+        if conn and conn.in_transaction:
+            conn.rollback()
+        log_error(f"Error archiving carts: {e}")
+        return moved
+    finally:
+        if conn:
+            conn.close()
+
+def _archive_available(cursor):
+    return bool(_get_setting(cursor, 'archive_horizon')) and os.path.exists(archive_path())
+
+def _create_views(cursor, attach, prefix):
+    """
+    TEMP views over each archived table, named prefix + table. The archive
+    is left as the archiver last shaped it: columns added to the live table
+    since then read as NULL for archived rows.
+    """
+    for table in _live_tables(cursor):
+        live = _columns(cursor, 'main', table)
+        archived = set(_columns(cursor, 'archive', table)) if attach else set()
+        if archived:
+            columns = ", ".join(f'"{c}"' for c in live)
+            archived_columns = ", ".join(f'"{c}"' if c in archived else f'NULL AS "{c}"' for c in live)
+            cursor.execute(f'''
+                CREATE TEMP VIEW "{prefix}{table}" AS
+                SELECT {columns} FROM main."{table}"
+                UNION ALL
+                SELECT {archived_columns} FROM archive."{table}"
+            ''')
+        else:
+            cursor.execute(f'CREATE TEMP VIEW "{prefix}{table}" AS SELECT * FROM main."{table}"')
+
+def history_connection(since=None):
+    """
+    (conn, cursor) with TEMP views all_cart, all_cart_item, all_cart_payments,
+    all_cart_dining_tables, all_refunds and all_kitchen_orders covering live
+    and archived rows. The archive is only attached when it may hold rows on
+    or after since (a date or datetime string); otherwise the views are just
+    the live tables.
+    """
+    conn, cursor = database.get_database_connection()
+    horizon = _get_setting(cursor, 'archive_horizon')
+    attach = _archive_available(cursor) and (since is None or str(since) <= horizon)
+    if attach:
+        cursor.execute("ATTACH DATABASE ? AS archive", (archive_path(),))
+    _create_views(cursor, attach, 'all_')
+    return conn, cursor
+
+def _is_live(cursor, cart_id):
+    cursor.execute("SELECT 1 FROM main.cart WHERE cart_id = ?", (cart_id,))
+    return cursor.fetchone() is not None
+
+def cart_connection(cart_id):
+    """
+    (conn, cursor) for reading one cart wherever it is. A live cart gets a
+    plain connection. For an archived one the archive is attached and TEMP
+    views named after the archived tables (cart, cart_item, ...) shadow
+    them, so the usual per-cart queries read it unchanged; those tables
+    are read-only on this connection.
+    """
+    conn, cursor = database.get_database_connection()
+    if not _is_live(cursor, cart_id) and _archive_available(cursor):
+        cursor.execute("ATTACH DATABASE ? AS archive", (archive_path(),))
+        _create_views(cursor, True, '')
+    return conn, cursor
+
+def restore_cart(cart_id):
+    """
+    Move an archived cart and its rows back into the live tables so it can
+    be changed again (refunds). Returns True if the cart was restored; a
+    cart that is live or unknown is left alone.
+    """
+    conn = None
+    try:
+        conn, cursor = database.get_database_connection()
+        if _is_live(cursor, cart_id) or not _archive_available(cursor):
+            return False
+        cursor.execute("ATTACH DATABASE ? AS archive", (archive_path(),))
+        conn.isolation_level = None
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT 1 FROM archive.cart WHERE cart_id = ?", (cart_id,))
+        if not cursor.fetchone():
+            cursor.execute("ROLLBACK")
+            return False
+        for table, key in ARCHIVED_TABLES.items():
+            archived = set(_columns(cursor, 'archive', table))
+            columns = ", ".join(f'"{c}"' for c in _columns(cursor, 'main', table) if c in archived)
+            if not columns:
+                continue
+            cursor.execute(f'''
+                INSERT INTO main."{table}" ({columns})
+                SELECT {columns} FROM archive."{table}" WHERE {key} = ?
+            ''', (cart_id,))
+            cursor.execute(f'DELETE FROM archive."{table}" WHERE {key} = ?', (cart_id,))
+        cursor.execute("COMMIT")
+        logger.info(f"Restored archived cart {cart_id}")
+        return True
+    except sqlite3.Error as e:
+        if conn and conn.in_transaction:
+            conn.rollback()
+        log_error(f"Error restoring archived cart {cart_id}: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+def _run(interval, stop_event):
+    while not stop_event.is_set():
+        try:
+            archive_closed_carts()
+        except Exception as e:
+            log_error(f"Archiver error: {e}")
+        stop_event.wait(interval)
+
+def start_archiver(interval=6 * 3600):
+    stop_event = threading.Event()
+    threading.Thread(target=_run, args=(interval, stop_event), daemon=True).start()
+    return stop_event
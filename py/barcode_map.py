@@ -0,0 +1,105 @@
+import threading
+from logging_utils import logger
+
+# barcode -> product fields a scan needs; reloaded when barcode_map_version moves
+_map = {}
+_version = None
+_lock = threading.Lock()
+
+# product columns shown on a scan; stock is always read live
+WATCHED_COLUMNS = ('barcode', 'product_name', 'out_price', 'category_id', 'is_hidden', 'vatable', 'track_inventory')
+
+def create_barcode_index(cursor):
+    """
+    Unique index on products.barcode (blank barcodes excluded) and the
+    triggers that bump barcode_map_version on any product or category edit a
+    scan would see, from every write path. Existing duplicate barcodes get a
+    plain index instead until they are cleaned up.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS barcode_map_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO barcode_map_version (id, version) VALUES (1, 0)")
+
+    bump = "UPDATE barcode_map_version SET version = version + 1 WHERE id = 1;"
+    changed = " OR ".join(f"OLD.{column} IS NOT NEW.{column}" for column in WATCHED_COLUMNS)
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS barcode_map_products_insert AFTER INSERT ON products BEGIN {bump} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS barcode_map_products_delete AFTER DELETE ON products BEGIN {bump} END")
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS barcode_map_products_update
+        AFTER UPDATE OF {", ".join(WATCHED_COLUMNS)} ON products
+        WHEN {changed}
+        BEGIN {bump} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS barcode_map_category_update
+        AFTER UPDATE OF category_order ON category
+        WHEN OLD.category_order IS NOT NEW.category_order
+        BEGIN {bump} END
+    ''')
+
+    cursor.execute('''
+        SELECT barcode FROM products
+        WHERE barcode IS NOT NULL AND barcode != ''
+        GROUP BY barcode HAVING COUNT(*) > 1
+    ''')
+    duplicates = [row[0] for row in cursor.fetchall()]
+    if duplicates:
+        logger.info(f"Duplicate product barcodes, not enforcing uniqueness: {', '.join(duplicates[:10])}")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_barcode ON products(barcode)")
+    else:
+        cursor.execute("DROP INDEX IF EXISTS idx_products_barcode")
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_products_barcode_unique
+            ON products(barcode) WHERE barcode IS NOT NULL AND barcode != ''
+        ''')
+
+def _load(cursor):
+    cursor.execute('''
+        SELECT p.barcode, p.product_id, p.product_name, p.out_price, c.category_order, p.vatable, p.track_inventory
+        FROM products p
+        JOIN category c ON p.category_id = c.category_id
+        WHERE p.is_hidden = 0 AND p.barcode IS NOT NULL AND p.barcode != ''
+        ORDER BY p.product_id DESC
+    ''')
+    # with duplicate barcodes the oldest product wins
+    return {
+        barcode: {'product_id': product_id, 'product_name': name, 'out_price': out_price,
+                  'category_order': category_order, 'vatable': vatable, 'track_inventory': track_inventory}
+        for barcode, product_id, name, out_price, category_order, vatable, track_inventory in cursor.fetchall()
+    }
+
+def _current(cursor):
+    global _map, _version
+    cursor.execute("SELECT version FROM barcode_map_version WHERE id = 1")
+    version = cursor.fetchone()[0]
+    with _lock:
+        if version != _version:
+            _map = _load(cursor)
+            _version = version
+            logger.info(f"Barcode map loaded with {len(_map)} products")
+        return _map
+
+def warm(cursor):
+    """Load the map ahead of the first scan."""
+    _current(cursor)
+
+def lookup(cursor, barcode):
+    """
+    Visible product for a scanned barcode, or None. Tracked products carry
+    their live stock_quantity.
+    {'product_id': 4, 'product_name': 'Cola', 'out_price': 1.2, 'category_order': 3,
+     'vatable': 1, 'track_inventory': 1, 'stock_quantity': 24}
+    """
+    entry = _current(cursor).get(str(barcode))
+    if entry is None:
+        return None
+    product = dict(entry, stock_quantity=None)
+    if product['track_inventory'] == 1:
+        cursor.execute("SELECT stock_quantity FROM products WHERE product_id = ?", (product['product_id'],))
+        row = cursor.fetchone()
+        product['stock_quantity'] = (row[0] or 0) if row else 0
+    return product
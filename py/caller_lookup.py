@@ -0,0 +1,139 @@
+import re, threading
+from collections import OrderedDict
+from . import database
+
+# Numbers dialled nationally (leading 0) are assumed to be UK numbers
+DEFAULT_COUNTRY_CODE = '44'
+CACHE_SIZE = 256
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def normalize_phone(number, country_code=DEFAULT_COUNTRY_CODE):
+    """Return the E.164 form of a phone number ('+447700900123') or None if it can't be one."""
+    if not number:
+        return None
+    number = str(number).strip()
+    digits = re.sub(r'\D', '', number)
+    if number.startswith('+'):
+        pass
+    elif digits.startswith('00'):
+        digits = digits[2:]
+    elif digits.startswith('0'):
+        digits = country_code + digits[1:]
+    elif len(digits) <= 10:
+        digits = country_code + digits
+    if not 8 <= len(digits) <= 15:
+        return None
+    return '+' + digits
+
+def create_phone_key_index(cursor):
+    """Add the normalised phone key column to customers, backfill it and index it."""
+    cursor.execute("PRAGMA table_info(customers)")
+    columns = [col[1] for col in cursor.fetchall()]
+    if 'customer_telephone_key' not in columns:
+        cursor.execute('ALTER TABLE customers ADD COLUMN customer_telephone_key TEXT')
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND name = 'idx_customers_telephone_key'")
+    row = cursor.fetchone()
+    if row and 'UNIQUE' in row[0].upper():
+        # the first version let one customer per number hold the key; key the rest too
+        cursor.execute("DROP INDEX idx_customers_telephone_key")
+        cursor.execute("DROP INDEX IF EXISTS idx_customers_telephone_unkeyed")
+        cursor.execute("DELETE FROM settings WHERE key = 'customer_phone_keys_backfilled'")
+    # several customers can share a number, so the key isn't unique
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_customers_telephone_key
+        ON customers(customer_telephone_key) WHERE customer_telephone_key IS NOT NULL
+    ''')
+    backfill_phone_keys(cursor)
+
+def backfill_phone_keys(cursor, batch_size=1000):
+    """
+    Fill customer_telephone_key for rows that don't have one yet.
+    Runs once; later writes key their rows through set_phone_key.
+    """
+    cursor.execute("SELECT value FROM settings WHERE key = 'customer_phone_keys_backfilled'")
+    if cursor.fetchone():
+        return
+    cursor.execute('''
+        SELECT customer_id, customer_telephone FROM customers
+        WHERE customer_telephone_key IS NULL AND customer_telephone IS NOT NULL
+        ORDER BY customer_id
+    ''')
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        updates = []
+        for customer_id, telephone in rows:
+            key = normalize_phone(telephone)
+            if key:
+                updates.append((key, customer_id))
+        if updates:
+            # separate cursor so the outer SELECT keeps its position
+            cursor.connection.executemany(
+                "UPDATE customers SET customer_telephone_key = ? WHERE customer_id = ?",
+                updates
+            )
+    cursor.execute("INSERT INTO settings (key, value) VALUES ('customer_phone_keys_backfilled', '1') "
+                   "ON CONFLICT(key) DO UPDATE SET value = excluded.value")
+
+def set_phone_key(cursor, customer_id, telephone):
+    """Keep the key in step with customer_telephone; call inside the writing transaction."""
+    cursor.execute(
+        "UPDATE customers SET customer_telephone_key = ? WHERE customer_id = ?",
+        (normalize_phone(telephone), customer_id)
+    )
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+def lookup(phone_number):
+    """
+    Customer and address rows for an incoming number, served from the
+    recent callers cache when possible.
+    [{'address_id': 3, 'address': '1 High St', 'postcode': 'AB1 2CD', 'distance': 1.2,
+      'customer_id': 7, 'customer_name': 'Sam', 'customer_telephone': '07700900123'}]
+    """
+    key = normalize_phone(phone_number)
+    cache_key = key or phone_number
+    with _cache_lock:
+        if cache_key in _cache:
+            _cache.move_to_end(cache_key)
+            return [dict(row) for row in _cache[cache_key]]
+
+    results = _fetch(key, phone_number)
+
+    with _cache_lock:
+        _cache[cache_key] = results
+        _cache.move_to_end(cache_key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return [dict(row) for row in results]
+
+def _fetch(key, phone_number):
+    conn = None
+    try:
+        conn, cursor = database.get_database_connection()
+        # numbers that can't be normalised have no key and are matched as entered
+        if key:
+            where, param = "c.customer_telephone_key = ?", key
+        else:
+            where, param = "c.customer_telephone_key IS NULL AND c.customer_telephone = ?", phone_number
+        cursor.execute(f"""
+            SELECT
+                a.address_id, a.address, a.postcode, a.distance,
+                c.customer_id, c.customer_name, c.customer_telephone
+            FROM customers c
+            LEFT JOIN customer_addresses a ON c.customer_id = a.customer_id
+            WHERE {where}
+            ORDER BY c.customer_id
+        """, (param,))
+        rows = cursor.fetchall()
+
+        columns = [col[0] for col in cursor.description]
+        return [dict(zip(columns, row)) for row in rows]
+    finally:
+        if conn:
+            conn.close()
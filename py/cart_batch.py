@@ -0,0 +1,161 @@
+from datetime import datetime
+from . import database, inventory, sync_outbox, cart_lines, cart_snapshot
+
+MAX_OPERATIONS = 200
+
+# op -> fields it needs besides 'op'
+REQUIRED_FIELDS = {
+    'add': ('product_id', 'product_name', 'price', 'quantity', 'category_order'),
+    'update': ('cart_item_id', 'quantity'),
+    'update_mods': ('cart_item_id', 'quantity', 'mods'),
+    'delete': ('cart_item_id',),
+    'discount': ('cart_item_id', 'discount_type', 'discount_value'),
+    'remove_discount': ('cart_item_id',)
+}
+
+class BatchError(Exception):
+    """An operation the batch can't apply; nothing in the batch is written."""
+    def __init__(self, index, message, status=400):
+        super().__init__(message)
+        self.index = index
+        self.status = status
+
+def mods_string(mods):
+    """Modifiers as stored in product_note: 'modifier_id|name|price|qty, ...'."""
+    mod_strings = []
+    for mod in mods:
+        mod_id = mod.get('modifier_id', 0)
+        name = mod.get('name', '').replace('|', '-').replace(',', '-')  # Sanitize
+        price = mod.get('price', 0)
+        qty = mod.get('qty', 1)
+        mod_strings.append(f"{mod_id}|{name}|{price}|{qty}")
+    return ', '.join(mod_strings)
+
+def _validate(operations):
+    if not isinstance(operations, list) or not operations:
+        raise BatchError(None, "operations must be a non-empty list")
+    if len(operations) > MAX_OPERATIONS:
+        raise BatchError(None, f"At most {MAX_OPERATIONS} operations per batch")
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get('op') not in REQUIRED_FIELDS:
+            raise BatchError(index, f"Unknown operation, expected one of {', '.join(REQUIRED_FIELDS)}")
+        missing = [field for field in REQUIRED_FIELDS[operation['op']] if operation.get(field) is None]
+        if missing:
+            raise BatchError(index, f"{operation['op']} needs {', '.join(missing)}")
+        try:
+            if 'quantity' in operation and int(operation['quantity']) < 1:
+                raise BatchError(index, "quantity must be at least 1")
+            for field in ('cart_item_id', 'product_id'):
+                if field in operation:
+                    int(operation[field])
+        except (TypeError, ValueError):
+            raise BatchError(index, "quantity, cart_item_id and product_id must be whole numbers")
+
+def _line(cursor, cart_id, index, cart_item_id):
+    cursor.execute("SELECT product_id FROM cart_item WHERE cart_item_id = ? AND cart_id = ?", (int(cart_item_id), cart_id))
+    row = cursor.fetchone()
+    if not row:
+        raise BatchError(index, f"Cart item {cart_item_id} is not in cart {cart_id}", 404)
+    return row[0]
+
+def _apply(cursor, cart_id, index, operation):
+    """Apply one operation; returns the product whose cart quantity may have grown, if any."""
+    op = operation['op']
+    if op == 'add':
+        cart_lines.add_lines(cursor, cart_id, [{
+            'product_id': int(operation['product_id']), 'product_name': operation['product_name'],
+            'price': operation['price'], 'quantity': int(operation['quantity']),
+            'options': operation.get('options') or '', 'product_note': operation.get('product_note') or '',
+            'category_order': operation['category_order'], 'vatable': operation.get('vatable', 0)
+        }])
+        return int(operation['product_id'])
+
+    product_id = _line(cursor, cart_id, index, operation['cart_item_id'])
+    cart_item_id = int(operation['cart_item_id'])
+    if op == 'update_mods' or (op == 'update' and 'product_note' in operation):
+        note = mods_string(operation['mods']) if op == 'update_mods' else operation['product_note'] or ''
+        cursor.execute("UPDATE cart_item SET product_note = ?, quantity = ? WHERE cart_item_id = ?",
+                       (note, int(operation['quantity']), cart_item_id))
+        return product_id
+    if op == 'update':
+        # no product_note in the operation leaves the line's note as it is
+        cursor.execute("UPDATE cart_item SET quantity = ? WHERE cart_item_id = ?",
+                       (int(operation['quantity']), cart_item_id))
+        return product_id
+    if op == 'delete':
+        cursor.execute("DELETE FROM cart_item WHERE cart_item_id = ?", (cart_item_id,))
+    elif op == 'discount':
+        cursor.execute("UPDATE cart_item SET product_discount_type = ?, product_discount = ? WHERE cart_item_id = ?",
+                       (operation['discount_type'], operation['discount_value'], cart_item_id))
+    else:
+        cursor.execute("UPDATE cart_item SET product_discount = 0, product_discount_type = 'fixed' WHERE cart_item_id = ?",
+                       (cart_item_id,))
+    return None
+
+def apply(cart_id, operations):
+    """
+    Apply an ordered list of line operations to one cart in a single
+    transaction: stock is checked once per product against the cart's final
+    quantities, the cart is touched and queued for sync once, and the
+    result is the cart as it now stands. Any failure writes nothing.
+
+    cart_batch.apply(12, [
+        {'op': 'add', 'product_id': 4, 'product_name': 'Cola', 'price': 1.2, 'quantity': 2,
+         'options': '', 'product_note': '', 'category_order': 3, 'vatable': 1},
+        {'op': 'update_mods', 'cart_item_id': 81, 'quantity': 1,
+         'mods': [{'modifier_id': 1, 'name': 'Extra cheese', 'price': 0.5, 'qty': 1}]},
+        {'op': 'discount', 'cart_item_id': 82, 'discount_type': 'percentage', 'discount_value': 10},
+        {'op': 'delete', 'cart_item_id': 83}
+    ])
+    Returns (cart_snapshot.build() of the updated cart, 200) or
+    ({'error': ..., 'index': 1}, 4xx) naming the operation that failed.
+    """
+    conn = None
+    try:
+        _validate(operations)
+        conn, cursor = database.get_database_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT 1 FROM cart WHERE cart_id = ?", (cart_id,))
+        if not cursor.fetchone():
+            raise BatchError(None, f"Cart {cart_id} not found", 404)
+
+        grown = {}
+        discounts = False
+        for index, operation in enumerate(operations):
+            product_id = _apply(cursor, cart_id, index, operation)
+            if product_id is not None:
+                grown[product_id] = index
+            discounts = discounts or operation['op'] in ('discount', 'remove_discount')
+
+        for product_id, index in grown.items():
+            cursor.execute("SELECT COALESCE(SUM(quantity), 0) FROM cart_item WHERE cart_id = ? AND product_id = ?",
+                           (cart_id, product_id))
+            try:
+                inventory.reserve_for_cart(cursor, cart_id, product_id, cursor.fetchone()[0])
+            except inventory.InsufficientStock as e:
+                raise BatchError(index, str(e))
+
+        cursor.execute('''
+            UPDATE cart
+            SET cart_charge_updated = ?,
+                sync_status = CASE WHEN sync_status != 'pending' THEN 'pending' ELSE sync_status END
+            WHERE cart_id = ?
+        ''', (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), cart_id))
+        sync_outbox.record(cursor, cart_id, 'items')
+        if discounts:
+            sync_outbox.record(cursor, cart_id, 'discount')
+
+        snapshot = cart_snapshot.build(cursor, cart_id)
+        conn.commit()
+        return snapshot, 200
+    except BatchError as e:
+        if conn:
+            conn.rollback()
+        return {'error': str(e), 'index': e.index}, e.status
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        return {'error': str(e)}, 500
+    finally:
+        if conn:
+            conn.close()
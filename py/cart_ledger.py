@@ -0,0 +1,88 @@
+import sqlite3
+from . import archive
+from logging_utils import logger, log_error
+
+def create_ledger_table(cursor):
+    # one row per paid cart; balance is always paid - refunded
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cart_ledger (
+            cart_id INTEGER PRIMARY KEY,
+            paid REAL NOT NULL DEFAULT 0,
+            refunded REAL NOT NULL DEFAULT 0,
+            balance REAL NOT NULL DEFAULT 0,
+            updated_at DATETIME DEFAULT (datetime('now', 'localtime'))
+        )
+    ''')
+
+def record_payment(cursor, cart_id, amount):
+    """Add a payment to the cart's ledger; call in the transaction writing cart_payments."""
+    cursor.execute('''
+        INSERT INTO cart_ledger (cart_id, paid, balance) VALUES (?, ?, ?)
+        ON CONFLICT(cart_id) DO UPDATE SET
+            paid = paid + excluded.paid,
+            balance = balance + excluded.paid,
+            updated_at = datetime('now', 'localtime')
+    ''', (cart_id, amount, amount))
+
+def record_refund(cursor, cart_id, amount):
+    """
+    Add a refund to the cart's ledger; call in the transaction writing refunds.
+    Returns the updated {'paid': 20.0, 'refunded': 5.0, 'balance': 15.0}.
+    """
+    cursor.execute('''
+        INSERT INTO cart_ledger (cart_id, refunded, balance) VALUES (?, ?, ?)
+        ON CONFLICT(cart_id) DO UPDATE SET
+            refunded = refunded + excluded.refunded,
+            balance = balance - excluded.refunded,
+            updated_at = datetime('now', 'localtime')
+    ''', (cart_id, amount, -amount))
+    return get(cursor, cart_id)
+
+def get(cursor, cart_id):
+    cursor.execute("SELECT paid, refunded, balance FROM cart_ledger WHERE cart_id = ?", (cart_id,))
+    row = cursor.fetchone()
+    paid, refunded, balance = row if row else (0, 0, 0)
+    return {'paid': round(paid, 2), 'refunded': round(refunded, 2), 'balance': round(balance, 2)}
+
+def status_for(entry):
+    """Cart status a refund leaves behind, or None if it should stay as it is."""
+    if entry['refunded'] > 0 and entry['refunded'] >= entry['paid']:
+        return 'refunded'
+    if entry['refunded'] > 0:
+        return 'partial_refund'
+    return None
+
+def remove(cursor, cart_id):
+    cursor.execute("DELETE FROM cart_ledger WHERE cart_id = ?", (cart_id,))
+
+def backfill():
+    """
+    Build ledger rows for carts paid before the ledger existed, archived
+    ones included. Runs once; the ledger is kept current from then on.
+    """
+    conn = None
+    try:
+        conn, cursor = archive.history_connection()
+        cursor.execute("SELECT value FROM settings WHERE key = 'cart_ledger_backfilled'")
+        if cursor.fetchone():
+            return 0
+        cursor.execute('''
+            INSERT OR IGNORE INTO cart_ledger (cart_id, paid, refunded, balance)
+            SELECT p.cart_id, p.paid, COALESCE(r.refunded, 0), p.paid - COALESCE(r.refunded, 0)
+            FROM (SELECT cart_id, SUM(discounted_total) AS paid FROM all_cart_payments GROUP BY cart_id) p
+            LEFT JOIN (SELECT cart_id, SUM(amount) AS refunded FROM all_refunds GROUP BY cart_id) r
+                ON r.cart_id = p.cart_id
+        ''')
+        added = cursor.rowcount
+        cursor.execute("INSERT INTO settings (key, value) VALUES ('cart_ledger_backfilled', '1') "
+                       "ON CONFLICT(key) DO UPDATE SET value = excluded.value")
+        conn.commit()
+        if added:
+            logger.info(f"Cart ledger backfilled for {added} carts")
+        return added
+    except sqlite3.Error as e:
+        log_error(f"Error backfilling cart ledger: {e}")
+        return 0
+    finally:
+        if conn:
+            conn.close()
@@ -0,0 +1,84 @@
+import hashlib
+from logging_utils import logger
+
+def line_key(cart_id, product_id, options, product_note):
+    """
+    Identity of a cart line: adding the same product with the same options
+    and note to a cart lands on one line. The cart is part of the hash so a
+    line moved to another cart can't collide there before its key is cleared.
+    """
+    raw = '\x1f'.join((str(int(cart_id)), str(int(product_id)), options or '', product_note or ''))
+    return hashlib.sha1(raw.encode()).hexdigest()[:16]
+
+def create_line_keys(cursor):
+    """
+    cart_item.line_key with a unique index per cart. Moving a line to
+    another cart or editing its product, options or note clears the key, so
+    those lines are left alone by later adds rather than merged wrongly.
+    """
+    cursor.execute("PRAGMA table_info(cart_item)")
+    columns = [col[1] for col in cursor.fetchall()]
+    if 'line_key' not in columns:
+        cursor.execute('ALTER TABLE cart_item ADD COLUMN line_key TEXT')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_cart_item_line_key
+        ON cart_item(cart_id, line_key) WHERE line_key IS NOT NULL
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS cart_item_line_key_stale
+        AFTER UPDATE OF cart_id, product_id, options, product_note ON cart_item
+        WHEN NEW.line_key IS NOT NULL AND (
+            OLD.cart_id IS NOT NEW.cart_id OR OLD.product_id IS NOT NEW.product_id
+            OR OLD.options IS NOT NEW.options OR OLD.product_note IS NOT NEW.product_note)
+        BEGIN
+            UPDATE cart_item SET line_key = NULL WHERE cart_item_id = NEW.cart_item_id;
+        END
+    ''')
+    backfill(cursor)
+
+def backfill(cursor):
+    """
+    Key the lines of carts still open when keys were introduced. Where a
+    cart already has duplicate lines the oldest keeps the key. Runs once.
+    """
+    cursor.execute("SELECT value FROM settings WHERE key = 'cart_line_keys_backfilled'")
+    if cursor.fetchone():
+        return
+    cursor.execute('''
+        SELECT ci.cart_item_id, ci.cart_id, ci.product_id, ci.options, ci.product_note
+        FROM cart_item ci
+        JOIN cart c ON c.cart_id = ci.cart_id
+        WHERE c.cart_status = 'processing' AND ci.line_key IS NULL AND ci.product_id IS NOT NULL
+        ORDER BY ci.cart_item_id
+    ''')
+    rows = cursor.fetchall()
+    cursor.executemany(
+        "UPDATE OR IGNORE cart_item SET line_key = ? WHERE cart_item_id = ?",
+        [(line_key(cart_id, product_id, options, note), cart_item_id)
+         for cart_item_id, cart_id, product_id, options, note in rows]
+    )
+    cursor.execute("INSERT INTO settings (key, value) VALUES ('cart_line_keys_backfilled', '1') "
+                   "ON CONFLICT(key) DO UPDATE SET value = excluded.value")
+    if rows:
+        logger.info(f"Cart line keys backfilled for {len(rows)} open cart items")
+
+def add_lines(cursor, cart_id, lines):
+    """
+    Add lines to a cart, bumping the quantity of any line already there
+    with the same key. Runs inside the caller's transaction; stock checks
+    are the caller's.
+
+    cart_lines.add_lines(cursor, 12, [{'product_id': 4, 'product_name': 'Cola', 'price': 1.2,
+                                       'quantity': 2, 'options': '', 'product_note': '',
+                                       'category_order': 3, 'vatable': 1}])
+    """
+    cursor.executemany('''
+        INSERT INTO cart_item
+            (cart_id, product_id, product_name, price, quantity, options, product_note, category_order, vatable, line_key)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(cart_id, line_key) WHERE line_key IS NOT NULL
+        DO UPDATE SET quantity = quantity + excluded.quantity
+    ''', [(cart_id, line['product_id'], line['product_name'], line['price'], line['quantity'],
+           line['options'], line['product_note'], line['category_order'], line.get('vatable', 0),
+           line_key(cart_id, line['product_id'], line['options'], line['product_note']))
+          for line in lines])
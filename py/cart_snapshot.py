@@ -0,0 +1,151 @@
+import json, hashlib
+from . import database, floor_state, checkout, row_types, archive
+
+def _header(cursor, cart_id):
+    cursor.execute('''
+        SELECT
+            c.cart_id, c.order_type, c.order_menu AS cart_menu, c.order_date,
+            c.customer_id, cu.customer_name, cu.customer_telephone,
+            CASE WHEN c.order_type = 'delivery' THEN ca.address_id END AS address_id,
+            CASE WHEN c.order_type = 'delivery' THEN ca.address END AS address,
+            CASE WHEN c.order_type = 'delivery' THEN ca.postcode END AS postcode,
+            c.cart_charge_updated AS charge_updated, e.name AS employee_name,
+            c.overall_note, c.cart_discount_type, c.cart_discount, c.cart_service_charge
+        FROM cart c
+        LEFT JOIN customers cu ON c.customer_id = cu.customer_id
+        LEFT JOIN customer_addresses ca ON ca.address_id = c.address_id
+        LEFT JOIN employees e ON c.cart_started_by = e.employee_id
+        WHERE c.cart_id = ?
+    ''', (cart_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return dict(zip([desc[0] for desc in cursor.description], row))
+
+def _tables(cursor, cart_id):
+    # open carts are served from the floor map, closed ones from history
+    tables = floor_state.cart_tables(cart_id)
+    if tables is not None:
+        return tables
+    cursor.execute('''
+        SELECT cdt.table_id, cdt.table_number, cdt.table_cover AS cover,
+               COALESCE(dr.room_label, '') AS room_label
+        FROM cart_dining_tables cdt
+        LEFT JOIN dining_tables dt ON cdt.table_id = dt.table_id
+        LEFT JOIN dining_rooms dr ON dt.room_id = dr.room_id
+        WHERE cdt.cart_id = ?
+        ORDER BY dr.room_order, CAST(cdt.table_number AS INTEGER)
+    ''', (cart_id,))
+    return row_types.dicts(cursor)
+
+def items(cursor, cart_id):
+    """The cart's lines as get_all_cart_items lists them."""
+    cursor.execute('''
+        SELECT
+            ci.cart_item_id, ci.cart_id, ci.product_id, ci.product_name, ci.price, ci.quantity,
+            ci.options, ci.product_note, ci.product_discount_type, ci.product_discount,
+            ci.category_order, ci.vatable AS vat,
+            COALESCE(ci.kitchen_printed_qty, 0) AS kitchen_printed_qty,
+            COALESCE(ci.bar_printed_qty, 0) AS bar_printed_qty,
+            COALESCE(p.cpn, 0) AS cpn, p.category_id
+        FROM cart_item ci
+        LEFT JOIN products p ON ci.product_id = p.product_id
+        WHERE ci.cart_id = ?
+        ORDER BY ci.category_order, ci.product_name
+    ''', (cart_id,))
+    return row_types.dicts(cursor)
+
+def _finish_header(header, tables, item_count):
+    """Add the table and count fields to a _header() row; returns the cart-level fields split off it."""
+    cart_fields = {key: header.pop(key) for key in ('overall_note', 'cart_discount_type', 'cart_discount', 'cart_service_charge')}
+    table_display = database.format_table_display(tables)
+    total_covers = sum(t.get('cover') or 0 for t in tables)
+    header.update({
+        'cart_item_count': item_count,
+        'table_display': table_display,
+        'total_covers': total_covers,
+        # Legacy fields for backwards compatibility
+        'table_number': table_display or (tables[0]['table_number'] if tables else None),
+        'table_cover': total_covers or (tables[0]['cover'] if tables else None)
+    })
+    return cart_fields
+
+def version_of(snapshot):
+    """Content hash of a snapshot; equal versions mean nothing the till shows has changed."""
+    content = json.dumps({k: v for k, v in snapshot.items() if k != 'version'}, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode()).hexdigest()[:16]
+
+def build(cursor, cart_id):
+    """
+    Everything the till shows for a cart, read with the caller's cursor, or
+    None if there is no such cart. header keeps the get_current_cart_data
+    fields and cart_data the get_all_cart_items ones, so either caller can
+    switch over.
+    {'version': '5f0c9e1d2a7b4c33',
+     'header': {'cart_id': 12, 'order_type': 'dine', 'cart_item_count': 3, 'table_display': 'Main 1-2', ...},
+     'tables': [{'table_id': 1, 'table_number': '1', 'cover': 2, 'room_label': 'Main'}, ...],
+     'items': [{'cart_item_id': 81, 'product_name': 'Cola', 'price': 1.2, 'quantity': 2, ...}, ...],
+     'cart_data': {'overall_note': '', 'cart_discount_type': 'fixed', 'cart_discount': 0,
+                   'cart_service_charge': 0, 'order_type': 'dine'},
+     'discounts': {'cart_discount_type': 'fixed', 'cart_discount': 0, 'item_discount_total': 1.0, 'cart_discount_total': 0},
+     'charges': {'cart_service_charge': 0},
+     'totals': {'item_count': 3, 'gross': 26.0, 'subtotal': 25.0, 'total': 25.0}}
+    """
+    header = _header(cursor, cart_id)
+    if header is None:
+        return None
+    tables = _tables(cursor, cart_id)
+    lines = items(cursor, cart_id)
+    totals = checkout.cart_totals(cursor, cart_id) or {'item_count': 0, 'gross': 0, 'subtotal': 0, 'total': 0}
+
+    cart_fields = _finish_header(header, tables, len(lines))
+
+    snapshot = {
+        'header': header,
+        'tables': tables,
+        'items': lines,
+        'cart_data': dict(cart_fields, order_type=header['order_type']),
+        'discounts': {
+            'cart_discount_type': cart_fields['cart_discount_type'],
+            'cart_discount': cart_fields['cart_discount'],
+            'item_discount_total': round(totals['gross'] - totals['subtotal'], 2),
+            'cart_discount_total': round(totals['subtotal'] - totals['total'], 2)
+        },
+        'charges': {'cart_service_charge': cart_fields['cart_service_charge']},
+        'totals': {
+            'item_count': totals['item_count'],
+            'gross': round(totals['gross'], 2),
+            'subtotal': round(totals['subtotal'], 2),
+            'total': round(totals['total'], 2)
+        }
+    }
+    snapshot['version'] = version_of(snapshot)
+    return snapshot
+
+def current_cart(cart_id):
+    """
+    The snapshot header alone (get_current_cart_data's fields), without
+    reading lines or totals; None if there is no such cart.
+    """
+    conn = None
+    try:
+        conn, cursor = archive.cart_connection(cart_id)
+        header = _header(cursor, cart_id)
+        if header is None:
+            return None
+        cursor.execute("SELECT COUNT(*) FROM cart_item WHERE cart_id = ?", (cart_id,))
+        _finish_header(header, _tables(cursor, cart_id), cursor.fetchone()[0])
+        return header
+    finally:
+        if conn:
+            conn.close()
+
+def get(cart_id):
+    """build() on its own connection."""
+    conn = None
+    try:
+        conn, cursor = archive.cart_connection(cart_id)
+        return build(cursor, cart_id)
+    finally:
+        if conn:
+            conn.close()
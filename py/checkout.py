@@ -0,0 +1,215 @@
+import time, helpers
+from collections import deque
+from datetime import datetime
+from flask import session
+from . import database, json_utils, inventory, floor_state, sync_outbox, shift_totals, cart_ledger, customer_profiles
+from logging_utils import logger
+
+# Recent checkout timings (ms per stage) for timing_summary()
+_timings = deque(maxlen=500)
+
+def cart_totals(cursor, cart_id, include_mods=True):
+    """
+    A cart's totals as the till charges them: lines with their options and
+    modifiers (gross), less item discounts (subtotal), then the cart discount
+    (total).
+    vatable is the share of total that carries VAT. Unrounded; None for an
+    empty cart.
+    {'order_type': 'collection', 'item_count': 3, 'gross': 26.0, 'subtotal': 24.5, 'total': 22.05, 'vatable': 12.6}
+    """
+    cursor.execute("""
+        SELECT
+            ci.price, ci.quantity, ci.product_discount_type,
+            ci.product_discount, ci.vatable, ci.options, ci.product_note,
+            c.order_type, c.cart_discount_type, c.cart_discount
+        FROM cart_item ci
+        JOIN cart c ON ci.cart_id = c.cart_id
+        WHERE ci.cart_id = ?""", (cart_id,))
+    items = cursor.fetchall()
+    if not items:
+        return None
+
+    order_type, cart_disc_type, cart_disc = items[0][7], items[0][8], items[0][9]
+    gross = 0
+    cart_total = 0
+    vatable_total = 0
+    item_count = 0
+
+    for base_price, base_qty, disc_type, disc_amount, base_vatable, options_str, mods_str, _, _, _ in items:
+        base_total = base_price * base_qty
+        base_vat_amount = base_total if (order_type == 'dine' or base_vatable) else 0
+        item_count += base_qty or 0
+
+        options_total = 0
+        options_vat_amount = 0
+        for opt in helpers.parse_options(options_str):
+            opt_total = opt['price'] * opt['quantity']
+            options_total += opt_total
+            if order_type == 'dine' or opt['vatable']:
+                options_vat_amount += opt_total
+
+        # Modifiers follow base item VAT status
+        mods_total = helpers.calculate_mods_total(mods_str) * base_qty if include_mods else 0
+        mods_vat_amount = mods_total if (order_type == 'dine' or base_vatable) else 0
+
+        combined_total = base_total + options_total + mods_total
+        combined_vatable = base_vat_amount + options_vat_amount + mods_vat_amount
+        gross += combined_total
+
+        # Item-level discount applied proportionally
+        if disc_amount > 0:
+            combined_total = helpers.calculate_cart_discounts(disc_amount, disc_type, combined_total)
+            if combined_total > 0:
+                combined_vatable *= combined_total / (combined_total + disc_amount)
+
+        cart_total += combined_total
+        vatable_total += combined_vatable
+
+    subtotal = cart_total
+    if cart_disc > 0:
+        cart_total = helpers.calculate_cart_discounts(cart_disc, cart_disc_type, cart_total)
+        if cart_total > 0:
+            vatable_total *= cart_total / (cart_total + cart_disc)
+
+    return {'order_type': order_type, 'item_count': item_count, 'gross': gross, 'subtotal': subtotal,
+            'total': cart_total, 'vatable': vatable_total}
+
+class CheckoutPipeline:
+    """
+    Completes a sale with every write in one BEGIN IMMEDIATE transaction.
+    Settings are read once before the transaction starts and each stage is
+    timed; see timing_summary() for recent percentiles.
+
+    result = CheckoutPipeline(cart_id, 'Card', 24.50).run()
+    """
+
+    STAGES = ('status', 'tables', 'vat', 'payments', 'kitchen', 'inventory', 'shift', 'profile', 'outbox')
+
+    def __init__(self, cart_id, payment_method, discounted_total, split_charges=None, include_mods=True):
+        self.cart_id = cart_id
+        self.payment_method = payment_method
+        self.discounted_total = discounted_total
+        self.split_charges = split_charges
+        self.include_mods = include_mods
+        self.employee_id = session.get('employee_id', 0)
+        self.timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.timings = {}
+        self.tables_released = False
+
+    def load_config(self, cursor):
+        self.vat_rate = json_utils.get_vat_rate()
+        cursor.execute("SELECT value FROM settings WHERE key = 'kitchen_screen'")
+        row = cursor.fetchone()
+        self.kitchen_screen = bool(row) and str(row[0]) == "1"
+
+    def run(self):
+        started = time.perf_counter()
+        conn = None
+        try:
+            conn, cursor = database.get_database_connection()
+            # transactions are managed explicitly below
+            conn.isolation_level = None
+
+            mark = time.perf_counter()
+            self.load_config(cursor)
+            self.timings['config'] = (time.perf_counter() - mark) * 1000
+
+            mark = time.perf_counter()
+            cursor.execute("BEGIN IMMEDIATE")
+            self.timings['lock'] = (time.perf_counter() - mark) * 1000
+
+            for stage in self.STAGES:
+                mark = time.perf_counter()
+                getattr(self, f"stage_{stage}")(cursor)
+                self.timings[stage] = (time.perf_counter() - mark) * 1000
+
+            mark = time.perf_counter()
+            cursor.execute("COMMIT")
+            self.timings['commit'] = (time.perf_counter() - mark) * 1000
+
+            if self.tables_released:
+                floor_state.mark_changed('checkout')
+            return {'status': 'success'}
+
+        except Exception as e:
+            if conn and conn.in_transaction:
+                conn.rollback()
+            return {'status': 'error', 'message': str(e)}
+        finally:
+            if conn:
+                conn.close()
+            self.timings['total'] = (time.perf_counter() - started) * 1000
+            _timings.append(self.timings)
+            logger.info(f"Checkout {self.cart_id}: " + ", ".join(f"{k} {v:.1f}ms" for k, v in self.timings.items()))
+
+    def stage_status(self, cursor):
+        cursor.execute("""
+            UPDATE cart
+            SET cart_status = 'completed',
+                cart_charge_updated = ?,
+                cart_updated_by = ?,
+                sync_status = 'pending'
+            WHERE cart_id = ?""",
+            (self.timestamp, self.employee_id, self.cart_id))
+        if cursor.rowcount == 0:
+            raise ValueError(f"Cart {self.cart_id} not found")
+
+    def stage_tables(self, cursor):
+        cursor.execute("UPDATE dining_tables SET table_occupied = 0 WHERE table_occupied = ?", (self.cart_id,))
+        self.tables_released = cursor.rowcount > 0
+
+    def stage_vat(self, cursor):
+        if self.vat_rate <= 0:
+            return
+        totals = cart_totals(cursor, self.cart_id, self.include_mods)
+        if not totals:
+            return
+        vat_base = totals['total'] if totals['order_type'] == 'dine' else totals['vatable']
+        cursor.execute("UPDATE cart SET vat_amount = ? WHERE cart_id = ?", (round(vat_base * self.vat_rate, 2), self.cart_id))
+
+    def stage_payments(self, cursor):
+        if self.payment_method == 'Split' and self.split_charges:
+            payments = [(self.cart_id, charge.get('paymentMethod', self.payment_method), charge.get('amount', 0))
+                        for charge in self.split_charges]
+        else:
+            payments = [(self.cart_id, self.payment_method, self.discounted_total)]
+        cursor.executemany(
+            "INSERT INTO cart_payments (cart_id, payment_method, discounted_total) VALUES (?, ?, ?)",
+            payments
+        )
+        cart_ledger.record_payment(cursor, self.cart_id, sum(float(amount or 0) for _, _, amount in payments))
+
+    def stage_kitchen(self, cursor):
+        if not self.kitchen_screen:
+            return
+        cursor.execute("""
+            INSERT INTO kitchen_orders (order_id, item_id)
+            SELECT cart_id, cart_item_id
+            FROM cart_item
+            WHERE cart_id = ?""",
+            (self.cart_id,))
+
+    def stage_inventory(self, cursor):
+        inventory.deduct_cart(cursor, self.cart_id, self.employee_id)
+
+    def stage_shift(self, cursor):
+        shift_totals.record_sale(cursor, self.cart_id, self.timestamp)
+
+    def stage_profile(self, cursor):
+        customer_profiles.record_order(cursor, self.cart_id)
+
+    def stage_outbox(self, cursor):
+        sync_outbox.record(cursor, self.cart_id, 'completed')
+
+def timing_summary():
+    """p50/p99 in ms per stage over recent checkouts, e.g. {'total': {'p50': 3.1, 'p99': 8.4}, ...}"""
+    samples = list(_timings)
+    summary = {}
+    for stage in {key for sample in samples for key in sample}:
+        values = sorted(sample[stage] for sample in samples if stage in sample)
+        summary[stage] = {
+            'p50': round(values[len(values) // 2], 2),
+            'p99': round(values[min(len(values) - 1, int(len(values) * 0.99))], 2),
+            'count': len(values)
+        }
+    return summary
@@ -0,0 +1,186 @@
+import json, sqlite3
+from . import archive
+from logging_utils import log_error
+
+RECENT_ORDERS = 10
+FAVOURITES = 5
+# products counted per customer for favourites; the rarest drop off past this
+MAX_ITEM_COUNTS = 200
+GUEST_TELEPHONE = '00000'
+
+def create_profile_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS customer_profiles (
+            customer_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            updated_at DATETIME DEFAULT (datetime('now', 'localtime'))
+        )
+    ''')
+
+def _items(cursor, cart_ids, prefix=''):
+    """{cart_id: [item, ...]} for a few carts, in till order."""
+    cursor.execute(f'''
+        SELECT cart_id, product_id, product_name, price, quantity, options, product_note, category_order
+        FROM {prefix}cart_item
+        WHERE cart_id IN (SELECT value FROM json_each(?))
+        ORDER BY category_order, cart_item_id
+    ''', (json.dumps(cart_ids),))
+    items = {}
+    for cart_id, product_id, name, price, quantity, options, note, category_order in cursor.fetchall():
+        items.setdefault(cart_id, []).append({
+            'product_id': product_id, 'product_name': name, 'price': price, 'quantity': quantity,
+            'options': options, 'product_note': note, 'category_order': category_order
+        })
+    return items
+
+def _favourites(item_counts):
+    top = sorted(item_counts.items(), key=lambda entry: entry[1][1], reverse=True)[:FAVOURITES]
+    return [{'product_id': int(product_id), 'product_name': name, 'quantity': quantity}
+            for product_id, (name, quantity) in top]
+
+def _trim_counts(item_counts):
+    if len(item_counts) <= MAX_ITEM_COUNTS:
+        return item_counts
+    keep = sorted(item_counts.items(), key=lambda entry: entry[1][1], reverse=True)[:MAX_ITEM_COUNTS]
+    return dict(keep)
+
+def _build(cursor, customer_id, prefix=''):
+    """Summary from the customer's order history; prefix 'all_' takes in archived carts."""
+    cursor.execute(f'''
+        SELECT c.cart_id, c.order_type, c.order_date, COALESCE(l.balance, 0)
+        FROM {prefix}cart c
+        LEFT JOIN cart_ledger l ON l.cart_id = c.cart_id
+        WHERE c.customer_id = ? AND c.cart_status = 'completed'
+        ORDER BY c.cart_id DESC
+    ''', (customer_id,))
+    carts = cursor.fetchall()
+    cursor.execute(f'''
+        SELECT COALESCE(SUM(l.balance), 0) FROM {prefix}cart c
+        JOIN cart_ledger l ON l.cart_id = c.cart_id
+        WHERE c.customer_id = ? AND c.cart_status IN ('completed', 'refunded', 'partial_refund')
+    ''', (customer_id,))
+    spend = cursor.fetchone()[0]
+    cursor.execute(f'''
+        SELECT ci.product_id, MAX(ci.product_name), SUM(ci.quantity)
+        FROM {prefix}cart c
+        JOIN {prefix}cart_item ci ON ci.cart_id = c.cart_id
+        WHERE c.customer_id = ? AND c.cart_status = 'completed'
+        GROUP BY ci.product_id
+    ''', (customer_id,))
+    item_counts = _trim_counts({str(product_id): [name, quantity or 0] for product_id, name, quantity in cursor.fetchall()})
+
+    recent = carts[:RECENT_ORDERS]
+    items = _items(cursor, [row[0] for row in recent], prefix)
+    return {
+        'order_count': len(carts),
+        'lifetime_spend': round(spend, 2),
+        'last_order_date': carts[0][2] if carts else None,
+        'recent_orders': [{'order_id': cart_id, 'order_type': order_type, 'order_date': order_date,
+                           'total': round(total, 2), 'items': items.get(cart_id, [])}
+                          for cart_id, order_type, order_date, total in recent],
+        'favourites': _favourites(item_counts),
+        'item_counts': item_counts
+    }
+
+def _store(cursor, customer_id, summary):
+    cursor.execute('''
+        INSERT INTO customer_profiles (customer_id, summary) VALUES (?, ?)
+        ON CONFLICT(customer_id) DO UPDATE SET summary = excluded.summary, updated_at = datetime('now', 'localtime')
+    ''', (customer_id, json.dumps(summary)))
+
+def record_order(cursor, cart_id):
+    """Fold a completed cart into its customer's profile; call in the checkout transaction after payments."""
+    cursor.execute('''
+        SELECT c.customer_id, c.order_type, c.order_date, cu.customer_telephone, COALESCE(l.balance, 0)
+        FROM cart c
+        JOIN customers cu ON cu.customer_id = c.customer_id
+        LEFT JOIN cart_ledger l ON l.cart_id = c.cart_id
+        WHERE c.cart_id = ?
+    ''', (cart_id,))
+    row = cursor.fetchone()
+    if not row or row[3] == GUEST_TELEPHONE:
+        return
+    customer_id, order_type, order_date, _, total = row
+
+    cursor.execute("SELECT summary FROM customer_profiles WHERE customer_id = ?", (customer_id,))
+    stored = cursor.fetchone()
+    if not stored:
+        # no profile yet: get() builds it with archived orders on the next read,
+        # which keeps the full history scan out of the checkout transaction
+        return
+    summary = json.loads(stored[0])
+    if any(order['order_id'] == cart_id for order in summary['recent_orders']):
+        return
+
+    items = _items(cursor, [cart_id]).get(cart_id, [])
+    summary['recent_orders'] = ([{'order_id': cart_id, 'order_type': order_type, 'order_date': order_date,
+                                  'total': round(total, 2), 'items': items}] + summary['recent_orders'])[:RECENT_ORDERS]
+    summary['order_count'] += 1
+    summary['lifetime_spend'] = round(summary['lifetime_spend'] + total, 2)
+    summary['last_order_date'] = order_date
+    counts = summary['item_counts']
+    for item in items:
+        entry = counts.setdefault(str(item['product_id']), [item['product_name'], 0])
+        entry[0] = item['product_name']
+        entry[1] += item['quantity'] or 0
+    summary['item_counts'] = _trim_counts(counts)
+    summary['favourites'] = _favourites(summary['item_counts'])
+    _store(cursor, customer_id, summary)
+
+def invalidate(cursor, customer_ids):
+    """Drop profiles that no longer match the orders (refunds, deletions); they rebuild on next read."""
+    cursor.execute("DELETE FROM customer_profiles WHERE customer_id IN (SELECT value FROM json_each(?))",
+                   (json.dumps(list(customer_ids)),))
+
+def invalidate_cart(cursor, cart_id):
+    cursor.execute("DELETE FROM customer_profiles WHERE customer_id = (SELECT customer_id FROM cart WHERE cart_id = ?)", (cart_id,))
+
+def get(customer_id):
+    """
+    Profile with the customer's details and latest address in one read.
+    {'customer_info': {'customer_name': 'Sam', 'customer_telephone': '0770...', 'address_id': 3,
+                       'address': '1 High St', 'postcode': 'AB1 2CD'},
+     'order_count': 12, 'lifetime_spend': 210.5, 'last_order_date': '2025-12-20 18:02:11',
+     'recent_orders': [{'order_id': 981, 'order_type': 'delivery', 'order_date': ..., 'total': 18.5,
+                        'items': [{'product_id': 4, 'product_name': 'Margherita', 'price': 9.5, 'quantity': 1,
+                                   'options': '', 'product_note': '', 'category_order': 1}, ...]}, ...],
+     'favourites': [{'product_id': 4, 'product_name': 'Margherita', 'quantity': 9}, ...]}
+    or None if there is no such customer.
+    """
+    conn = None
+    try:
+        conn, cursor = archive.history_connection()
+        query = '''
+            SELECT
+                COALESCE(c.customer_name, '') AS customer_name,
+                COALESCE(c.customer_telephone, '') AS customer_telephone,
+                COALESCE(a.address_id, '') AS address_id,
+                COALESCE(a.address, '') AS address,
+                COALESCE(a.postcode, '') AS postcode,
+                p.summary
+            FROM customers c
+            LEFT JOIN customer_addresses a ON a.address_id = (
+                SELECT MAX(address_id) FROM customer_addresses WHERE customer_id = c.customer_id)
+            LEFT JOIN customer_profiles p ON p.customer_id = c.customer_id
+            WHERE c.customer_id = ?
+        '''
+        cursor.execute(query, (customer_id,))
+        row = cursor.fetchone()
+        columns = [desc[0] for desc in cursor.description]
+        if not row:
+            return None
+        if row[5] is None:
+            summary = _build(cursor, customer_id, 'all_')
+            _store(cursor, customer_id, summary)
+            conn.commit()
+        else:
+            summary = json.loads(row[5])
+        summary.pop('item_counts', None)
+        summary['customer_info'] = dict(zip(columns[:5], row[:5]))
+        return summary
+    except sqlite3.Error as e:
+        log_error(f"Error reading customer profile: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
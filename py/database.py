@@ -1,7 +1,7 @@
-import sqlite3, json, os, io, helpers, data_directory, time, random
+import sqlite3, json, os, io, base64, helpers, data_directory, time, random, storefront_queue, orders_client
 from flask import jsonify, session
-from datetime import datetime, timedelta, timezone
-from . import json_utils, async_settings
+from datetime import datetime, timedelta
+from . import json_utils, async_settings, caller_lookup, inventory, checkout, floor_state, sync_outbox, menu_push, archive, analytics, shift_totals, cart_ledger, ordering, option_index, retention, customer_profiles, barcode_map, cart_lines, cart_batch, cart_snapshot, serialize, row_types
 from collections import defaultdict
 from logging_utils import logger, log_error
 
@@ -411,9 +411,48 @@ def create_pos_database():
         if 'print_group' not in columns:
             cursor.execute('ALTER TABLE category ADD COLUMN print_group INTEGER DEFAULT 1')
 
+        # Normalised phone key for caller id lookups
+        caller_lookup.create_phone_key_index(cursor)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_customer_addresses_customer ON customer_addresses(customer_id)")
+
+        # Stock ledger and reservations
+        inventory.create_inventory_tables(cursor)
+
+        # Change log for the remote sync worker
+        sync_outbox.create_outbox_table(cursor)
+        sync_outbox.trim_unsent(cursor)
+        menu_push.create_menu_push_tables(cursor)
+        # storefront order updates waiting to be delivered
+        storefront_queue.create_queue_table(cursor)
+        # v2 order polling validators, watermark and today's orders
+        orders_client.create_sync_state_table(cursor)
+        # cache key for sales analytics
+        analytics.create_version_table(cursor)
+        # running day totals and Z report snapshots
+        shift_totals.create_shift_tables(cursor)
+        # running paid/refunded per cart
+        cart_ledger.create_ledger_table(cursor)
+        # prefix-searchable option templates for the option editor
+        option_index.create_option_index(cursor)
+        # customer deletion / anonymisation jobs
+        retention.create_retention_tables(cursor)
+        # per-customer order summaries for screen pops and reorders
+        customer_profiles.create_profile_table(cursor)
+        # barcode uniqueness and the in-memory scan map
+        barcode_map.create_barcode_index(cursor)
+        barcode_map.warm(cursor)
+        # one line per product, options and note in a cart
+        cart_lines.create_line_keys(cursor)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_cart_sync_pending ON cart(sync_status) WHERE sync_status = 'pending'")
+
+        # keyset pagination for order history
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_cart_charge_updated ON cart(cart_charge_updated, cart_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_cart_payments_cart ON cart_payments(cart_id)")
+
         # Commit the changes and close the connection
         conn.commit()
         conn.close()
+        cart_ledger.backfill()
 
         message = "Database 'pos_database.db' and tables created successfully."
         return jsonify({"success": True, "message": message}), 200
@@ -543,12 +582,10 @@ def add_or_update_category(category, colour, text_colour, category_order=None, c
 def update_category_order(category_orders):
     try:
         conn, cursor = get_database_connection()
-        for category_data in category_orders:
-            category_id = category_data['id']
-            category_order = category_data['category_order']
-            cursor = conn.cursor()
-            cursor.execute('UPDATE category SET category_order = ? WHERE category_id = ?', (category_order, category_id))
-            conn.commit()
+        # only the relative order matters; categories that didn't move keep their keys
+        ids = [int(c['id']) for c in sorted(category_orders, key=lambda c: float(c['category_order']))]
+        ordering.save(cursor, 'category', 'category_id', 'category_order', ids)
+        conn.commit()
         conn.close()
         return jsonify({'success': True}), 200
 
@@ -837,9 +874,11 @@ def new_cart(cartData):
             customer_id = int(posted_customer)
             if customer_id > 1 and customer_name != "" and customer_phone != "":
                 cursor.execute("UPDATE customers SET customer_name = ?, customer_telephone = ? WHERE customer_id = ?", (customer_name, customer_phone, customer_id))
+                caller_lookup.set_phone_key(cursor, customer_id, customer_phone)
         else:
             cursor.execute("INSERT INTO customers (customer_name, customer_telephone) VALUES (?, ?)", (customer_name, customer_phone))
             customer_id = cursor.lastrowid
+            caller_lookup.set_phone_key(cursor, customer_id, customer_phone)
 
         if 'customerAddress' in customer and customer['customerAddress'] != '' and 'customerPostcode' in customer and customer['customerPostcode'] != '' and customer['addressId'] == "":
             address = customer['customerAddress']
@@ -971,7 +1010,12 @@ def new_cart(cartData):
         cursor.execute('DELETE FROM cart WHERE cart_id = ?', (posted_cart_id,))
         cursor.execute('DELETE FROM cart_dining_tables WHERE cart_id = ?', (posted_cart_id,))
         
+        sync_outbox.record(cursor, cart_id, 'opened')
+        if posted_cart_id:
+            sync_outbox.record(cursor, posted_cart_id, 'deleted')
         conn.commit()
+        caller_lookup.clear_cache()
+        floor_state.mark_changed('open')
         log_deleted_cart(posted_cart_id)
         return jsonify({'cart_id': cart_id})
     except sqlite3.Error as e:
@@ -984,84 +1028,12 @@ def new_cart(cartData):
 
 def get_current_cart_data(cart_id):
     try:
-        conn, cursor = get_database_connection()
-        cursor.execute('''
-            SELECT
-                c.cart_id,
-                c.order_type,
-                c.order_menu,
-                c.order_date,
-                COUNT(ci.cart_id) AS cart_item_count,
-                c.customer_id,
-                cu.customer_name,
-                cu.customer_telephone,
-                CASE
-                    WHEN c.order_type = 'delivery'
-                    THEN ca.address_id
-                    ELSE NULL
-                END AS address_id,
-                CASE
-                    WHEN c.order_type = 'delivery'
-                    THEN ca.address
-                    ELSE NULL
-                END AS address,
-                CASE
-                    WHEN c.order_type = 'delivery'
-                    THEN ca.postcode
-                    ELSE NULL
-                END AS postcode,
-                c.cart_charge_updated,
-                e.name
-            FROM cart c
-            LEFT JOIN cart_item ci ON c.cart_id = ci.cart_id
-            LEFT JOIN customers cu ON c.customer_id = cu.customer_id
-            LEFT JOIN customer_addresses ca ON ca.address_id = c.address_id
-            LEFT JOIN employees e ON cart_started_by = e.employee_id
-            WHERE c.cart_id = ?
-            GROUP BY c.cart_id
-            ORDER BY c.order_date;
-            ''', (cart_id,))
-        
-        cart_data = cursor.fetchone()
-        if cart_data:
-            # Get tables for dine-in orders
-            tables = []
-            table_display = None
-            total_covers = 0
-            
-            if cart_data[1] == 'dine':  # order_type
-                tables = get_cart_tables(cart_id)
-                table_display = format_table_display(tables)
-                total_covers = sum(t.get('cover', 0) for t in tables)
-            
-            cart_dict = {
-                'cart_id': cart_data[0],
-                'order_type': cart_data[1],
-                'cart_menu': cart_data[2],
-                'order_date': cart_data[3],
-                'cart_item_count': cart_data[4],
-                'customer_id': cart_data[5],
-                'customer_name': cart_data[6],
-                'customer_telephone': cart_data[7],
-                'address_id': cart_data[8],
-                'address': cart_data[9],
-                'postcode': cart_data[10],
-                'charge_updated': cart_data[11],
-                'employee_name': cart_data[12],
-                # New multi-table fields
-                'table_display': table_display,
-                'total_covers': total_covers,
-                # Legacy fields for backwards compatibility
-                'table_number': table_display or (tables[0]['table_number'] if tables else None),
-                'table_cover': total_covers or (tables[0]['cover'] if tables else None)
-            }
-            conn.close()
-            return jsonify(cart_dict)
-        else:
-            conn.close()
-            return jsonify({'error': 'Cart not found'}), 404
+        cart = cart_snapshot.current_cart(cart_id)
+        if cart is None:
+            return serialize.response({'error': 'Cart not found'}, 404)
+        return serialize.response(cart)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return serialize.response({'error': str(e)}, 500)
 
 def all_carts():
     """Updated to show merged tables in display"""
@@ -1086,18 +1058,11 @@ def all_carts():
         
         results = cursor.fetchall()
         
-        # For dine-in orders, get table display
+        # For dine-in orders, add table display from the floor map
+        table_displays = floor_state.table_displays()
         enriched_results = []
         for row in results:
-            cart_id = row[0]
-            order_type = row[1]
-            
-            table_display = None
-            if order_type == 'dine':
-                tables = get_cart_tables(cart_id)
-                table_display = format_table_display(tables)
-            
-            # Convert to tuple with table_display added
+            table_display = table_displays.get(row[0]) if row[1] == 'dine' else None
             enriched_results.append(row + (table_display,))
         
         conn.close()
@@ -1160,46 +1125,25 @@ def add_item_to_cart(item):
         vatable = data['vatable']
         
         conn, cursor = get_database_connection()
-        
-        # Check inventory before adding
-        cursor.execute(
-            "SELECT track_inventory, stock_quantity FROM products WHERE product_id = ?",
-            (productId,)
-        )
-        product = cursor.fetchone()
-        
-        if product:
-            track_inventory = product[0]
-            stock_quantity = product[1]
-            
-            if track_inventory == 1 and stock_quantity <= 0:
-                conn.close()
-                return {"error": f"{productName} is out of stock"}, 400
-        
-        # Check if item already exists in cart
+
+        # Check (and optionally reserve) stock for the cart's new total of this product
         cursor.execute(
-            "SELECT * FROM cart_item WHERE cart_id = ? AND product_id = ? AND options = ?",
-            (cartId, productId, options)
+            "SELECT COALESCE(SUM(quantity), 0) FROM cart_item WHERE cart_id = ? AND product_id = ?",
+            (cartId, productId)
         )
-        existing_record = cursor.fetchone()
-        
-        if existing_record:
-            new_quantity = existing_record[5] + 1
-            
-            # Check if enough stock for the new quantity
-            if product and track_inventory == 1 and stock_quantity < new_quantity:
-                conn.close()
-                return {"error": f"Only {stock_quantity} of {productName} available"}, 400
-            
-            cursor.execute(
-                "UPDATE cart_item SET quantity = ? WHERE cart_id = ? AND product_id = ? AND options = ?",
-                (new_quantity, cartId, productId, options)
-            )
-        else:
-            cursor.execute(
-                "INSERT INTO cart_item (cart_id, product_id, product_name, price, quantity, options, product_note, category_order, vatable) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                (cartId, productId, productName, formattedPrice, quantity, options, productNote, categoryOrder, vatable)
-            )
+        try:
+            inventory.reserve_for_cart(cursor, cartId, productId, cursor.fetchone()[0] + int(quantity))
+        except inventory.InsufficientStock as e:
+            conn.rollback()
+            conn.close()
+            return {"error": str(e)}, 400
+
+        # Same product, options and note already in the cart adds to that line
+        cart_lines.add_lines(cursor, cartId, [{
+            'product_id': productId, 'product_name': productName, 'price': formattedPrice,
+            'quantity': int(quantity), 'options': options, 'product_note': productNote,
+            'category_order': categoryOrder, 'vatable': vatable
+        }])
         
         # Update cart timestamp and sync status
         cursor.execute(
@@ -1211,7 +1155,7 @@ def add_item_to_cart(item):
             """,
             (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), cartId)
         )
-       
+        sync_outbox.record(cursor, cartId, 'items')
         conn.commit()
         conn.close()
         return {"message": "Item added to cart successfully."}, 200
@@ -1221,49 +1165,84 @@ def add_item_to_cart(item):
 def get_item_by_barcode(barcode):
     try:
         conn, cursor = get_database_connection()
-        cursor.execute(
-            """SELECT 
-                p.product_id, 
-                p.product_name, 
-                p.out_price, 
-                c.category_order,
-                p.vatable,
-                p.track_inventory,
-                p.stock_quantity
-               FROM products p
-               JOIN category c ON p.category_id = c.category_id
-               WHERE p.barcode = ? AND p.is_hidden = 0""",
-            (barcode,)
-        )
-        product = cursor.fetchone()
+        product = barcode_map.lookup(cursor, barcode)
         conn.close()
         
         if not product:
             return jsonify({'found': False, 'message': 'Product not found'}), 404
         
         # Check inventory
-        track_inventory = product[5]
-        stock_quantity = product[6]
-        
-        if track_inventory == 1 and stock_quantity <= 0:
+        if product['track_inventory'] == 1 and product['stock_quantity'] <= 0:
             return jsonify({
                 'found': False, 
-                'message': f'{product[1]} is out of stock'
+                'message': f"{product['product_name']} is out of stock"
             }), 404
         
         return jsonify({
             'found': True,
-            'productId': product[0],
-            'productName': product[1],
-            'formattedPrice': product[2],
+            'productId': product['product_id'],
+            'productName': product['product_name'],
+            'formattedPrice': product['out_price'],
             'options': 'null',
-            'categoryOrder': product[3],
-            'vatable': product[4]
+            'categoryOrder': product['category_order'],
+            'vatable': product['vatable']
         })
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def scan_item_to_cart(cart_id, barcode, quantity=1):
+    """
+    Look up a scanned barcode, check stock and add it to the cart (or bump
+    the existing line) in one transaction, as add_item_to_cart would for
+    the same product with no options.
+    """
+    conn = None
+    try:
+        conn, cursor = get_database_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        product = barcode_map.lookup(cursor, barcode)
+        if not product:
+            conn.rollback()
+            return {'found': False, 'message': 'Product not found'}, 404
+        product_id = product['product_id']
+
+        cursor.execute(
+            "SELECT COALESCE(SUM(quantity), 0) FROM cart_item WHERE cart_id = ? AND product_id = ?",
+            (cart_id, product_id)
+        )
+        try:
+            inventory.reserve_for_cart(cursor, cart_id, product_id, cursor.fetchone()[0] + quantity)
+        except inventory.InsufficientStock as e:
+            conn.rollback()
+            return {'found': False, 'message': str(e)}, 400
+
+        cart_lines.add_lines(cursor, cart_id, [{
+            'product_id': product_id, 'product_name': product['product_name'], 'price': product['out_price'],
+            'quantity': quantity, 'options': '', 'product_note': '',
+            'category_order': product['category_order'], 'vatable': product['vatable']
+        }])
+
+        cursor.execute(
+            """
+            UPDATE cart
+            SET cart_charge_updated = ?,
+                sync_status = CASE WHEN sync_status != 'pending' THEN 'pending' ELSE sync_status END
+            WHERE cart_id = ?
+            """,
+            (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), cart_id)
+        )
+        sync_outbox.record(cursor, cart_id, 'items')
+        conn.commit()
+        return {'found': True, 'productId': product_id, 'productName': product['product_name']}, 200
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        return {'error': str(e)}, 500
+    finally:
+        if conn:
+            conn.close()
+
 # ============================================
 # ROOM CRUD FUNCTIONS
 # ============================================
@@ -1306,6 +1285,7 @@ def update_room(room_id, room_label):
         cursor.execute('UPDATE dining_rooms SET room_label = ? WHERE room_id = ?', 
                       (room_label.strip(), room_id))
         conn.commit()
+        floor_state.mark_changed('layout')
         conn.close()
         return jsonify({'success': True, 'rooms': get_all_rooms()})
     except sqlite3.IntegrityError:
@@ -1327,34 +1307,21 @@ def delete_room(room_id):
         
         cursor.execute('DELETE FROM dining_rooms WHERE room_id = ?', (room_id,))
         conn.commit()
+        floor_state.mark_changed('layout')
         conn.close()
         return jsonify({'success': True, 'rooms': get_all_rooms()})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 def update_room_order(room_orders):
-    """Update room display order"""
-    try:
-        conn, cursor = get_database_connection()
-        for item in room_orders:
-            cursor.execute('UPDATE dining_rooms SET room_order = ? WHERE room_id = ?',
-                          (item['order'], item['room_id']))
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
-
-def update_room_order(room_orders):
-    """Update room_order for multiple rooms"""
+    """Update room_order for multiple rooms ({'room_id', 'room_order'} or the older {'room_id', 'order'})"""
     try:
         conn, cursor = get_database_connection()
-        for room in room_orders:
-            cursor.execute(
-                'UPDATE dining_rooms SET room_order = ? WHERE room_id = ?',
-                (room['room_order'], room['room_id'])
-            )
+        ids = [int(room['room_id']) for room in sorted(room_orders, key=lambda r: float(r.get('room_order', r.get('order', 0))))]
+        moved = ordering.save(cursor, 'dining_rooms', 'room_id', 'room_order', ids)
         conn.commit()
+        if moved:
+            floor_state.mark_changed('layout')
         conn.close()
         return jsonify({'success': True})
     except Exception as e:
@@ -1366,30 +1333,14 @@ def update_room_order(room_orders):
 def get_dining_tables_with_rooms():
     """Get all tables with room information, grouped by room"""
     try:
-        conn, cursor = get_database_connection()
-        cursor.execute('''
-            SELECT 
-                dt.table_id, 
-                dt.table_number, 
-                dt.table_occupied,
-                dt.room_id,
-                COALESCE(dr.room_label, '') as room_label,
-                COALESCE(dr.room_order, 999) as room_order
-            FROM dining_tables dt
-            LEFT JOIN dining_rooms dr ON dt.room_id = dr.room_id
-            ORDER BY dr.room_order, dr.room_label, CAST(dt.table_number AS INTEGER)
-        ''')
-        tables = cursor.fetchall()
-        conn.close()
-        
         return [{
-            'table_id': t[0], 
-            'table_number': t[1], 
-            'table_occupied': t[2],
-            'room_id': t[3],
-            'room_label': t[4],
-            'room_order': t[5]
-        } for t in tables]
+            'table_id': t['table_id'], 
+            'table_number': t['table_number'], 
+            'table_occupied': t['cart_id'],
+            'room_id': t['room_id'],
+            'room_label': t['room_label'],
+            'room_order': t['room_order']
+        } for t in floor_state.snapshot()['tables']]
     except Exception as e:
         print(f"Error getting tables with rooms: {e}")
         return []
@@ -1413,6 +1364,7 @@ def add_table_with_room(table_number, room_id):
         cursor.execute('INSERT INTO dining_tables (table_number, room_id) VALUES (?, ?)', 
                       (table_number, room_id))
         conn.commit()
+        floor_state.mark_changed('layout')
         conn.close()
         
         return jsonify({'success': True, 'tables': get_dining_tables_with_rooms()})
@@ -1427,6 +1379,7 @@ def update_table_room(table_id, room_id):
         cursor.execute('UPDATE dining_tables SET room_id = ? WHERE table_id = ?', 
                       (room_id, table_id))
         conn.commit()
+        floor_state.mark_changed('layout')
         conn.close()
         return jsonify({'success': True, 'tables': get_dining_tables_with_rooms()})
     except Exception as e:
@@ -1436,35 +1389,20 @@ def update_table_room(table_id, room_id):
 def get_free_tables_grouped():
     """Get free tables grouped by room for POS selection"""
     try:
-        conn, cursor = get_database_connection()
-        cursor.execute('''
-            SELECT 
-                dt.table_id, 
-                dt.table_number, 
-                dt.table_occupied,
-                dt.room_id,
-                COALESCE(dr.room_label, '') as room_label,
-                COALESCE(dr.room_order, 999) as room_order
-            FROM dining_tables dt
-            LEFT JOIN dining_rooms dr ON dt.room_id = dr.room_id
-            WHERE dt.table_occupied = 0
-            ORDER BY dr.room_order, dr.room_label, CAST(dt.table_number AS INTEGER)
-        ''')
-        tables = cursor.fetchall()
-        conn.close()
-        
         # Group by room
         grouped = {}
-        for t in tables:
-            room = t[4] if t[4] else 'Other'
+        for t in floor_state.snapshot()['tables']:
+            if t['cart_id']:
+                continue
+            room = t['room_label'] if t['room_label'] else 'Other'
             if room not in grouped:
                 grouped[room] = []
             grouped[room].append({
-                'table_id': t[0],
-                'table_number': t[1],
-                'room_id': t[3],
-                'room_label': t[4],
-                'room_order': t[5]
+                'table_id': t['table_id'],
+                'table_number': t['table_number'],
+                'room_id': t['room_id'],
+                'room_label': t['room_label'],
+                'room_order': t['room_order']
             })
         
         return grouped
@@ -1515,10 +1453,12 @@ def new_cart_multi_table(cartData):
                 if customer_id > 1 and customer_name != "" and customer_phone != "":
                     cursor.execute("UPDATE customers SET customer_name = ?, customer_telephone = ? WHERE customer_id = ?", 
                                  (customer_name, customer_phone, customer_id))
+                    caller_lookup.set_phone_key(cursor, customer_id, customer_phone)
             else:
                 cursor.execute("INSERT INTO customers (customer_name, customer_telephone) VALUES (?, ?)", 
                              (customer_name, customer_phone))
                 customer_id = cursor.lastrowid
+                caller_lookup.set_phone_key(cursor, customer_id, customer_phone)
         
         address_id = None
         if 'customerAddress' in customer and customer['customerAddress'] != '':
@@ -1598,7 +1538,12 @@ def new_cart_multi_table(cartData):
         cursor.execute('DELETE FROM cart WHERE cart_id = ?', (posted_cart_id,))
         cursor.execute('DELETE FROM cart_dining_tables WHERE cart_id = ?', (posted_cart_id,))
         
+        sync_outbox.record(cursor, cart_id, 'opened')
+        if posted_cart_id:
+            sync_outbox.record(cursor, posted_cart_id, 'deleted')
         conn.commit()
+        caller_lookup.clear_cache()
+        floor_state.mark_changed('open')
         return jsonify({'cart_id': cart_id})
         
     except sqlite3.Error as e:
@@ -1667,6 +1612,7 @@ def merge_tables_to_cart(cart_id, tables_to_add):
             ''', (cart_id, table_id, table_number, cover))
         
         conn.commit()
+        floor_state.mark_changed('merge')
         
         # Return updated table list for this cart
         tables = get_cart_tables(cart_id)
@@ -1802,7 +1748,10 @@ def split_tables_from_cart(source_cart_id, tables_to_split, items_to_move=None,
                     ''', (new_cart_id, item[0], item[1], item[2], qty_to_move,
                           item[4], item[5], item[6], item[7], item[8], item[9]))
         
+        sync_outbox.record(cursor, source_cart_id, 'items')
+        sync_outbox.record(cursor, new_cart_id, 'opened')
         conn.commit()
+        floor_state.mark_changed('split')
         
         return jsonify({
             'success': True,
@@ -1826,8 +1775,12 @@ def split_tables_from_cart(source_cart_id, tables_to_split, items_to_move=None,
 
 def get_cart_tables(cart_id):
     """Get all tables associated with a cart"""
+    # open carts are served from the floor map, closed ones from history
+    tables = floor_state.cart_tables(cart_id)
+    if tables is not None:
+        return tables
     try:
-        conn, cursor = get_database_connection()
+        conn, cursor = archive.cart_connection(cart_id)
         cursor.execute('''
             SELECT cdt.table_id, cdt.table_number, cdt.table_cover,
                    COALESCE(dr.room_label, '') as room_label
@@ -2035,6 +1988,7 @@ def update_cart_tables(cart_id, table_updates):
                 ''', (new_table_id, new_table_number, cart_id, table_id))
         
         conn.commit()
+        floor_state.mark_changed('tables')
         
         # Return updated table list
         tables = get_cart_tables(cart_id)
@@ -2055,7 +2009,7 @@ def update_cart_tables(cart_id, table_updates):
 def get_current_cart_data_v2(cart_id):
     """Updated to return multiple tables"""
     try:
-        conn, cursor = get_database_connection()
+        conn, cursor = archive.cart_connection(cart_id)
         cursor.execute('''
             SELECT
                 c.cart_id, c.order_type, c.order_menu, c.order_date,
@@ -2126,12 +2080,18 @@ def delete_cart_and_items_v2(cart_id):
         cursor.execute("UPDATE dining_tables SET table_occupied = 0 WHERE table_occupied = ?", (cart_id,))
         
         # Delete cart data
+        shift_totals.void_cart(cursor, cart_id)
+        cart_ledger.remove(cursor, cart_id)
+        customer_profiles.invalidate_cart(cursor, cart_id)
         cursor.execute("DELETE FROM cart WHERE cart_id = ?", (cart_id,))
         cursor.execute("DELETE FROM cart_item WHERE cart_id = ?", (cart_id,))
         cursor.execute("DELETE FROM cart_dining_tables WHERE cart_id = ?", (cart_id,))
         cursor.execute("DELETE FROM cart_payments WHERE cart_id = ?", (cart_id,))
+        inventory.release_cart(cursor, cart_id)
+        sync_outbox.record(cursor, cart_id, 'deleted')
         
         conn.commit()
+        floor_state.mark_changed('close')
         conn.close()
         
         return jsonify({"message": f"Cart {cart_id} and associated data deleted."})
@@ -2139,218 +2099,57 @@ def delete_cart_and_items_v2(cart_id):
         return jsonify({"error": str(e)}), 500
 
 def complete_checkout_v2(cart_id, payment_method, discounted_total, split_charges=None):
-    try:
-        employee_id = session.get('employee_id', 0)
-        current_timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        conn, cursor = get_database_connection()
-        
-        # 1. First update cart status and clear dining table
-        cursor.execute("""
-            UPDATE cart 
-            SET cart_status = 'completed', 
-                cart_charge_updated = ?, 
-                cart_updated_by = ?,
-                sync_status = 'pending'
-            WHERE cart_id = ?""", 
-            (current_timestamp, employee_id, cart_id))
-        
-        cursor.execute("""
-            UPDATE dining_tables 
-            SET table_occupied = 0 
-            WHERE table_occupied = ?""", 
-            (cart_id,))
-        
-        # VAT Calculation with multi-option support
-        vat_rate = json_utils.get_vat_rate()
-
-        if vat_rate > 0:
-            cursor.execute("""
-                SELECT 
-                    ci.price, ci.quantity, ci.product_discount_type, 
-                    ci.product_discount, ci.vatable, ci.options,
-                    ci.product_note,  -- ADD THIS
-                    c.order_type, c.cart_discount_type, c.cart_discount
-                FROM cart_item ci
-                JOIN cart c ON ci.cart_id = c.cart_id
-                WHERE ci.cart_id = ?""", (cart_id,))
-            items = cursor.fetchall()
-            
-            if items:
-                cart_total = 0
-                vatable_total = 0
-                order_type = items[0][7]  # Index shifted due to product_note
-                
-                for item in items:
-                    base_price, base_qty, disc_type, disc_amount, base_vatable, options_str, mods_str, _, _, _ = item
-                    options = helpers.parse_options(options_str)
-                    
-                    # 1. Calculate base item
-                    base_total = base_price * base_qty
-                    base_vat_amount = base_total if (order_type == 'dine' or base_vatable) else 0
-                    
-                    # 2. Calculate all options
-                    options_total = 0
-                    options_vat_amount = 0
-                    for opt in options:
-                        opt_total = opt['price'] * opt['quantity']
-                        options_total += opt_total
-                        if order_type == 'dine' or opt['vatable']:
-                            options_vat_amount += opt_total
-                    
-                    # 3. Calculate modifier prices (NEW)
-                    mods_total = helpers.calculate_mods_total(mods_str) * base_qty
-                    # Modifiers follow base item VAT status
-                    mods_vat_amount = mods_total if (order_type == 'dine' or base_vatable) else 0
-                    
-                    # 4. Combined total before discounts
-                    combined_total = base_total + options_total + mods_total
-                    combined_vatable = base_vat_amount + options_vat_amount + mods_vat_amount
-                    
-                    # 5. Apply item-level discount proportionally
-                    if disc_amount > 0:
-                        combined_total = helpers.calculate_cart_discounts(disc_amount, disc_type, combined_total)
-                        if combined_total > 0:
-                            discount_ratio = combined_total / (combined_total + disc_amount)
-                            combined_vatable *= discount_ratio
-                    
-                    # Add to totals
-                    cart_total += combined_total
-                    vatable_total += combined_vatable
-                
-                # Apply cart discount proportionally
-                cart_disc = items[0][8]
-                if cart_disc > 0:
-                    cart_disc_type = items[0][7]
-                    cart_total = helpers.calculate_cart_discounts(cart_disc, cart_disc_type, cart_total)
-                    if cart_total > 0:
-                        vatable_total *= (cart_total / (cart_total + cart_disc))
-                
-                # Update VAT
-                vat_base = cart_total if order_type == 'dine' else vatable_total
-                vat_amount = round(vat_base * vat_rate, 2)
-                cursor.execute("UPDATE cart SET vat_amount = ? WHERE cart_id = ?", (vat_amount, cart_id))
-        
-        # 3. Process payments
-        if payment_method == 'Split' and split_charges and len(split_charges) > 0:
-            for charge in split_charges:
-                charge_payment_method = charge.get('paymentMethod', payment_method)
-                charge_discounted_total = charge.get('amount', 0)
-                cursor.execute("""
-                    INSERT INTO cart_payments 
-                    (cart_id, payment_method, discounted_total) 
-                    VALUES (?, ?, ?)""",
-                    (cart_id, charge_payment_method, charge_discounted_total))
-        else:
-            cursor.execute("""
-                INSERT INTO cart_payments 
-                (cart_id, payment_method, discounted_total) 
-                VALUES (?, ?, ?)""",
-                (cart_id, payment_method, discounted_total))
-        
-        # 4. Create kitchen order if enabled
-        if get_setting('kitchen_screen') == "1":
-            cursor.execute("""
-                INSERT INTO kitchen_orders (order_id, item_id)
-                SELECT cart_id, cart_item_id
-                FROM cart_item
-                WHERE cart_id = ?""", 
-                (cart_id,))
-
-        conn.commit()
-        deduct_inventory(cart_id)
-        return {'status': 'success'}
-        
-    except Exception as e:
-        if conn:
-            conn.rollback()
-        return {'status': 'error', 'message': str(e)}
-    finally:
-        if conn:
-            conn.close()
+    """Status, tables, VAT, payments, kitchen orders and stock in one transaction."""
+    return checkout.CheckoutPipeline(cart_id, payment_method, discounted_total, split_charges).run()
 
-async def get_all_cart_items(cart_id):
+def cart_items(cart_id):
+    """
+    A cart's lines and cart-level fields as plain data.
+    {'items': [{'cart_item_id': 81, 'product_name': 'Cola', 'price': 1.2, 'quantity': 2, 'vat': 1, ...}, ...],
+     'cart_data': {'overall_note': '', 'cart_discount_type': 'fixed', 'cart_discount': 0,
+                   'cart_service_charge': 0, 'order_type': 'dine'}}
+    """
+    conn = None
     try:
-        conn, cursor = get_database_connection()
-        cursor.execute(
-            """SELECT 
-                cart_item.cart_item_id,
-                cart_item.cart_id,
-                cart_item.product_id,
-                cart_item.product_name,
-                cart_item.price,
-                cart_item.quantity,
-                cart_item.options,
-                cart_item.product_note,
-                cart_item.product_discount_type,
-                cart_item.product_discount,
-                cart_item.category_order,
-                cart_item.vatable,
-                COALESCE(cart_item.kitchen_printed_qty, 0) AS kitchen_printed_qty,
-                COALESCE(cart_item.bar_printed_qty, 0) AS bar_printed_qty,
-                COALESCE(products.cpn, 0) AS cpn,
-                products.category_id
-            FROM cart_item
-            LEFT JOIN products ON cart_item.product_id = products.product_id
-            WHERE cart_item.cart_id = ?
-            ORDER BY cart_item.category_order""",
-            (cart_id,)
-        )
-        items = cursor.fetchall()
-        sorted_items = sorted(items, key=lambda x: (x[10], x[3]))
-        # Convert the items to a list of dictionaries
-        items_list = []
-        for item in sorted_items:
-            item_dict = {
-                'cart_item_id': item[0],
-                'cart_id': item[1],
-                'product_id': item[2],
-                'product_name': item[3],
-                'price': item[4],
-                'quantity': item[5],
-                'options': item[6],
-                'product_note': item[7],
-                'product_discount_type': item[8],
-                'product_discount': item[9],
-                'category_order': item[10],
-                'vat': item[11],
-                'kitchen_printed_qty': item[12],
-                'bar_printed_qty': item[13],
-                'cpn': item[14],
-                'category_id': item[15]
-            }
-            items_list.append(item_dict)
+        conn, cursor = archive.cart_connection(cart_id)
+        items_list = cart_snapshot.items(cursor, cart_id)
         cursor.execute(
             "SELECT overall_note, cart_discount_type, cart_discount, cart_service_charge, order_type FROM cart WHERE cart_id = ?",
             (cart_id,)
         )
         cart_data = cursor.fetchone()
-        conn.close()
-        vendor = await async_settings.get_active_payment_vendor()
-        card_vendor = vendor['vendor_name']
-        response_data = {
+        return {
             "items": items_list,
-            "cart_data": {
-                "overall_note": cart_data[0],
-                "cart_discount_type": cart_data[1],
-                "cart_discount": cart_data[2],
-                "cart_service_charge": cart_data[3],
-                "order_type": cart_data[4]
-            },
-            "card_vendor": card_vendor
+            "cart_data": dict(zip([desc[0] for desc in cursor.description], cart_data)) if cart_data else None
         }
-        return jsonify(response_data), 200
+    finally:
+        if conn:
+            conn.close()
+
+async def get_all_cart_items(cart_id):
+    try:
+        response_data = cart_items(cart_id)
+        vendor = await async_settings.get_active_payment_vendor()
+        response_data["card_vendor"] = vendor['vendor_name']
+        return serialize.response(response_data), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return serialize.response({"error": str(e)}), 500
 
 def delete_cart_and_items(cart_id):
     try:
         conn, cursor = get_database_connection()
+        shift_totals.void_cart(cursor, cart_id)
+        cart_ledger.remove(cursor, cart_id)
+        customer_profiles.invalidate_cart(cursor, cart_id)
         cursor.execute("DELETE FROM cart WHERE cart_id = ?", (cart_id,))
         cursor.execute("DELETE FROM cart_item WHERE cart_id = ?", (cart_id,))
         cursor.execute("DELETE FROM cart_dining_tables WHERE cart_id = ?", (cart_id,))
         cursor.execute("DELETE FROM cart_payments WHERE cart_id = ?", (cart_id,))
         cursor.execute("UPDATE dining_tables SET table_occupied = 0 WHERE table_occupied = ?", (cart_id,))
+        inventory.release_cart(cursor, cart_id)
+        sync_outbox.record(cursor, cart_id, 'deleted')
         conn.commit()
+        floor_state.mark_changed('close')
         conn.close()
         success_message = f"Cart with cart_id {cart_id} and associated cart items and payments deleted."
         return jsonify({"message": success_message})
@@ -2361,6 +2160,7 @@ def delete_cart_and_items(cart_id):
 def delete_cart_item(cart_item_id):
     try:
         conn, cursor = get_database_connection()
+        sync_outbox.record_item(cursor, cart_item_id, 'items')
         cursor.execute(
             "DELETE FROM cart_item WHERE cart_item_id = ?",
             (cart_item_id,)
@@ -2488,10 +2288,9 @@ def update_cart_item_with_mods(item_id, mods_data, quantity):
             return jsonify({"error": "Product not found"}), 404
         
         track_inventory = product[0]
-        stock_quantity = product[1]
         product_name = product[2]
         
-        # If inventory tracking is enabled, validate stock
+        # If inventory tracking is enabled, validate (and reserve) stock
         if track_inventory == 1:
             cursor.execute("""
                 SELECT COALESCE(SUM(quantity), 0) 
@@ -2504,22 +2303,17 @@ def update_cart_item_with_mods(item_id, mods_data, quantity):
             other_items_quantity = cursor.fetchone()[0]
             new_total_quantity = other_items_quantity + int(quantity)
             
-            if new_total_quantity > stock_quantity:
-                available = stock_quantity - other_items_quantity
+            try:
+                inventory.reserve_for_cart(cursor, cart_id, product_id, new_total_quantity)
+            except inventory.InsufficientStock as e:
+                conn.rollback()
+                available = max(e.available - other_items_quantity, 0)
                 return jsonify({
                     "error": f"Insufficient stock for {product_name}. Available: {available}, Requested: {quantity}"
                 }), 400
         
         # Build the modifier string in new format: modifier_id|name|price|qty
-        mod_strings = []
-        for mod in mods_data:
-            mod_id = mod.get('modifier_id', 0)
-            name = mod.get('name', '').replace('|', '-').replace(',', '-')  # Sanitize
-            price = mod.get('price', 0)
-            qty = mod.get('qty', 1)
-            mod_strings.append(f"{mod_id}|{name}|{price}|{qty}")
-        
-        combined_mods = ', '.join(mod_strings)
+        combined_mods = cart_batch.mods_string(mods_data)
         
         # Update the cart item
         cursor.execute("""
@@ -2527,6 +2321,7 @@ def update_cart_item_with_mods(item_id, mods_data, quantity):
             SET product_note = ?, quantity = ? 
             WHERE cart_item_id = ?
         """, (combined_mods, quantity, item_id))
+        sync_outbox.record(cursor, cart_id, 'items')
         
         conn.commit()
         return jsonify({"message": "Item modified successfully"}), 200
@@ -2782,12 +2577,10 @@ def update_cart_item(item_id, combined_mods, quantity):
             return jsonify({"error": "Product not found"}), 404
         
         track_inventory = product[0]
-        stock_quantity = product[1]
         product_name = product[2]
         
-        # If inventory tracking is enabled, validate stock
+        # If inventory tracking is enabled, validate (and reserve) stock
         if track_inventory == 1:
-            # Calculate total quantity of this product in the cart (excluding current item)
             cursor.execute("""
                 SELECT COALESCE(SUM(quantity), 0) 
                 FROM cart_item 
@@ -2797,13 +2590,13 @@ def update_cart_item(item_id, combined_mods, quantity):
             """, (cart_id, product_id, item_id))
             
             other_items_quantity = cursor.fetchone()[0]
-            
-            # Calculate total quantity if we apply this update
             new_total_quantity = other_items_quantity + int(quantity)
             
-            # Check if new quantity exceeds stock
-            if new_total_quantity > stock_quantity:
-                available = stock_quantity - other_items_quantity
+            try:
+                inventory.reserve_for_cart(cursor, cart_id, product_id, new_total_quantity)
+            except inventory.InsufficientStock as e:
+                conn.rollback()
+                available = max(e.available - other_items_quantity, 0)
                 return jsonify({
                     "error": f"Insufficient stock for {product_name}. Available: {available}, Requested: {quantity}"
                 }), 400
@@ -2814,6 +2607,7 @@ def update_cart_item(item_id, combined_mods, quantity):
             SET product_note = ?, quantity = ? 
             WHERE cart_item_id = ?
         """, (combined_mods, quantity, item_id))
+        sync_outbox.record(cursor, cart_id, 'items')
         
         conn.commit()
         return jsonify({"message": "Item modified successfully"}), 200
@@ -2830,7 +2624,7 @@ def get_free_tables():
     try:
         conn, cursor = get_database_connection()
         cursor.execute('SELECT table_id, table_number, table_occupied FROM dining_tables')
-        dining_tables = [dict(zip([desc[0] for desc in cursor.description], row)) for row in cursor.fetchall()]
+        dining_tables = row_types.dicts(cursor)
         conn.close()
         return dining_tables
     except Exception as e:
@@ -2840,7 +2634,7 @@ def get_all_tables():
     try:
         conn, cursor = get_database_connection()
         cursor.execute('SELECT * FROM dining_tables')
-        dining_tables = [dict(zip([desc[0] for desc in cursor.description], row)) for row in cursor.fetchall()]
+        dining_tables = row_types.dicts(cursor)
         conn.close()
         return dining_tables
     except Exception as e:
@@ -2895,6 +2689,7 @@ def add_table(table_number):
 
         cursor.execute('INSERT INTO dining_tables (table_number) VALUES (?)', (table_number,))
         conn.commit()
+        floor_state.mark_changed('layout')
 
         cursor.execute('SELECT table_id, table_number, table_occupied FROM dining_tables')
         columns = [column[0] for column in cursor.description]
@@ -2907,9 +2702,13 @@ def add_table(table_number):
         print(str(e))
     return jsonify({'error': 'Failed to save table. Try a different number'}), 500
 
-def get_cart_discount(cart_id):
+def cart_discount_summary(cart_id):
+    """
+    Cart discount with the cart's gross and item-discount totals.
+    {'cart_discount_type': 'percentage', 'cart_discount': 10, 'total_price': 26.0, 'item_discount_total': 1.0}
+    """
+    conn, cursor = archive.cart_connection(cart_id)
     try:
-        conn, cursor = get_database_connection()
         cursor.execute(
             """
             SELECT cart.cart_discount_type, cart.cart_discount
@@ -2973,15 +2772,18 @@ def get_cart_discount(cart_id):
 
             total_price += each_item_price
 
-        result = {
+        return {
             "cart_discount_type": discount_type,
             "cart_discount": discount_value,
             "total_price": total_price,
             "item_discount_total": item_discount_total
         }
-        
+    finally:
         conn.close()
-        return json.dumps(result)
+
+def get_cart_discount(cart_id):
+    try:
+        return json.dumps(cart_discount_summary(cart_id))
     except Exception as e:
         error_message = {"error": f"Error getting discounts: {str(e)}"}
         return json.dumps(error_message)
@@ -2991,6 +2793,7 @@ def apply_discount(cart_id, discount_type, discount_value):
         if cart_id is not None and discount_type is not None and discount_value is not None:
             conn, cursor = get_database_connection()
             cursor.execute("UPDATE cart SET cart_discount_type = ?, cart_discount = ? WHERE cart_id = ?", (discount_type, discount_value, cart_id))
+            sync_outbox.record(cursor, cart_id, 'discount')
             conn.commit()
             conn.close()
 
@@ -3005,6 +2808,7 @@ def apply_item_discount(cart_item_id, discount_type, discount_value):
         if cart_item_id is not None and discount_type is not None and discount_value is not None:
             conn, cursor = get_database_connection()
             cursor.execute("UPDATE cart_item SET product_discount_type = ?, product_discount = ? WHERE cart_item_id = ?", (discount_type, discount_value, cart_item_id))
+            sync_outbox.record_item(cursor, cart_item_id, 'discount')
             conn.commit()
             conn.close()
 
@@ -3027,6 +2831,10 @@ def remove_discount(cart_or_item, id):
             """
         cursor.execute(update_query,
                        (id,))
+        if cart_or_item == "cart":
+            sync_outbox.record(cursor, id, 'discount')
+        else:
+            sync_outbox.record_item(cursor, id, 'discount')
         conn.commit()
         return jsonify({"message": "discount removed"}), 200
     except Exception as e:
@@ -3036,7 +2844,7 @@ def remove_discount(cart_or_item, id):
 
 def get_cart_service_delivery_charge(cart_id):
     try:
-        conn, cursor = get_database_connection()
+        conn, cursor = archive.cart_connection(cart_id)
         cursor.execute(
             """
             SELECT cart_service_charge
@@ -3132,130 +2940,92 @@ def search_customers(search_term):
     except Exception as e:
         return [{'error': str(e)}]
 
+def customer_orders(customer_id):
+    """
+    Items of the customer's last orders with their profile figures, or None
+    if there is no such customer.
+    {'orders': [{'order_id': 981, 'order_type': 'delivery', 'order_date': ..., 'product_id': 4,
+                 'product_name': 'Margherita', 'price': 9.5, 'quantity': 1, 'options': '',
+                 'product_note': '', 'category_order': 1}, ...],
+     'customer_info': {...}, 'favourites': [...], 'order_count': 12, 'lifetime_spend': 210.5,
+     'last_order_date': '2025-12-20 18:02:11'}
+    """
+    # precomputed by checkout; rebuilt from history only after a refund or deletion
+    profile = customer_profiles.get(customer_id)
+    if profile is None:
+        return None
+
+    # items of the last orders, flattened as the reorder screen lists them
+    orders_list = [
+        dict(item, order_id=order['order_id'], order_type=order['order_type'], order_date=order['order_date'])
+        for order in profile['recent_orders']
+        for item in order['items']
+    ]
+    return {
+        'orders': orders_list,
+        'customer_info': profile['customer_info'],
+        'favourites': profile['favourites'],
+        'order_count': profile['order_count'],
+        'lifetime_spend': profile['lifetime_spend'],
+        'last_order_date': profile['last_order_date']
+    }
+
 def get_orders_by_customer_id(customer_id):
     try:
+        response = customer_orders(customer_id)
+        if response is None:
+            return json.dumps({'error': 'Customer not found'})
+        return json.dumps(response)
+
+    except Exception as e:
+        return json.dumps({'error': str(e)})
+
+def reorder_customer_order(cart):
+    try:
+        reorder_items = cart.get('reorderItems', [])
+        cart_id = cart.get('cartId', 0)
+        cart_menu = int(cart.get('cartMenu', 0))
         conn, cursor = get_database_connection()
-        order_query = """
-        SELECT
-            c.cart_id,
-            c.order_type,
-            c.order_date,
-            ci.product_id,
-            ci.product_name,
-            ci.price,
-            ci.quantity,
-            ci.options,
-            ci.product_note,
-            ci.category_order
-        FROM
-            cart c
-        JOIN
-            cart_item ci ON c.cart_id = ci.cart_id
-        WHERE
-            c.customer_id = ? AND c.cart_status = ?
-        ORDER BY c.cart_id DESC
-        LIMIT 10
-        """
-        cursor.execute(order_query, (customer_id, "completed"))
-        orders = cursor.fetchall()
 
-        customer_query = """
-        SELECT
-            COALESCE(c.customer_name, '') AS customer_name,
-            COALESCE(c.customer_telephone, '') AS customer_telephone,
-            COALESCE(a.address_id, '') AS address_id,
-            COALESCE(a.address, '') AS address,
-            COALESCE(a.postcode, '') AS postcode
-        FROM
-            customers c
-        LEFT JOIN
-            customer_addresses a ON c.customer_id = a.customer_id
-        WHERE
-            c.customer_id = ?
-        """
-        cursor.execute(customer_query, (customer_id,))
-        customer_info = cursor.fetchone()
-
-        conn.close()
-
-        # Create the orders list
-        orders_list = [
-            {
-                'order_id': order[0],
-                'order_type': order[1],
-                'order_date': order[2],
-                'product_id': order[3],
-                'product_name': order[4],
-                'price': order[5],
-                'quantity': order[6],
-                'options': order[7],
-                'product_note': order[8],
-                'category_order': order[9]
-            }
-            for order in orders
-        ]
-
-        # Combine orders and customer info into one response
-        response = {
-            'orders': orders_list,
-            'customer_info': {
-                'customer_name': customer_info[0],
-                'customer_telephone': customer_info[1],
-                'address_id': customer_info[2],
-                'address': customer_info[3],
-                'postcode': customer_info[4]
-            }
-        }
-
-        response_json = json.dumps(response)
-
-        return response_json
-
-    except Exception as e:
-        return json.dumps({'error': str(e)})
-
-def reorder_customer_order(cart):
-    try:
-        reorder_items = cart.get('reorderItems', [])
-        cart_id = cart.get('cartId', 0)
-        cart_menu = int(cart.get('cartMenu', 0))
-        conn, cursor = get_database_connection()
+        # look up every product and option once instead of per line
+        product_ids = list({item['product_id'] for item in reorder_items})
+        option_ids = list({int(option.strip('"')) for item in reorder_items for option in (item['options'] or [])})
+        cursor.execute("""
+            SELECT product_id, product_name, in_price, out_price
+            FROM products
+            WHERE product_id IN (SELECT value FROM json_each(?))
+        """, (json.dumps(product_ids),))
+        products = {row[0]: row[1:] for row in cursor.fetchall()}
+        cursor.execute("""
+            SELECT option_item_id, option_item_name, option_item_in_price, option_item_out_price
+            FROM option_items
+            WHERE option_item_id IN (SELECT value FROM json_each(?))
+        """, (json.dumps(option_ids),))
+        option_items = {row[0]: row[1:] for row in cursor.fetchall()}
 
+        rows = []
         for item in reorder_items:
             product_id = item['product_id']
-            quantity = item['quantity']
-            category_order = item['category_order']
-            note = item['note']
-
-            cursor.execute("""
-                SELECT product_name, in_price, out_price
-                FROM products
-                WHERE product_id = ?
-            """, (product_id,))
-            product = cursor.fetchone()
+            product = products[product_id]
 
             option_strings = []
-            if item['options']:
-                for option in item['options']:
-                    cleaned_option = option.strip('"')
-                    cursor.execute("""
-                        SELECT option_item_name, option_item_in_price, option_item_out_price
-                        FROM option_items
-                        WHERE option_item_id = ?
-                    """, (int(cleaned_option),))
-                    option_item = cursor.fetchone()
-                    option_string = f"{cleaned_option}|{option_item[0]}|"
-                    option_string += str(option_item[1]) if cart_menu == 0 else str(option_item[2])
-                    option_string += f"|1"
-
-                    option_strings.append(option_string)
-
-            options_final = ", ".join(option_strings)
+            for option in item['options'] or []:
+                cleaned_option = option.strip('"')
+                option_item = option_items[int(cleaned_option)]
+                option_string = f"{cleaned_option}|{option_item[0]}|"
+                option_string += str(option_item[1]) if cart_menu == 0 else str(option_item[2])
+                option_string += f"|1"
+
+                option_strings.append(option_string)
+
+            rows.append({
+                'product_id': product_id, 'product_name': product[0],
+                'price': product[1] if cart_menu == 0 else product[2], 'quantity': item['quantity'],
+                'options': ", ".join(option_strings), 'product_note': item['note'],
+                'category_order': item['category_order']
+            })
 
-            cursor.execute("""
-                INSERT INTO cart_item (cart_id, product_id, product_name, price, quantity, options, product_note, category_order)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (cart_id, product_id, product[0], product[1] if cart_menu == 0 else product[2], quantity, options_final, note, category_order))
+        cart_lines.add_lines(cursor, cart_id, rows)
 
         conn.commit()
         conn.close()
@@ -3279,6 +3049,7 @@ def update_customer(customer):
             SET customer_name = ?, customer_telephone = ?
             WHERE customer_id = ?
         ''', (name, phone, customer_id))
+        caller_lookup.set_phone_key(cursor, customer_id, phone)
 
         address_id_raw = customer.get('addressId')
         if address_id_raw and str(address_id_raw).isdigit():
@@ -3297,6 +3068,7 @@ def update_customer(customer):
             ''', (customer_id, address, postcode))
 
         conn.commit()
+        caller_lookup.clear_cache()
         response = {'success': True}
     except Exception as e:
         conn.rollback()
@@ -3308,160 +3080,25 @@ def update_customer(customer):
     return jsonify(response)
 
 def complete_checkout(cart_id, payment_method, discounted_total, split_charges=None):
+    # original checkout VAT excluded modifier prices
+    return checkout.CheckoutPipeline(cart_id, payment_method, discounted_total, split_charges, include_mods=False).run()
+
+def deduct_inventory(cart_id):
+    """Deduct a cart's stock in its own transaction; checkout does this inline."""
+    conn = None
     try:
-        employee_id = session.get('employee_id', 0)
-        current_timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         conn, cursor = get_database_connection()
-        
-        # 1. First update cart status and clear dining table
-        cursor.execute("""
-            UPDATE cart 
-            SET cart_status = 'completed', 
-                cart_charge_updated = ?, 
-                cart_updated_by = ?,
-                sync_status = 'pending'
-            WHERE cart_id = ?""", 
-            (current_timestamp, employee_id, cart_id))
-        
-        cursor.execute("""
-            UPDATE dining_tables 
-            SET table_occupied = 0 
-            WHERE table_occupied = ?""", 
-            (cart_id,))
-        
-        # VAT Calculation with multi-option support
-        vat_rate = json_utils.get_vat_rate()
-        if vat_rate > 0:
-            cursor.execute("""
-                SELECT 
-                    ci.price, ci.quantity, ci.product_discount_type, 
-                    ci.product_discount, ci.vatable, ci.options,
-                    c.order_type, c.cart_discount_type, c.cart_discount
-                FROM cart_item ci
-                JOIN cart c ON ci.cart_id = c.cart_id
-                WHERE ci.cart_id = ?""", (cart_id,))
-            items = cursor.fetchall()
-            
-            if items:
-                cart_total = 0
-                vatable_total = 0
-                order_type = items[0][6]
-                
-                for item in items:
-                    base_price, base_qty, disc_type, disc_amount, base_vatable, options_str, _, _, _ = item
-                    options = helpers.parse_options(options_str)
-                    
-                    # 1. Calculate base item
-                    base_total = base_price * base_qty
-                    base_vat_amount = base_total if (order_type == 'dine' or base_vatable) else 0
-                    
-                    # 2. Calculate all options
-                    options_total = 0
-                    options_vat_amount = 0
-                    for opt in options:
-                        opt_total = opt['price'] * opt['quantity']
-                        options_total += opt_total
-                        if order_type == 'dine' or opt['vatable']:
-                            options_vat_amount += opt_total
-                    
-                    # 3. Combined total before discounts
-                    combined_total = base_total + options_total
-                    combined_vatable = base_vat_amount + options_vat_amount
-                    
-                    # 4. Apply item-level discount proportionally
-                    if disc_amount > 0:
-                        combined_total = helpers.calculate_cart_discounts(disc_amount, disc_type, combined_total)
-                        if combined_total > 0:
-                            discount_ratio = combined_total / (combined_total + disc_amount)
-                            combined_vatable *= discount_ratio
-                    
-                    # Add to totals
-                    cart_total += combined_total
-                    vatable_total += combined_vatable
-                
-                # Apply cart discount proportionally
-                cart_disc = items[0][8]
-                if cart_disc > 0:
-                    cart_disc_type = items[0][7]
-                    cart_total = helpers.calculate_cart_discounts(cart_disc, cart_disc_type, cart_total)
-                    if cart_total > 0:
-                        vatable_total *= (cart_total / (cart_total + cart_disc))
-                
-                # Update VAT
-                vat_base = cart_total if order_type == 'dine' else vatable_total
-                vat_amount = round(vat_base * vat_rate, 2)
-                cursor.execute("UPDATE cart SET vat_amount = ? WHERE cart_id = ?", (vat_amount, cart_id))
-        
-        # 3. Process payments
-        if payment_method == 'Split' and split_charges and len(split_charges) > 0:
-            for charge in split_charges:
-                charge_payment_method = charge.get('paymentMethod', payment_method)
-                charge_discounted_total = charge.get('amount', 0)
-                cursor.execute("""
-                    INSERT INTO cart_payments 
-                    (cart_id, payment_method, discounted_total) 
-                    VALUES (?, ?, ?)""",
-                    (cart_id, charge_payment_method, charge_discounted_total))
-        else:
-            cursor.execute("""
-                INSERT INTO cart_payments 
-                (cart_id, payment_method, discounted_total) 
-                VALUES (?, ?, ?)""",
-                (cart_id, payment_method, discounted_total))
-        
-        # 4. Create kitchen order if enabled
-        if get_setting('kitchen_screen') == "1":
-            cursor.execute("""
-                INSERT INTO kitchen_orders (order_id, item_id)
-                SELECT cart_id, cart_item_id
-                FROM cart_item
-                WHERE cart_id = ?""", 
-                (cart_id,))
-
+        conn.execute("BEGIN IMMEDIATE")
+        inventory.deduct_cart(cursor, cart_id, session.get('employee_id', 0))
         conn.commit()
-        deduct_inventory(cart_id)
-        return {'status': 'success'}
-        
-    except Exception as e:
-        if conn:
-            conn.rollback()
-        return {'status': 'error', 'message': str(e)}
+        return {"message": "Inventory updated"}, 200
+    except inventory.InsufficientStock as e:
+        conn.rollback()
+        return {"error": str(e)}, 400
     finally:
         if conn:
             conn.close()
 
-def deduct_inventory(cart_id):
-    conn, cursor = get_database_connection()
-    
-    # Get all items in cart
-    cursor.execute("""
-        SELECT ci.product_id, ci.quantity, p.stock_quantity, p.track_inventory, p.product_name
-        FROM cart_item ci
-        JOIN products p ON ci.product_id = p.product_id
-        WHERE ci.cart_id = ?
-    """, (cart_id,))
-    
-    items = cursor.fetchall()
-    
-    for product_id, qty, current_stock, track_inv, name in items:
-        if track_inv == 1:  # Only if inventory tracking enabled
-            new_stock = current_stock - qty
-            
-            # Optional: Prevent negative stock
-            if new_stock < 0:
-                conn.close()
-                return {"error": f"{name} out of stock"}, 400
-            
-            cursor.execute("""
-                UPDATE products 
-                SET stock_quantity = ? 
-                WHERE product_id = ?
-            """, (new_stock, product_id))
-    
-    conn.commit()
-    conn.close()
-    return {"message": "Inventory updated"}, 200
-
 def update_vat_price(cart_id, vat_amount):
     try:
         conn, cursor = get_database_connection()
@@ -3474,88 +3111,103 @@ def update_vat_price(cart_id, vat_amount):
     finally:
         conn.close()
 
-def get_order_history(start_date=None, end_date=None, payment_method=None):
-    conn, cursor = get_database_connection()
-    
-    # Base query
-    query = '''
-        SELECT
-            main.cart_id,
-            main.order_type,
-            main.formatted_order_date,
-            main.customer_name,
-            main.payment_info,
-            sub.total_discounted_amount,
-            vat_amount
-        FROM (
-            SELECT
-                c.cart_id,
-                c.order_type,
-                c.vat_amount,
-                strftime('%H:%M %d-%m-%Y', c.cart_charge_updated) AS formatted_order_date,
-                cu.customer_name,
-                cp.payment_info
-            FROM cart c
-            LEFT JOIN customers cu ON c.customer_id = cu.customer_id
-            LEFT JOIN (
-                SELECT cart_id, GROUP_CONCAT(payment_method || ': £' || printf("%.2f", discounted_total)) AS payment_info
-                FROM cart_payments
-                GROUP BY cart_id
-            ) cp ON c.cart_id = cp.cart_id
-            WHERE c.cart_status IN ('completed', 'refunded', 'partial_refund')
-    '''
-    
-    params = []
-    
-    # Add date range filter if both dates are provided
+HISTORY_STATUSES = ('completed', 'refunded', 'partial_refund')
+
+def encode_history_cursor(charge_updated, cart_id):
+    return base64.urlsafe_b64encode(json.dumps([charge_updated, cart_id]).encode()).decode().rstrip('=')
+
+def decode_history_cursor(token):
+    try:
+        charge_updated, cart_id = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        return str(charge_updated), int(cart_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid history cursor")
+
+def get_order_history_page(start_date=None, end_date=None, payment_method=None, cursor=None, limit=50):
+    """
+    One page of order history, newest first, keyed on (cart_charge_updated, cart_id).
+    Payments are only aggregated for the carts on the page.
+    {'orders': [{'cart_id': 12, 'order_type': 'dine', 'formatted_order_date': '12:30 20-12-2025',
+                 'customer_name': 'Guest', 'payment_info': 'Cash: £12.50', 'total_discounted_amount': 12.5,
+                 'vat_amount': 2.08, 'cart_charge_updated': '2025-12-20 12:30:00'}, ...],
+     'next_cursor': 'WyIyMDI1...' or None}
+    """
+    if bool(start_date) != bool(end_date):
+        raise ValueError("Both start_date and end_date must be provided, or neither")
+
+    conditions = [f"c.cart_status IN ({','.join('?' * len(HISTORY_STATUSES))})"]
+    params = list(HISTORY_STATUSES)
     if start_date and end_date:
-        query += ' AND c.cart_charge_updated BETWEEN ? AND ?'
+        conditions.append("c.cart_charge_updated BETWEEN ? AND ?")
         params.extend([start_date, end_date])
-    elif start_date or end_date:
-        conn.close()
-        raise ValueError("Both start_date and end_date must be provided, or neither")
-    
-    # Add payment method filter if provided
+    if cursor:
+        conditions.append("(c.cart_charge_updated, c.cart_id) < (?, ?)")
+        params.extend(decode_history_cursor(cursor))
     if payment_method is not None:
-        if payment_method == "Cash":
-            query += '''
-                AND c.cart_id IN (
-                    SELECT DISTINCT cart_id 
-                    FROM cart_payments 
-                    WHERE payment_method = ?
-                )
-            '''
-            params.append("Cash")
-        else:
-            query += '''
-                AND c.cart_id IN (
-                    SELECT DISTINCT cart_id 
-                    FROM cart_payments 
-                    WHERE payment_method != 'Cash'
-                )
-            '''
-    
-    # Complete the query
-    query += '''
-            GROUP BY c.cart_id, c.order_type, c.order_menu, c.cart_charge_updated, c.customer_id, cu.customer_name
-            ORDER BY c.cart_charge_updated DESC
-        ) main
-        LEFT JOIN (
+        operator = "=" if payment_method == "Cash" else "!="
+        conditions.append(f"EXISTS (SELECT 1 FROM all_cart_payments p WHERE p.cart_id = c.cart_id AND p.payment_method {operator} 'Cash')")
+
+    # archived carts are included when the range reaches back past the archive horizon
+    conn, db_cursor = archive.history_connection(start_date)
+    try:
+        db_cursor.execute(f'''
+            WITH page AS (
+                SELECT c.cart_id, c.order_type, c.vat_amount, c.cart_charge_updated, c.customer_id
+                FROM all_cart c
+                WHERE {" AND ".join(conditions)}
+                ORDER BY c.cart_charge_updated DESC, c.cart_id DESC
+                LIMIT ?
+            )
             SELECT
-                cart_id,
-                SUM(discounted_total) AS total_discounted_amount
-            FROM cart_payments
-            GROUP BY cart_id
-        ) sub ON main.cart_id = sub.cart_id;
-    '''
-    
-    cursor.execute(query, params)
-    orders = cursor.fetchall()
-    conn.close()
-    return orders
+                page.cart_id,
+                page.order_type,
+                strftime('%H:%M %d-%m-%Y', page.cart_charge_updated) AS formatted_order_date,
+                cu.customer_name,
+                (SELECT GROUP_CONCAT(payment_method || ': £' || printf("%.2f", discounted_total))
+                 FROM all_cart_payments WHERE cart_id = page.cart_id) AS payment_info,
+                (SELECT SUM(discounted_total) FROM all_cart_payments WHERE cart_id = page.cart_id) AS total_discounted_amount,
+                page.vat_amount,
+                page.cart_charge_updated
+            FROM page
+            LEFT JOIN customers cu ON page.customer_id = cu.customer_id
+            ORDER BY page.cart_charge_updated DESC, page.cart_id DESC
+        ''', params + [limit])
+        columns = [col[0] for col in db_cursor.description]
+        orders = [dict(zip(columns, row)) for row in db_cursor.fetchall()]
+    finally:
+        conn.close()
+
+    next_cursor = None
+    if len(orders) == limit:
+        last = orders[-1]
+        next_cursor = encode_history_cursor(last['cart_charge_updated'], last['cart_id'])
+    return {'orders': orders, 'next_cursor': next_cursor}
+
+def iter_order_history(start_date=None, end_date=None, payment_method=None, page_size=500):
+    """Every matching order as a dict, fetched a page at a time."""
+    cursor = None
+    while True:
+        page = get_order_history_page(start_date, end_date, payment_method, cursor, page_size)
+        yield from page['orders']
+        cursor = page['next_cursor']
+        if not cursor:
+            return
+
+def order_history_ndjson(start_date=None, end_date=None, payment_method=None):
+    """NDJSON lines for exports; pass to Response(..., mimetype='application/x-ndjson')."""
+    for order in iter_order_history(start_date, end_date, payment_method):
+        yield json.dumps(order, default=str) + "\n"
+
+def get_order_history(start_date=None, end_date=None, payment_method=None):
+    """All matching orders as tuples, built from pages; prefer get_order_history_page for the UI."""
+    return [
+        (o['cart_id'], o['order_type'], o['formatted_order_date'], o['customer_name'],
+         o['payment_info'], o['total_discounted_amount'], o['vat_amount'])
+        for o in iter_order_history(start_date, end_date, payment_method)
+    ]
 
 def get_payment_info(cart_id):
-    conn, cursor = get_database_connection()
+    conn, cursor = archive.cart_connection(cart_id)
     cursor.execute('''
         SELECT payment_method, discounted_total FROM cart_payments WHERE cart_id = ?
     ''', (cart_id,))
@@ -3566,12 +3218,20 @@ def get_payment_info(cart_id):
 
 def create_refund(cart_id):
     try:
+        # an archived cart comes back to the live tables to be refunded
+        archive.restore_cart(cart_id)
         conn, cursor = get_database_connection()
         employee_id = session.get('employee_id', 0)
         current_timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        cursor.execute("SELECT cart_status FROM cart WHERE cart_id = ?", (cart_id,))
+        previous = cursor.fetchone()
         cursor.execute('''
             UPDATE cart SET cart_status = ?, cart_charge_updated = ?, cart_updated_by = ? WHERE cart_id = ?
         ''', ('refunded', current_timestamp, employee_id, cart_id))
+        customer_profiles.invalidate_cart(cursor, cart_id)
+        # no refund row is written here, so only the order count moves
+        shift_totals.record_refund(cursor, 0, bool(previous) and previous[0] not in shift_totals.REFUNDED_STATUSES,
+                                   current_timestamp, has_refund_row=False)
         # add receipt print
         conn.commit()
         return jsonify({"message": "Refund complete"}), 200
@@ -3597,8 +3257,8 @@ def create_new_product(form_data):
         outprice = form_data.get('outprice')
         category = form_data.get('newCategory')
         barcode = form_data.get('barcode', '')  # Optional field
-        stock_quantity = int(form_data.get('stock_quantity', 0))
-        low_stock_threshold = int(form_data.get('low_stock_threshold', 5))
+        stock_quantity = int(form_data.get('stock_quantity') or 0)
+        low_stock_threshold = int(form_data.get('low_stock_threshold') or 5)
         
         # Validation
         if not outprice:
@@ -3621,6 +3281,10 @@ def create_new_product(form_data):
         
         return {"message": "New product added successfully."}, 200
         
+    except sqlite3.IntegrityError as e:
+        if 'products.barcode' in str(e):
+            return {"error": f"Barcode {barcode} is already used by another product"}, 400
+        return {"error": str(e)}, 500
     except Exception as e:
         return {"error": str(e)}, 500
 
@@ -3654,6 +3318,8 @@ def update_product(product_id, product):
 
         # Extract barcode safely
         barcode = product.get('barcode', None)
+        # the form posts an empty string when the field is cleared
+        stock_quantity = int(product.get('stock_quantity') or 0)
 
         # Base SQL without barcode
         sql = """
@@ -3679,8 +3345,8 @@ def update_product(product_id, product):
             product['is_vatable'],
             int(product['category_id']),
             product.get('track_inventory', 0),
-            int(product.get('stock_quantity', 0)),
-            int(product.get('low_stock_threshold', 5))
+            stock_quantity,
+            int(product.get('low_stock_threshold') or 5)
         ]
 
         # Only update barcode if provided AND not empty
@@ -3692,7 +3358,9 @@ def update_product(product_id, product):
         sql += " WHERE product_id = ?"
         values.append(product_id)
 
+        inventory.record_adjustment(cursor, product_id, stock_quantity, employee_id=session.get('employee_id', 0))
         cursor.execute(sql, tuple(values))
+        menu_push.record(cursor, 'product', [product_id])
         conn.commit()
 
         return jsonify({"message": "Product updated"}), 200
@@ -3704,7 +3372,7 @@ def update_product(product_id, product):
         conn.close()
 
 def get_cart_note(cart_id):
-    conn, cursor = get_database_connection()
+    conn, cursor = archive.cart_connection(cart_id)
     cursor.execute("SELECT overall_note FROM cart WHERE cart_id=?", (cart_id,))
     cart = cursor.fetchone()
     conn.close()
@@ -3717,7 +3385,6 @@ def update_cart_note(cart_id, new_note):
     conn.close()
 
 def fetch_totals(start_date, end_date):
-    conn, cursor = get_database_connection()
     cut_off_hour = get_setting('cut_off_hour')
     if cut_off_hour is None:
         cut_off_hour = set_setting('cut_off_hour', 0)
@@ -3743,22 +3410,36 @@ def fetch_totals(start_date, end_date):
     start_str = effective_start.strftime('%Y-%m-%d %H:%M:%S')
     end_str = effective_end.strftime('%Y-%m-%d %H:%M:%S')
     
+    # paid and refunded come from each cart's ledger row, so a cart with
+    # several payments or several refunds is still counted once
     query = """
+        WITH carts AS (
+            SELECT c.cart_id, c.order_type, c.cart_status, c.vat_amount, l.paid, l.refunded
+            FROM all_cart c
+            JOIN cart_ledger l ON l.cart_id = c.cart_id
+            WHERE c.cart_charge_updated BETWEEN ? AND ?
+              AND c.cart_status IN ('completed', 'refunded', 'partial_refund')
+        ),
+        payments AS (
+            SELECT cp.payment_method, cp.discounted_total
+            FROM all_cart_payments cp
+            JOIN carts ON carts.cart_id = cp.cart_id
+        )
         SELECT
-            SUM(cp.discounted_total) AS grand_total,
-            COUNT(DISTINCT c.cart_id) AS total_orders,
-            COUNT(DISTINCT CASE WHEN c.order_type = 'dine' THEN c.cart_id END) AS dine_count,
-            COUNT(DISTINCT CASE WHEN c.order_type = 'takeaway' THEN c.cart_id END) AS takeaway_count,
-            COUNT(DISTINCT CASE WHEN c.order_type = 'delivery' THEN c.cart_id END) AS delivery_count,
-            COUNT(DISTINCT CASE WHEN c.order_type = 'waiting' THEN c.cart_id END) AS waiting_count,
-            COUNT(DISTINCT CASE WHEN c.order_type = 'sale' THEN c.cart_id END) AS sale_count,
-            SUM(CASE WHEN cp.payment_method LIKE 'Card%' THEN 1 ELSE 0 END) AS card_payments_count,
-            SUM(CASE WHEN cp.payment_method LIKE 'Card%' THEN cp.discounted_total ELSE 0 END) AS card_payments_total,
-            SUM(CASE WHEN cp.payment_method = 'Cash' THEN 1 ELSE 0 END) AS cash_payments_count,
-            SUM(CASE WHEN cp.payment_method = 'Cash' THEN cp.discounted_total ELSE 0 END) AS cash_payments_total,
-            SUM(CASE WHEN c.cart_status IN ('refunded', 'partial_refund') THEN 1 ELSE 0 END) AS refunded_orders_count,
-            COALESCE(SUM(r.amount), 0) AS total_refunds,
-            SUM(c.vat_amount) AS total_vat_amount,
+            SUM(paid) AS grand_total,
+            COUNT(*) AS total_orders,
+            SUM(CASE WHEN order_type = 'dine' THEN 1 ELSE 0 END) AS dine_count,
+            SUM(CASE WHEN order_type = 'takeaway' THEN 1 ELSE 0 END) AS takeaway_count,
+            SUM(CASE WHEN order_type = 'delivery' THEN 1 ELSE 0 END) AS delivery_count,
+            SUM(CASE WHEN order_type = 'waiting' THEN 1 ELSE 0 END) AS waiting_count,
+            SUM(CASE WHEN order_type = 'sale' THEN 1 ELSE 0 END) AS sale_count,
+            (SELECT SUM(CASE WHEN payment_method LIKE 'Card%' THEN 1 ELSE 0 END) FROM payments) AS card_payments_count,
+            (SELECT SUM(CASE WHEN payment_method LIKE 'Card%' THEN discounted_total ELSE 0 END) FROM payments) AS card_payments_total,
+            (SELECT SUM(CASE WHEN payment_method = 'Cash' THEN 1 ELSE 0 END) FROM payments) AS cash_payments_count,
+            (SELECT SUM(CASE WHEN payment_method = 'Cash' THEN discounted_total ELSE 0 END) FROM payments) AS cash_payments_total,
+            SUM(CASE WHEN cart_status IN ('refunded', 'partial_refund') THEN 1 ELSE 0 END) AS refunded_orders_count,
+            COALESCE(SUM(refunded), 0) AS total_refunds,
+            SUM(vat_amount) AS total_vat_amount,
             -- Processing orders (not filtered by date)
             (SELECT COUNT(DISTINCT cart_id) FROM cart WHERE cart_status = 'processing') AS processing_orders_count,
             COALESCE(
@@ -3768,16 +3449,10 @@ def fetch_totals(start_date, end_date):
                 WHERE c2.cart_status = 'processing'),
             0) AS processing_orders_total
         FROM
-            cart c
-        JOIN
-            cart_payments cp ON c.cart_id = cp.cart_id
-        LEFT JOIN
-            refunds r ON c.cart_id = r.cart_id
-        WHERE
-            c.cart_charge_updated BETWEEN ? AND ?
-            AND c.cart_status IN ('completed', 'refunded', 'partial_refund');
+            carts;
             """
     
+    conn, cursor = archive.history_connection(start_str)
     cursor.execute(query, (start_str, end_str))
     result = cursor.fetchone()
 
@@ -3788,13 +3463,13 @@ def get_inventory():
     try:
         conn, cursor = get_database_connection()
         cursor.execute('SELECT product_id, product_name, in_price, out_price, is_hidden FROM products WHERE is_hidden = 1')
-        products = [dict(zip([desc[0] for desc in cursor.description], row)) for row in cursor.fetchall()]
+        products = row_types.dicts(cursor)
 
         cursor.execute('SELECT category_id, category_name, is_hidden FROM category WHERE is_hidden = 1')
-        categories = [dict(zip([desc[0] for desc in cursor.description], row)) for row in cursor.fetchall()]
+        categories = row_types.dicts(cursor)
 
         cursor.execute('SELECT option_id, option_name, is_hidden FROM options WHERE is_hidden = 1')
-        options = [dict(zip([desc[0] for desc in cursor.description], row)) for row in cursor.fetchall()]
+        options = row_types.dicts(cursor)
 
         conn.close()
         inventory_dict = {
@@ -3812,14 +3487,18 @@ def update_inventory_item_by_id(inventory_item_id, type, undo):
         if type == 'p':
             cursor.execute("UPDATE products SET is_hidden = ? WHERE product_id = ?",
                         (undo, inventory_item_id))
+            menu_push.record(cursor, 'product', [inventory_item_id])
         elif type == 'c':
             cursor.execute("UPDATE category SET is_hidden = ? WHERE category_id = ?",
                         (undo, inventory_item_id))
+            cursor.execute("SELECT product_id FROM products WHERE category_id = ?", (inventory_item_id,))
+            menu_push.record(cursor, 'product', [row[0] for row in cursor.fetchall()])
         elif type == 'o':
             cursor.execute("UPDATE options SET is_hidden = ? WHERE option_id = ?",
                         (undo, inventory_item_id))
             cursor.execute("UPDATE product_options SET is_hidden = ? WHERE option_id = ?",
                         (undo, inventory_item_id))
+            menu_push.record(cursor, 'option_group', [inventory_item_id])
         conn.commit()
         return jsonify({"message": "inventory item updated"}), 200
     except Exception as e:
@@ -3832,6 +3511,7 @@ def delete_dining_table_by_id(table_id):
         conn, cursor = get_database_connection()
         cursor.execute("DELETE FROM dining_tables WHERE table_id = ?", (table_id, ))
         conn.commit()
+        floor_state.mark_changed('layout')
         return get_dining_tables(), 200
     except Exception as e:
         return f"Error deleting table: {e}"
@@ -3854,12 +3534,16 @@ def update_delete_save_option_item(data):
             cursor.execute("UPDATE option_items SET option_item_name = ? WHERE option_item_id = ?", (option_name, item_id))
 
             cursor.execute("UPDATE option_item_groups SET option_item_in_price = ?, option_item_out_price = ?, vatable = ? WHERE option_item_id = ? AND option_id = ?", (in_price, out_price, vatable, item_id, option_id))
+            menu_push.record(cursor, 'option', [item_id], option_id)
 
             conn.commit()
             return jsonify({'message': 'Update successful'})
 
         elif method == 'delete':
             cursor.execute("UPDATE option_item_groups SET is_hidden = 1 WHERE option_item_id = ?", (item_id, ))
+            cursor.execute("SELECT option_id FROM option_item_groups WHERE option_item_id = ?", (item_id, ))
+            for (group_id,) in cursor.fetchall():
+                menu_push.record(cursor, 'option', [item_id], group_id)
             conn.commit()
             return jsonify({'message': 'Delete successful'})
         
@@ -4016,15 +3700,13 @@ def add_option_items_bulk(options):
 
 def reorder_option_items(option_id, items):
     """Update the order of option items within a group."""
+    conn = None
     try:
         conn, cursor = get_database_connection()
         
-        for item in items:
-            cursor.execute('''
-                UPDATE option_item_groups 
-                SET option_item_group_order = ? 
-                WHERE option_id = ? AND option_item_id = ?
-            ''', (item['option_order'], option_id, item['option_item_id']))
+        ids = [int(item['option_item_id']) for item in sorted(items, key=lambda i: float(i['option_order']))]
+        ordering.save(cursor, 'option_item_groups', 'option_item_id', 'option_item_group_order', ids,
+                      scope={'option_id': option_id})
         
         conn.commit()
         return {'success': True}
@@ -4038,7 +3720,7 @@ def reorder_option_items(option_id, items):
 def get_refunded_orders(start_date, end_date):
     conn = None
     try:
-        conn, cursor = get_database_connection()
+        conn, cursor = archive.history_connection(start_date)
         sql_query = """
         SELECT 
             c.order_type, 
@@ -4046,15 +3728,17 @@ def get_refunded_orders(start_date, end_date):
             c.cart_status, 
             strftime('%H:%M %d-%m-%Y', c.cart_charge_updated) AS formatted_charge_date, 
             cu.customer_name, 
-            cp.payment_method, 
-            cp.discounted_total,
+            (SELECT group_concat(payment_method, ', ') FROM all_cart_payments WHERE cart_id = c.cart_id) AS payment_method, 
+            l.paid AS discounted_total,
+            l.refunded,
+            l.balance,
             e.name
         FROM 
-            cart c
+            all_cart c
         JOIN 
             customers cu ON c.customer_id = cu.customer_id
         JOIN 
-            cart_payments cp ON c.cart_id = cp.cart_id
+            cart_ledger l ON c.cart_id = l.cart_id
         JOIN 
             employees e ON c.cart_updated_by = e.employee_id
         WHERE 
@@ -4063,7 +3747,7 @@ def get_refunded_orders(start_date, end_date):
         """
         cursor.execute(sql_query, (start_date, end_date))
         result = cursor.fetchall()
-        refunds = [dict(zip([desc[0] for desc in cursor.description], row)) for row in result]
+        refunds = row_types.dicts(cursor, result)
         return refunds
     except sqlite3.Error as e:
         print("Error executing SQL query:", e)
@@ -4103,10 +3787,13 @@ def save_bulk_products(products, in_prices, out_prices, category_id):
                 out_prices[i] = in_prices[i]
         
         conn, cursor = get_database_connection()
+        new_ids = []
         for product_name, in_price, out_price in zip(products, in_prices, out_prices):
             product_name = product_name.capitalize()
             cursor.execute("INSERT INTO products (category_id, product_name, in_price, out_price, cpn) VALUES (?, ?, ?, ?, 1)",
                            (category_id, product_name, in_price, out_price))
+            new_ids.append(cursor.lastrowid)
+        menu_push.record(cursor, 'product', new_ids)
         conn.commit()
         conn.close()
 
@@ -4157,7 +3844,7 @@ def get_terminals_from_db():
         conn, cursor = get_database_connection()
         cursor.execute("SELECT * FROM card_terminals")
         result = cursor.fetchall()
-        terminals = [dict(zip([desc[0] for desc in cursor.description], row)) for row in result]
+        terminals = row_types.dicts(cursor, result)
         return terminals
     except sqlite3.Error as e:
         print("Error all terminals query:", e)
@@ -4279,9 +3966,14 @@ def delete_cart_data(cart_id):
         conn, cursor = get_database_connection()
         conn.execute('BEGIN TRANSACTION')
         
+        shift_totals.void_cart(cursor, cart_id)
+        cart_ledger.remove(cursor, cart_id)
+        customer_profiles.invalidate_cart(cursor, cart_id)
         cursor.execute('DELETE FROM cart WHERE cart_id = ?', (cart_id,))
         cursor.execute('DELETE FROM cart_item WHERE cart_id = ?', (cart_id,))
         cursor.execute('DELETE FROM cart_payments WHERE cart_id = ?', (cart_id,))
+        inventory.release_cart(cursor, cart_id)
+        sync_outbox.record(cursor, cart_id, 'deleted')
 
         conn.commit()
         response = {'success': True, 'message': 'Cart data deleted successfully'}
@@ -4307,7 +3999,7 @@ def get_customers():
         """
         cursor.execute(sql_query)
         result = cursor.fetchall()
-        customers = [dict(zip([desc[0] for desc in cursor.description], row)) for row in result]
+        customers = row_types.dicts(cursor, result)
         return customers
     except sqlite3.Error as e:
         print("Error executing customers SQL query:", e)
@@ -4318,6 +4010,7 @@ def get_customers():
 
 # all option names and products for adding to new option group
 def get_all_option_templates():
+    """Whole catalogue at once; the option editor pages through option_index.search_option_templates instead."""
     conn = None
     cursor = None
     try:
@@ -4325,21 +4018,8 @@ def get_all_option_templates():
         if not conn or not cursor:
             raise Exception("Failed to get database connection.")
 
-        # Fetch option items
-        sql_query = """
-            SELECT DISTINCT oi.option_item_id, 
-                option_item_name, 
-                option_item_in_price, 
-                option_item_out_price, 
-                o.option_name 
-            FROM option_items oi
-            LEFT JOIN option_item_groups oig ON oi.option_item_id = oig.option_item_id
-            LEFT JOIN options o ON o.option_id = oig.option_id
-            WHERE o.is_hidden = 0
-            ORDER BY oi.option_item_name;
-        """
-        cursor.execute(sql_query)
-        option_items = [dict(zip([desc[0] for desc in cursor.description], row)) for row in cursor.fetchall()]
+        # Option items from the maintained template index
+        option_items = option_index.all_option_items()
 
         # Fetch product items
         sql_query = """
@@ -4349,7 +4029,7 @@ def get_all_option_templates():
             ORDER BY product_name
         """
         cursor.execute(sql_query)
-        product_items = [dict(zip([desc[0] for desc in cursor.description], row)) for row in cursor.fetchall()]
+        product_items = row_types.dicts(cursor)
 
         # Organize option_items by option_name
         grouped_option_items = defaultdict(list)
@@ -4372,46 +4052,16 @@ def get_all_option_templates():
         if conn:
             conn.close()  # Close the connection
 
-def delete_customer(customer_id):
+def delete_customer(customer_id, mode='delete'):
+    """
+    Queue removal of a customer with their carts, items, payments, refunds,
+    kitchen and table rows, archived ones included; mode 'anonymise' keeps
+    the orders and scrubs the customer instead. Progress via retention.job_status.
+    """
     try:
-        conn, cursor = get_database_connection()
-        conn.execute("BEGIN")
-
-        cursor.execute(
-            "SELECT cart_id FROM cart WHERE customer_id = ?",
-            (customer_id,)
-        )
-        cart_ids = cursor.fetchall()
-
-        if cart_ids:
-            cart_ids_tuple = tuple([cart_id[0] for cart_id in cart_ids])  # Convert to tuple
-            cursor.execute(
-                "DELETE FROM cart_item WHERE cart_id IN ({seq})".format(
-                    seq=','.join(['?'] * len(cart_ids_tuple))
-                ),
-                cart_ids_tuple
-            )
-
-        cursor.execute(
-            "DELETE FROM customer_addresses WHERE customer_id = ?",
-            (customer_id,)
-        )
-
-        cursor.execute(
-            "DELETE FROM cart WHERE customer_id = ?",
-            (customer_id,)
-        )
-
-        cursor.execute(
-            "DELETE FROM customers WHERE customer_id = ?",
-            (customer_id,)
-        )
-        conn.commit()
-        conn.close()
-        return jsonify({"message": "All customer data successfully deleted"}), 200
-
+        job_id = retention.queue_customer(customer_id, mode)
+        return jsonify({"message": "Customer deletion started", "job_id": job_id}), 202
     except Exception as e:
-        conn.rollback()
         return jsonify({"error": str(e)}), 500
     
 def get_recent_orders_for_pos():
@@ -4437,7 +4087,7 @@ def get_recent_orders_for_pos():
         """
         cursor.execute(sql_query)
         result = cursor.fetchall()
-        orders = [dict(zip([desc[0] for desc in cursor.description], row)) for row in result]
+        orders = row_types.dicts(cursor, result)
         return orders
     except sqlite3.Error as e:
         print("Error executing orders SQL query:", e)
@@ -4520,9 +4170,8 @@ def get_setting_str(key, default=''):
 
 # recent orders for remote sync
 def get_recent_orders():
-    """Fetch orders updated in the last 15 minutes"""
+    """Carts flagged pending for the legacy sync; sync_outbox ships changes incrementally."""
     conn = None
-    minutes_ago = datetime.now(timezone.utc) - timedelta(minutes=15)
     try:
         conn, cursor = get_database_connection()
         cursor.execute("""
@@ -4533,32 +4182,26 @@ def get_recent_orders():
                 c.cart_discount, 
                 c.vat_amount,
                 c.cart_discount_type, 
-                COALESCE((
-                    SELECT SUM(
+                COALESCE(t.total_amount, 0) AS total_amount,
+                COALESCE(t.item_count, 0) AS item_count
+            FROM cart c
+            LEFT JOIN (
+                SELECT ci.cart_id,
+                    SUM(
                         CASE 
                             WHEN ci.product_discount_type = 'percentage' THEN 
                                 (ci.price * ci.quantity) * (1 - ci.product_discount/100)
                             ELSE 
                                 (ci.price * ci.quantity) - ci.product_discount
                         END
-                    ) 
-                    FROM cart_item ci 
-                    WHERE ci.cart_id = c.cart_id
-                ), 0) AS total_amount,
-                (SELECT COUNT(*) FROM cart_item WHERE cart_id = c.cart_id) AS item_count
-            FROM cart c
+                    ) AS total_amount,
+                    COUNT(*) AS item_count
+                FROM cart_item ci
+                JOIN cart p ON p.cart_id = ci.cart_id AND p.sync_status = 'pending'
+                GROUP BY ci.cart_id
+            ) t ON t.cart_id = c.cart_id
             WHERE c.sync_status = 'pending'
-            GROUP BY c.cart_id
         """)
-        # cursor.execute("""
-        #     SELECT c.cart_id, c.order_date, c.cart_status, c.cart_discount, c.vat_amount,
-        #         SUM(ci.price * ci.quantity - ci.product_discount) AS total_amount,
-        #         COUNT(ci.cart_id) AS item_count
-        #     FROM cart c
-        #     LEFT JOIN cart_item ci ON c.cart_id = ci.cart_id
-        #     WHERE c.sync_status = 'pending'
-        #     GROUP BY c.cart_id
-        # """)
         orders = cursor.fetchall()
         return orders
     except sqlite3.Error as e:
@@ -4590,7 +4233,10 @@ def update_sync_status(cart_ids, status):
 
     conn, cursor = get_database_connection()
     try:
-        cursor.executemany("UPDATE cart SET sync_status = ? WHERE cart_id = ?", [(status, cid) for cid in cart_ids])
+        cursor.execute(
+            "UPDATE cart SET sync_status = ? WHERE cart_id IN (SELECT value FROM json_each(?))",
+            (status, json.dumps([int(cid) for cid in cart_ids]))
+        )
         conn.commit()
     except Exception as e:
         print(f"Error updating sync status: {e}")
@@ -4794,7 +4440,7 @@ def get_kitchen_screen_orders(status=None):
         
         # Convert to list of dictionaries
         if orders:
-            orders = [dict(zip([desc[0] for desc in cursor.description], row)) for row in orders]
+            orders = row_types.dicts(cursor, orders)
             return orders
         else:
             return []
@@ -4982,10 +4628,6 @@ def end_day_carts():
                 c.customer_id,
                 COUNT(ci.cart_id) AS cart_item_count,
                 cu.customer_name,
-                CASE 
-                    WHEN c.order_type = "dine" THEN (SELECT table_number FROM dining_tables d WHERE table_occupied = c.cart_id)
-                    ELSE NULL
-                END AS table_number,
                 SUM(ci.price) AS cart_total,
                 e.name
             FROM cart c
@@ -4999,7 +4641,12 @@ def end_day_carts():
 
         columns = [col[0] for col in cursor.description]  # Get column names
         results = [dict(zip(columns, row)) for row in cursor.fetchall()]  # Convert to list of dictionaries
+        table_displays = floor_state.table_displays()
         for cart in results:
+            # table_number stays the bare number; the formatted label goes in table_display
+            tables = floor_state.cart_tables(cart["cart_id"]) if cart["order_type"] == "dine" else None
+            cart["table_number"] = tables[0]["table_number"] if tables else None
+            cart["table_display"] = table_displays.get(cart["cart_id"]) if cart["order_type"] == "dine" else None
             if cart["order_date"]:
                 cart["order_date"] = datetime.strptime(cart["order_date"], "%Y-%m-%d %H:%M:%S").strftime("%d %b, %I:%M %p")
         return jsonify(results) if results else jsonify([])
@@ -5056,205 +4703,11 @@ def sales_analytics(start_date=None, end_date=None):
     if not end_date:
         end_date = today.strftime('%Y-%m-%d')
 
-    conn, cursor = get_database_connection()
     try:
-        # 1. Most Popular Products
-        popular_products = cursor.execute('''
-            SELECT 
-                ci.product_id,
-                ci.product_name,
-                SUM(ci.quantity) AS total_quantity_sold,
-                COUNT(DISTINCT c.cart_id) AS number_of_orders,
-                SUM(ci.quantity * ci.price) AS total_revenue
-            FROM 
-                cart_item ci
-            JOIN 
-                cart c ON ci.cart_id = c.cart_id
-            WHERE 
-                c.cart_status = 'completed'
-                AND DATE(c.order_date) BETWEEN ? AND ?
-            GROUP BY 
-                ci.product_id, ci.product_name
-            ORDER BY 
-                total_quantity_sold DESC
-            LIMIT 20
-        ''', (start_date, end_date)).fetchall()
-        popular_products_dicts = [dict(zip([col[0] for col in cursor.description], row)) for row in popular_products]
-        # 2. Revenue by Product (with discounts)
-        product_revenue = cursor.execute('''
-            SELECT 
-                ci.product_id,
-                ci.product_name,
-                SUM(ci.quantity * (ci.price - 
-                    CASE WHEN ci.product_discount_type = 'fixed' THEN ci.product_discount 
-                         WHEN ci.product_discount_type = 'percentage' THEN ci.price * (ci.product_discount/100)
-                         ELSE 0 END)) AS net_revenue
-            FROM 
-                cart_item ci
-            JOIN 
-                cart c ON ci.cart_id = c.cart_id
-            WHERE 
-                c.cart_status = 'completed'
-                AND DATE(c.order_date) BETWEEN ? AND ?
-            GROUP BY 
-                ci.product_id, ci.product_name
-            ORDER BY 
-                net_revenue DESC
-            LIMIT 20
-        ''', (start_date, end_date)).fetchall()
-        product_revenue_dicts = [dict(zip([col[0] for col in cursor.description], row)) for row in product_revenue]
-        
-        # 3. Sales Trends
-        sales_trends = cursor.execute('''
-            SELECT 
-                DATE(c.order_date) AS sale_date,
-                SUM(ci.quantity * ci.price) AS daily_revenue,
-                COUNT(DISTINCT c.cart_id) AS orders_count
-            FROM 
-                cart c
-            JOIN 
-                cart_item ci ON c.cart_id = ci.cart_id
-            WHERE 
-                c.cart_status = 'completed'
-                AND DATE(c.order_date) BETWEEN ? AND ?
-            GROUP BY 
-                DATE(c.order_date)
-            ORDER BY 
-                sale_date
-        ''', (start_date, end_date)).fetchall()
-        sales_trends_dicts = [dict(zip([col[0] for col in cursor.description], row)) for row in sales_trends]
-        
-        # 4. Average Order Value
-        avg_order_value = cursor.execute('''
-            SELECT 
-                AVG(order_total) AS avg_order_value
-            FROM (
-                SELECT 
-                    c.cart_id,
-                    SUM(ci.quantity * ci.price) AS order_total
-                FROM 
-                    cart c
-                JOIN 
-                    cart_item ci ON c.cart_id = ci.cart_id
-                WHERE 
-                    c.cart_status = 'completed'
-                    AND DATE(c.order_date) BETWEEN ? AND ?
-                GROUP BY 
-                    c.cart_id
-            )
-        ''', (start_date, end_date)).fetchone()[0] or 0
-        
-        # 5. Discount Usage
-        discount_usage = discount_usage = cursor.execute('''
-            WITH cart_summary AS (
-                    SELECT 
-                        c.cart_id,
-                        c.cart_discount_type,
-                        c.cart_discount,
-                        SUM(ci.quantity * ci.price) AS cart_subtotal,
-                        CASE
-                            WHEN c.cart_discount_type = 'percentage' AND c.cart_discount > 0 
-                            THEN ROUND(SUM(ci.quantity * ci.price) * (c.cart_discount/100.0), 2)
-                            WHEN c.cart_discount_type = 'fixed' AND c.cart_discount > 0
-                            THEN ROUND(c.cart_discount, 2)
-                            ELSE 0
-                        END AS calculated_discount
-                    FROM cart c
-                    JOIN cart_item ci ON c.cart_id = ci.cart_id
-                    WHERE c.cart_status = 'completed'
-                    AND DATE(c.order_date) BETWEEN ? AND ?
-                    GROUP BY c.cart_id
-                )
-                SELECT 
-                    cart_discount_type,
-                    COUNT(DISTINCT cart_id) AS order_count,
-                    AVG(calculated_discount) AS avg_discount_amount,
-                    SUM(cart_subtotal) AS gross_sales,
-                    SUM(calculated_discount) AS total_discounts_applied,
-                    SUM(cart_subtotal - calculated_discount) AS net_sales
-                FROM cart_summary
-                GROUP BY cart_discount_type
-                HAVING SUM(calculated_discount) > 0
-                ORDER BY total_discounts_applied DESC
-        ''', (start_date, end_date)).fetchall()
-        discount_usage_dicts = [dict(zip([col[0] for col in cursor.description], row)) for row in discount_usage]
-        
-        # 6. Products Bought Together
-        products_together = cursor.execute('''
-            SELECT 
-                a.product_id AS product1_id,
-                a.product_name AS product1_name,
-                b.product_id AS product2_id,
-                b.product_name AS product2_name,
-                COUNT(*) AS times_bought_together
-            FROM 
-                cart_item a
-            JOIN 
-                cart_item b ON a.cart_id = b.cart_id AND a.product_id < b.product_id
-            JOIN 
-                cart c ON a.cart_id = c.cart_id
-            WHERE 
-                c.cart_status = 'completed'
-                AND DATE(c.order_date) BETWEEN ? AND ?
-            GROUP BY 
-                a.product_id, a.product_name, b.product_id, b.product_name
-            ORDER BY 
-                times_bought_together DESC
-            LIMIT 10
-        ''', (start_date, end_date)).fetchall()
-        products_together_dicts = [dict(zip([col[0] for col in cursor.description], row)) for row in products_together]
-        
-        refunds = list(cursor.execute('''
-            SELECT 
-                COUNT(*) as refund_count,
-                SUM(amount) as total_refunded,
-                AVG(amount) as avg_refund,
-                (
-                    SELECT json_group_array(json_object(
-                        'refund_date', timestamp,
-                        'order_id', cart_id,
-                        'amount', amount
-                    ))
-                    FROM refunds
-                    ORDER BY timestamp DESC
-                    LIMIT 10
-                ) as details
-            FROM refunds
-            WHERE timestamp BETWEEN ? AND ?
-        ''', (start_date, end_date)).fetchone())
-
-        # Safely load JSON details
-        refunds[3] = json.loads(refunds[3]) if refunds[3] else []
-        refunds = {
-            "refund_count": refunds[0],
-            "total_refunded": refunds[1],
-            "avg_refund": refunds[2],
-            "details": refunds[3]
-        }
-
-        # Convert rows to dictionaries for JSON serialization
-        result = {
-            "date_range": {
-                "start_date": start_date,
-                "end_date": end_date
-            },
-            "popular_products": popular_products_dicts,
-            "product_revenue": product_revenue_dicts,
-            "sales_trends": sales_trends_dicts,
-            "average_order_value": avg_order_value,
-            "discount_usage": discount_usage_dicts,
-            "products_bought_together": products_together_dicts,
-            "refunds": refunds
-        }
-
-        return result
-    
+        return analytics.sales_analytics(start_date, end_date)
     except Exception as e:
         print(f"Error in sales_analytics: {str(e)}")
         return str(e)
-    
-    finally:
-        conn.close()
 
 def create_refunds_table():
     try:
@@ -5275,10 +4728,9 @@ def create_refunds_table():
         return jsonify({"error": f"Error creating refunds table: {str(e)}"}), 500
     
 def get_refunds_by_cart_id(cart_id):
+    conn = None
     try:
-        conn, cursor = get_database_connection()
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        conn, cursor = archive.cart_connection(cart_id)
 
         # Fetch all refunds
         cursor.execute("""
@@ -5287,28 +4739,15 @@ def get_refunds_by_cart_id(cart_id):
             WHERE cart_id = ?
             ORDER BY timestamp ASC
         """, (cart_id,))
-        refunds = [dict(row) for row in cursor.fetchall()]
-
-        # Total refunded amount
-        cursor.execute("""
-            SELECT COALESCE(SUM(amount), 0) AS total_refunded
-            FROM refunds
-            WHERE cart_id = ?
-        """, (cart_id,))
-        total_refunded = float(cursor.fetchone()["total_refunded"])
-
-        # Total initial payment (from cart_payments)
-        cursor.execute("""
-            SELECT COALESCE(SUM(discounted_total), 0) AS initial_paid
-            FROM cart_payments
-            WHERE cart_id = ?
-        """, (cart_id,))
-        initial_paid = float(cursor.fetchone()["initial_paid"])
+        refunds = row_types.dicts(cursor)
 
+        # Paid and refunded so far, from the cart's ledger row
+        ledger = cart_ledger.get(cursor, cart_id)
         return {
             "refunds": refunds,
-            "total_refunded": total_refunded,
-            "initial_paid": initial_paid
+            "total_refunded": ledger['refunded'],
+            "initial_paid": ledger['paid'],
+            "balance": ledger['balance']
         }
 
     except Exception as e:
@@ -5316,7 +4755,8 @@ def get_refunds_by_cart_id(cart_id):
         return {
             "refunds": [],
             "total_refunded": 0.0,
-            "initial_paid": 0.0
+            "initial_paid": 0.0,
+            "balance": 0.0
         }
 
     finally:
@@ -5324,10 +4764,14 @@ def get_refunds_by_cart_id(cart_id):
             conn.close()
 
 def process_refund(cart_id, amount, payment_type):
+    conn = None
     try:
+        # an archived cart comes back to the live tables to be refunded
+        archive.restore_cart(cart_id)
         conn, cursor = get_database_connection()
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+
+        cursor.execute("SELECT cart_status FROM cart WHERE cart_id = ?", (cart_id,))
+        previous = cursor.fetchone()
 
         # Insert refund
         cursor.execute("""
@@ -5335,33 +4779,25 @@ def process_refund(cart_id, amount, payment_type):
             VALUES (?, ?, ?)
         """, (cart_id, payment_type, amount))
 
-        # Get total refunded
-        cursor.execute("SELECT COALESCE(SUM(amount), 0) AS total_refunded FROM refunds WHERE cart_id = ?", (cart_id,))
-        total_refunded = float(cursor.fetchone()["total_refunded"])
-
-        # Get total initial paid
-        cursor.execute("SELECT COALESCE(SUM(discounted_total), 0) AS initial_paid FROM cart_payments WHERE cart_id = ?", (cart_id,))
-        initial_paid = float(cursor.fetchone()["initial_paid"])
-
-        # Decide on new status
-        if total_refunded >= initial_paid:
-            new_status = 'refunded'
-        elif total_refunded > 0:
-            new_status = 'partial_refund'
-        else:
-            new_status = None  # Leave as is
+        # Running totals come back from the ledger update; no re-summing
+        ledger = cart_ledger.record_refund(cursor, cart_id, float(amount))
+        new_status = cart_ledger.status_for(ledger)
 
         # Only update if we have a new status
         if new_status:
             now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             cursor.execute("UPDATE cart SET cart_status = ?, cart_charge_updated = ? WHERE cart_id = ?", (new_status, now, cart_id))
 
+        customer_profiles.invalidate_cart(cursor, cart_id)
+        shift_totals.record_refund(cursor, float(amount), bool(previous) and previous[0] not in shift_totals.REFUNDED_STATUSES)
+        sync_outbox.record(cursor, cart_id, 'refund')
         conn.commit()
         return {
             "success": True,
             "refunded": amount,
-            "total_refunded": total_refunded,
-            "initial_paid": initial_paid,
+            "total_refunded": ledger['refunded'],
+            "initial_paid": ledger['paid'],
+            "balance": ledger['balance'],
             "new_status": new_status
         }
 
@@ -5477,6 +4913,7 @@ def update_order_type(cart_id, new_type):
             cursor.execute("UPDATE cart SET vat_amount = ? WHERE cart_id = ?", (vat_amount, cart_id))
         
         conn.commit()
+        floor_state.mark_changed('order_type')
         return True
         
     except Exception as e:
@@ -5519,7 +4956,7 @@ def get_delivery_rules():
         
         # Convert to list of dictionaries
         if rules:
-            rules = [dict(zip([desc[0] for desc in cursor.description], row)) for row in rules]
+            rules = row_types.dicts(cursor, rules)
             return rules
         else:
             return []
@@ -5871,6 +5308,7 @@ def update_option_items(data):
             conn.close()
 
 def add_caller_id(caller_id, line, time_stamp):
+    conn = None
     try:
         conn, cursor = get_database_connection()        
         cursor.execute("""
@@ -5878,6 +5316,8 @@ def add_caller_id(caller_id, line, time_stamp):
                 VALUES (?, ?, ?)
             """, (caller_id, line, time_stamp))
         conn.commit()
+        # warm the lookup cache so the screen pop is ready before it's asked for
+        caller_lookup.lookup(caller_id)
         return True
     except sqlite3.Error as e:
         print(f"Error saving option group: {e}")
@@ -5888,58 +5328,21 @@ def add_caller_id(caller_id, line, time_stamp):
 
 def get_address_by_caller_id(phone_number):
     try:
-        conn, cursor = get_database_connection()
-
-        query = """
-            SELECT 
-                a.address_id, a.address, a.postcode, a.distance,
-                c.customer_id, c.customer_name, c.customer_telephone
-            FROM customers c
-            LEFT JOIN customer_addresses a ON c.customer_id = a.customer_id
-            WHERE c.customer_telephone = ?
-        """
-        cursor.execute(query, (phone_number,))
-        rows = cursor.fetchall()
-
-        # Convert to list of dicts using cursor.description
-        columns = [col[0] for col in cursor.description]
-        results = [dict(zip(columns, row)) for row in rows]
-
-        return results
-
+        return caller_lookup.lookup(phone_number)
     except sqlite3.Error as e:
         print(f"Error getting caller data: {e}")
         return []
 
-    finally:
-        if conn:
-            conn.close()
-
 def get_customer_name_by_number(phone_number):
     try:
-        conn, cursor = get_database_connection()
-
-        query = """
-            SELECT customer_name
-            FROM customers
-            WHERE customer_telephone = ?
-            LIMIT 1
-        """
-        cursor.execute(query, (phone_number,))
-        row = cursor.fetchone()
-
-        if row:
-            return row[0]  # customer_name
+        results = caller_lookup.lookup(phone_number)
+        if results:
+            return results[0]['customer_name']
         return None
-
     except sqlite3.Error as e:
         print(f"Error getting customer name: {e}")
         return None
 
-    finally:
-        if conn:
-            conn.close()
-
 def update_products_order_colour(data):
     if not data or 'products' not in data or 'category_id' not in data:
         return jsonify({'error': 'Invalid data'}), 400
@@ -5951,21 +5354,11 @@ def update_products_order_colour(data):
     try:
         conn, cursor = get_database_connection()
 
-        # Begin transaction explicitly
-        conn.execute('BEGIN')
-
-        for order_index, product in enumerate(products):
-            product_id = int(product['product_id'])
-            color = product.get('color', '') or None  # Treat empty string as NULL
-
-            cursor.execute(
-                '''
-                UPDATE products
-                SET product_order = ?, product_colour = ?
-                WHERE product_id = ? AND category_id = ?
-                ''',
-                (order_index, color, product_id, category_id)
-            )
+        ids = [int(product['product_id']) for product in products]
+        # Treat empty string as NULL
+        colours = {int(product['product_id']): {'product_colour': product.get('color', '') or None} for product in products}
+        ordering.save(cursor, 'products', 'product_id', 'product_order', ids,
+                      scope={'category_id': category_id}, values=colours)
 
         conn.commit()
         return jsonify({'success': True}), 200
@@ -5987,18 +5380,14 @@ def update_options_order_colour(data):
     if not option_id or not isinstance(options, list):
         return jsonify({'error': 'Invalid input'}), 400
 
+    conn = None
     try:
         conn, cursor = get_database_connection()
 
-        for order_index, item in enumerate(options):
-            option_item_id = item.get('option_item_id')
-            color = item.get('color', '')
-
-            cursor.execute("""
-                UPDATE option_item_groups
-                SET option_item_group_order = ?, option_item_colour = ?
-                WHERE option_id = ? AND option_item_id = ?
-            """, (order_index, color, option_id, option_item_id))
+        ids = [int(item.get('option_item_id')) for item in options]
+        colours = {int(item.get('option_item_id')): {'option_item_colour': item.get('color', '')} for item in options}
+        ordering.save(cursor, 'option_item_groups', 'option_item_id', 'option_item_group_order', ids,
+                      scope={'option_id': option_id}, values=colours)
 
         conn.commit()
         return jsonify({'success': True})
@@ -0,0 +1,187 @@
+import threading, time, queue
+from collections import deque
+from . import database
+
+# Safety net for writes that bypass refresh(); the map is reloaded at most this stale
+MAX_AGE = 30
+# Events kept for clients reconnecting with Last-Event-ID
+EVENT_BACKLOG = 200
+
+_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+_tables = []       # every table, in floor order
+_by_cart = {}      # cart_id -> [table, ...] for open carts
+_version = 0
+_loaded_at = 0
+_initialised = False
+_events = deque(maxlen=EVENT_BACKLOG)
+_subscribers = set()
+
+class Subscriber:
+    """Per-connection event queue; overflowed is set if the client falls behind."""
+    def __init__(self, maxsize=100):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+def _load():
+    conn = None
+    try:
+        conn, cursor = database.get_database_connection()
+        cursor.execute('''
+            SELECT
+                dt.table_id,
+                dt.table_number,
+                dt.room_id,
+                COALESCE(dr.room_label, '') AS room_label,
+                COALESCE(dr.room_order, 999) AS room_order,
+                COALESCE(dt.table_occupied, 0) AS cart_id,
+                COALESCE(cdt.table_cover, 0) AS cover
+            FROM dining_tables dt
+            LEFT JOIN dining_rooms dr ON dt.room_id = dr.room_id
+            LEFT JOIN cart_dining_tables cdt
+                ON cdt.cart_id = dt.table_occupied
+                AND (cdt.table_id = dt.table_id OR (cdt.table_id IS NULL AND cdt.table_number = dt.table_number))
+            GROUP BY dt.table_id
+            ORDER BY dr.room_order, dr.room_label, CAST(dt.table_number AS INTEGER)
+        ''')
+        columns = [col[0] for col in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    finally:
+        if conn:
+            conn.close()
+
+def refresh(reason='update'):
+    """Reload the map after a committed table change and publish what moved. Returns the version."""
+    global _tables, _by_cart, _version, _loaded_at, _initialised
+    # serialised so an older load can't overwrite a newer one
+    with _refresh_lock:
+        tables = _load()
+        by_cart = {}
+        for table in tables:
+            if table['cart_id']:
+                by_cart.setdefault(table['cart_id'], []).append(table)
+        with _lock:
+            changes = _diff(_tables, tables)
+            _tables, _by_cart = tables, by_cart
+            _loaded_at = time.monotonic()
+            if not _initialised or changes == []:
+                _initialised = True
+                return _version
+            _version += 1
+            event = {
+                'version': _version,
+                'type': 'layout' if changes is None else 'tables',
+                'reason': reason,
+                'changes': changes or []
+            }
+            _events.append(event)
+            for subscriber in list(_subscribers):
+                try:
+                    subscriber.queue.put_nowait(event)
+                except queue.Full:
+                    subscriber.overflowed = True
+            return _version
+
+def _diff(old, new):
+    """
+    Per-table changes between two loads, or None when tables or rooms changed
+    and clients should take a fresh snapshot instead.
+    [{'table_id': 3, 'table_number': '3', 'change': 'occupied', 'cart_id': 41, 'from_cart_id': 0, 'cover': 2}]
+    """
+    old_by_id = {t['table_id']: t for t in old}
+    if set(old_by_id) != {t['table_id'] for t in new}:
+        return None
+    changes = []
+    for table in new:
+        before = old_by_id[table['table_id']]
+        if (before['table_number'], before['room_id'], before['room_label'], before['room_order']) != \
+                (table['table_number'], table['room_id'], table['room_label'], table['room_order']):
+            return None
+        if before['cart_id'] != table['cart_id']:
+            if not before['cart_id']:
+                change = 'occupied'
+            elif not table['cart_id']:
+                change = 'released'
+            else:
+                change = 'moved'
+        elif before['cover'] != table['cover']:
+            change = 'cover'
+        else:
+            continue
+        changes.append({
+            'table_id': table['table_id'],
+            'table_number': table['table_number'],
+            'change': change,
+            'cart_id': table['cart_id'],
+            'from_cart_id': before['cart_id'],
+            'cover': table['cover']
+        })
+    return changes
+
+def _ensure_loaded():
+    if time.monotonic() - _loaded_at > MAX_AGE or not _loaded_at:
+        refresh()
+
+def snapshot():
+    """
+    Whole floor in one read.
+    {'version': 12, 'tables': [{'table_id': 1, 'table_number': '1', 'room_id': 1,
+      'room_label': 'Main', 'room_order': 0, 'cart_id': 0, 'cover': 0}, ...]}
+    """
+    _ensure_loaded()
+    with _lock:
+        return {'version': _version, 'tables': [dict(t) for t in _tables]}
+
+def cart_tables(cart_id):
+    """Tables held by an open cart, in get_cart_tables() shape, or None if it holds none."""
+    _ensure_loaded()
+    with _lock:
+        tables = _by_cart.get(int(cart_id))
+        if not tables:
+            return None
+        return [{
+            'table_id': t['table_id'],
+            'table_number': t['table_number'],
+            'cover': t['cover'],
+            'room_label': t['room_label']
+        } for t in tables]
+
+def table_displays():
+    """{cart_id: 'Main 1-3'} for every open cart holding tables."""
+    _ensure_loaded()
+    with _lock:
+        by_cart = {cart_id: list(tables) for cart_id, tables in _by_cart.items()}
+    return {cart_id: database.format_table_display(tables) for cart_id, tables in by_cart.items()}
+
+def mark_changed(reason='update'):
+    """Call after committing a table change; never raises into the caller."""
+    global _loaded_at
+    try:
+        return refresh(reason)
+    except Exception as e:
+        print(f"Error refreshing floor state: {e}")
+        with _lock:
+            _loaded_at = 0
+        return None
+
+def subscribe():
+    subscriber = Subscriber()
+    with _lock:
+        _subscribers.add(subscriber)
+    return subscriber
+
+def unsubscribe(subscriber):
+    with _lock:
+        _subscribers.discard(subscriber)
+
+def events_since(version):
+    """Events after version, or None if they're no longer held and a snapshot is needed."""
+    _ensure_loaded()
+    with _lock:
+        if version > _version:
+            return None
+        if version == _version:
+            return []
+        if not _events or _events[0]['version'] > version + 1:
+            return None
+        return [event for event in _events if event['version'] > version]
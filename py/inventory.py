@@ -0,0 +1,163 @@
+import json
+from datetime import datetime, timedelta
+from . import database, menu_push
+
+# Soft reservations are opt-in via the 'stock_reservations' setting
+RESERVATION_MINUTES = 30
+
+class InsufficientStock(Exception):
+    def __init__(self, product_name, available):
+        self.product_name = product_name
+        self.available = max(available or 0, 0)
+        if self.available == 0:
+            super().__init__(f"{product_name} is out of stock")
+        else:
+            super().__init__(f"Only {self.available} of {product_name} available")
+
+def create_inventory_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_movements (
+            movement_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL,
+            cart_id INTEGER,
+            quantity_change INTEGER NOT NULL,
+            stock_after INTEGER,
+            reason TEXT NOT NULL,
+            employee_id INTEGER DEFAULT 0,
+            created_at DATETIME DEFAULT (datetime('now', 'localtime'))
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_movements_product ON stock_movements(product_id, created_at)")
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_reservations (
+            cart_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            expires_at TEXT NOT NULL,
+            PRIMARY KEY (cart_id, product_id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_reservations_product ON stock_reservations(product_id, expires_at)")
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+def reservations_enabled(cursor):
+    cursor.execute("SELECT value FROM settings WHERE key = 'stock_reservations'")
+    row = cursor.fetchone()
+    return bool(row) and str(row[0]) == "1"
+
+def reserve_for_cart(cursor, cart_id, product_id, cart_quantity):
+    """
+    Check a cart can hold cart_quantity of a product (its total across lines)
+    and, when reservations are on, hold that stock against other carts until
+    it expires. Raises InsufficientStock. Runs inside the caller's transaction.
+    """
+    cursor.execute(
+        "SELECT track_inventory, stock_quantity, product_name FROM products WHERE product_id = ?",
+        (product_id,)
+    )
+    product = cursor.fetchone()
+    if not product or product[0] != 1:
+        return
+
+    stock_quantity = product[1] or 0
+    if not reservations_enabled(cursor):
+        if cart_quantity > stock_quantity:
+            raise InsufficientStock(product[2], stock_quantity)
+        return
+
+    now = _now()
+    expires_at = (datetime.now() + timedelta(minutes=RESERVATION_MINUTES)).strftime('%Y-%m-%d %H:%M:%S')
+
+    # Single statement so two terminals can't both claim the last unit
+    cursor.execute('''
+        INSERT INTO stock_reservations (cart_id, product_id, quantity, expires_at)
+        SELECT ?, ?, ?, ?
+        WHERE (SELECT stock_quantity FROM products WHERE product_id = ?)
+            - (SELECT COALESCE(SUM(quantity), 0) FROM stock_reservations
+               WHERE product_id = ? AND cart_id != ? AND expires_at > ?) >= ?
+        ON CONFLICT(cart_id, product_id) DO UPDATE
+        SET quantity = excluded.quantity, expires_at = excluded.expires_at
+    ''', (cart_id, product_id, cart_quantity, expires_at,
+          product_id, product_id, cart_id, now, cart_quantity))
+
+    if cursor.rowcount == 0:
+        cursor.execute('''
+            SELECT COALESCE(SUM(quantity), 0) FROM stock_reservations
+            WHERE product_id = ? AND cart_id != ? AND expires_at > ?
+        ''', (product_id, cart_id, now))
+        raise InsufficientStock(product[2], stock_quantity - cursor.fetchone()[0])
+
+def release_cart(cursor, cart_id):
+    cursor.execute("DELETE FROM stock_reservations WHERE cart_id = ?", (cart_id,))
+
+def purge_expired_reservations(cursor):
+    cursor.execute("DELETE FROM stock_reservations WHERE expires_at <= ?", (_now(),))
+    return cursor.rowcount
+
+def deduct_cart(cursor, cart_id, employee_id=0):
+    """
+    Take a cart's tracked products out of stock inside the checkout transaction.
+    Each product is decremented once with a guarded UPDATE, so concurrent sales
+    can't oversell; raises InsufficientStock and the caller rolls back.
+    """
+    cursor.execute('''
+        SELECT ci.product_id, p.product_name, SUM(ci.quantity)
+        FROM cart_item ci
+        JOIN products p ON ci.product_id = p.product_id
+        WHERE ci.cart_id = ? AND p.track_inventory = 1
+        GROUP BY ci.product_id
+    ''', (cart_id,))
+    lines = cursor.fetchall()
+
+    for product_id, product_name, quantity in lines:
+        cursor.execute('''
+            UPDATE products
+            SET stock_quantity = stock_quantity - ?
+            WHERE product_id = ? AND stock_quantity >= ?
+        ''', (quantity, product_id, quantity))
+        if cursor.rowcount == 0:
+            cursor.execute("SELECT stock_quantity FROM products WHERE product_id = ?", (product_id,))
+            raise InsufficientStock(product_name, cursor.fetchone()[0])
+
+    if lines:
+        cursor.executemany('''
+            INSERT INTO stock_movements (product_id, cart_id, quantity_change, stock_after, reason, employee_id)
+            SELECT product_id, ?, ?, stock_quantity, 'sale', ? FROM products WHERE product_id = ?
+        ''', [(cart_id, -quantity, employee_id, product_id) for product_id, _, quantity in lines])
+        # sold out lines go offline on the storefront as well
+        cursor.execute(
+            "SELECT product_id FROM products WHERE product_id IN (SELECT value FROM json_each(?)) AND stock_quantity <= 0",
+            (json.dumps([product_id for product_id, _, _ in lines]),)
+        )
+        menu_push.record(cursor, 'product', [row[0] for row in cursor.fetchall()])
+
+    release_cart(cursor, cart_id)
+
+def record_adjustment(cursor, product_id, new_stock, reason='adjustment', employee_id=0):
+    """Log a manual stock change; call before the products row is updated."""
+    cursor.execute('''
+        INSERT INTO stock_movements (product_id, quantity_change, stock_after, reason, employee_id)
+        SELECT product_id, ? - COALESCE(stock_quantity, 0), ?, ?, ?
+        FROM products
+        WHERE product_id = ? AND track_inventory = 1 AND COALESCE(stock_quantity, 0) != ?
+    ''', (new_stock, new_stock, reason, employee_id, product_id, new_stock))
+
+def get_stock_movements(product_id, limit=100):
+    conn = None
+    try:
+        conn, cursor = database.get_database_connection()
+        cursor.execute('''
+            SELECT movement_id, product_id, cart_id, quantity_change, stock_after, reason, employee_id, created_at
+            FROM stock_movements
+            WHERE product_id = ?
+            ORDER BY movement_id DESC
+            LIMIT ?
+        ''', (product_id, limit))
+        columns = [col[0] for col in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    finally:
+        if conn:
+            conn.close()
@@ -1,6 +1,6 @@
 from flask import jsonify
 import json, sqlite3, os, csv, data_directory
-from . import database
+from . import database, cart_snapshot, serialize
 from collections import Counter
 
 data_dir = data_directory.get_data_directory()
@@ -390,14 +390,11 @@ def get_multiple_pos_settings(*settings):
         print(f"File not found: {json_file_path}")
         return {}
 
-def pos_methods(cart_id, change=None):
+def pos_methods_data(cart_id, change=None):
+    """Enabled order methods, quick cart flag and the current cart's header as plain data."""
     pos_methods = get_pos_settings("pos_methods")
     quick_cart = get_pos_settings("quick_cart")
-    if cart_id:
-        current_cart_response = database.get_current_cart_data(cart_id)
-        current_cart_data = json.loads(current_cart_response.get_data(as_text=True))
-    else:
-        current_cart_data = {}
+    current_cart_data = (cart_snapshot.current_cart(cart_id) if cart_id else None) or {}
     filtered_pos_methods = [method for method in pos_methods if method.get('on', 0) == 1]
     for method in filtered_pos_methods:
         if method.get('method') == 'dine' and method.get('on', 0) == 1:
@@ -405,11 +402,14 @@ def pos_methods(cart_id, change=None):
                 method['tables'] = database.get_all_tables()
             else:
                 method['tables'] = database.get_free_tables()
-    return jsonify({
+    return {
         "methods": filtered_pos_methods,
         "quick_cart": quick_cart,
         "current_cart_data": current_cart_data
-    })
+    }
+
+def pos_methods(cart_id, change=None):
+    return serialize.response(pos_methods_data(cart_id, change))
 
 def get_discounts():
     pos_discounts = get_pos_settings("discounts")
@@ -0,0 +1,338 @@
+import json, random, threading, time, sqlite3, requests
+from . import database
+from logging_utils import logger, log_error
+
+# the v2 bulk endpoints accept at most this many entries per request
+BULK_LIMIT = 100
+BATCH_SIZE = 500
+# changes are held until the menu has been quiet this long, or the oldest is MAX_DELAY old
+COALESCE_SECONDS = 5
+MAX_DELAY = 30
+MAX_BACKOFF = 300
+KEEP_DAYS = 2
+# unmapped items are matched against the storefront's listing at most this often
+SEED_SECONDS = 3600
+
+_seeded_at = {}  # (site, 'products' or 'options') -> time.monotonic() of the last listing read
+
+def create_menu_push_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS menu_changes (
+            change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            item_type TEXT NOT NULL,
+            item_id INTEGER NOT NULL,
+            group_id INTEGER,
+            created_at DATETIME DEFAULT (datetime('now', 'localtime'))
+        )
+    ''')
+    # local product/option ids -> the storefront's ids, matched by name from its listings
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS storefront_item_map (
+            site TEXT NOT NULL,
+            item_type TEXT NOT NULL,
+            item_id INTEGER NOT NULL,
+            group_id INTEGER NOT NULL DEFAULT 0,
+            remote_id INTEGER NOT NULL,
+            PRIMARY KEY (site, item_type, item_id, group_id)
+        )
+    ''')
+
+def enabled(cursor):
+    cursor.execute("SELECT value FROM settings WHERE key = 'menu_push'")
+    row = cursor.fetchone()
+    return bool(row) and str(row[0]) == "1"
+
+def record(cursor, item_type, item_ids, group_id=None):
+    """
+    Note changed menu items inside the transaction making the change.
+    item_type is 'product' (product_id), 'option' (option_item_id within
+    group_id) or 'option_group' (options.option_id, for hide toggles).
+    """
+    if not item_ids or not enabled(cursor):
+        return
+    cursor.executemany(
+        "INSERT INTO menu_changes (item_type, item_id, group_id) VALUES (?, ?, ?)",
+        [(item_type, item_id, group_id) for item_id in item_ids]
+    )
+
+def _get_setting(cursor, key):
+    cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def _set_setting(cursor, key, value):
+    cursor.execute("INSERT INTO settings (key, value) VALUES (?, ?) "
+                   "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                   (key, value))
+
+def _pending(cursor, site):
+    """Coalesced changes after the site's cursor, or None while the window is still open."""
+    position = int(_get_setting(cursor, f'menu_push_cursor_{site}') or 0)
+    cursor.execute('''
+        SELECT change_id, item_type, item_id, group_id,
+               (julianday('now', 'localtime') - julianday(created_at)) * 86400
+        FROM menu_changes
+        WHERE change_id > ?
+        ORDER BY change_id
+        LIMIT ?
+    ''', (position, BATCH_SIZE))
+    rows = cursor.fetchall()
+    if not rows:
+        return None
+    if rows[-1][4] < COALESCE_SECONDS and rows[0][4] < MAX_DELAY and len(rows) < BATCH_SIZE:
+        return None
+
+    changes = {'last_id': rows[-1][0], 'product': set(), 'option': set(), 'option_group': set()}
+    for _, item_type, item_id, group_id, _ in rows:
+        changes[item_type].add((item_id, group_id) if item_type == 'option' else item_id)
+    return changes
+
+def _mapped(cursor, site, item_type):
+    cursor.execute("SELECT item_id, group_id, remote_id FROM storefront_item_map WHERE site = ? AND item_type = ?",
+                   (site, item_type))
+    return {(item_id, group_id): remote_id for item_id, group_id, remote_id in cursor.fetchall()}
+
+def _key(name):
+    return str(name or '').strip().lower()
+
+def _due(site, listing):
+    return _seeded_at.get((site, listing), 0) + SEED_SECONDS <= time.monotonic()
+
+def _seed_products(cursor, site, send, product_ids):
+    """
+    Map changed products the storefront already has, by category and name,
+    from GET /products. Returns False if the listing couldn't be read.
+    """
+    mapped = _mapped(cursor, site, 'product')
+    unmapped = [product_id for product_id in product_ids if (product_id, 0) not in mapped]
+    if not unmapped or not _due(site, 'products'):
+        return True
+    data = send('GET', 'products', None)
+    if data is None:
+        return False
+    remote = {}
+    for category, listing in data.items():
+        for product in (listing or {}).get('products') or []:
+            remote[(_key(category), _key(product.get('name')))] = product.get('id')
+    cursor.execute('''
+        SELECT p.product_id, p.product_name, c.category_name
+        FROM products p
+        JOIN category c ON p.category_id = c.category_id
+        WHERE p.product_id IN (SELECT value FROM json_each(?))
+    ''', (json.dumps(unmapped),))
+    for product_id, name, category in cursor.fetchall():
+        remote_id = remote.get((_key(category), _key(name)))
+        if remote_id:
+            _remember(cursor, site, 'product', product_id, 0, remote_id)
+    _seeded_at[(site, 'products')] = time.monotonic()
+    return True
+
+def _product_payloads(cursor, site, product_ids):
+    """
+    {category_name: [(product_id, entry), ...]} for /products/bulk/upsert.
+    Only products mapped to a storefront id are sent: an entry without an id
+    would be created online, and till-only items must stay off the storefront.
+    """
+    cursor.execute('''
+        SELECT p.product_id, p.product_name, p.out_price, p.is_hidden, p.track_inventory,
+               p.stock_quantity, c.category_name, c.is_hidden
+        FROM products p
+        JOIN category c ON p.category_id = c.category_id
+        WHERE p.product_id IN (SELECT value FROM json_each(?))
+    ''', (json.dumps(list(product_ids)),))
+    rows = cursor.fetchall()
+    mapped = _mapped(cursor, site, 'product')
+    by_category = {}
+    for product_id, name, price, hidden, track, stock_quantity, category, category_hidden in rows:
+        in_stock = not hidden and not category_hidden and not (track == 1 and (stock_quantity or 0) <= 0)
+        remote_id = mapped.get((product_id, 0))
+        if not remote_id:
+            continue
+        entry = {'id': remote_id, 'price': f"{price or 0:.2f}", 'stock': 1 if in_stock else 0}
+        by_category.setdefault(category, []).append((product_id, entry))
+    return by_category
+
+def _option_payloads(cursor, site, options, remote_groups):
+    """
+    {remote_group_id: [((option_item_id, group_id), entry), ...]} for
+    /options/bulk/upsert; like products, only mapped option items are sent.
+    """
+    cursor.execute('''
+        SELECT oig.option_item_id, oig.option_id, oig.option_item_out_price, oig.is_hidden
+        FROM option_item_groups oig
+        WHERE (oig.option_item_id, oig.option_id) IN (SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?))
+    ''', (json.dumps([list(option) for option in options]),))
+    rows = cursor.fetchall()
+    mapped = _mapped(cursor, site, 'option')
+    by_group = {}
+    for item_id, group_id, price, hidden in rows:
+        remote_group = remote_groups.get(group_id)
+        remote_id = mapped.get((item_id, group_id))
+        if not remote_group or not remote_id:
+            continue
+        entry = {'id': remote_id, 'price': price or 0, 'stock': 0 if hidden else 1}
+        by_group.setdefault(remote_group, []).append(((item_id, group_id), entry))
+    return by_group
+
+def _remote_groups(cursor, site, send, options):
+    """
+    Local option group id -> storefront group id. Groups, and the changed
+    option items within them, are matched by name from GET /options and
+    then remembered.
+    """
+    groups = {group_id: remote_id for (group_id, _), remote_id in _mapped(cursor, site, 'option_group').items()}
+    mapped = _mapped(cursor, site, 'option')
+    cursor.execute("SELECT option_id, option_name FROM options")
+    local = cursor.fetchall()
+    unmapped = [option for option in options if option not in mapped]
+    if (all(option_id in groups for option_id, _ in local) and not unmapped) or not _due(site, 'options'):
+        return groups
+    data = send('GET', 'options', None)
+    if data is None:
+        return groups
+    by_name = {_key(group.get('name')): group for group in data}
+    for option_id, option_name in local:
+        group = by_name.get(_key(option_name))
+        if option_id not in groups and group and group.get('id'):
+            groups[option_id] = group['id']
+            _remember(cursor, site, 'option_group', option_id, 0, group['id'])
+
+    cursor.execute('''
+        SELECT oig.option_item_id, oig.option_id, oi.option_item_name, o.option_name
+        FROM option_item_groups oig
+        JOIN option_items oi ON oi.option_item_id = oig.option_item_id
+        JOIN options o ON o.option_id = oig.option_id
+        WHERE (oig.option_item_id, oig.option_id) IN (SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?))
+    ''', (json.dumps([list(option) for option in unmapped]),))
+    for item_id, group_id, name, option_name in cursor.fetchall():
+        group = by_name.get(_key(option_name)) or {}
+        remote_id = {_key(option.get('name')): option.get('id') for option in group.get('options') or []}.get(_key(name))
+        if remote_id:
+            _remember(cursor, site, 'option', item_id, group_id, remote_id)
+    _seeded_at[(site, 'options')] = time.monotonic()
+    return groups
+
+def _remember(cursor, site, item_type, item_id, group_id, remote_id):
+    cursor.execute('''
+        INSERT INTO storefront_item_map (site, item_type, item_id, group_id, remote_id)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(site, item_type, item_id, group_id) DO UPDATE SET remote_id = excluded.remote_id
+    ''', (site, item_type, item_id, group_id or 0, remote_id))
+
+def _chunks(entries):
+    for start in range(0, len(entries), BULK_LIMIT):
+        yield entries[start:start + BULK_LIMIT]
+
+def push_once(site, send):
+    """
+    Push one coalesced batch of menu changes to a site with
+    send(method, path, body) -> response data or None on failure.
+    Products go to /products/bulk/upsert per category, option items to
+    /options/bulk/upsert per group and hidden groups to /options/bulk/stock.
+    Only items the storefront already lists are pushed; the till never
+    creates products or options online.
+    Returns the number of items pushed, 0 when idle, or None on failure;
+    the site's cursor only moves once every call in the batch succeeded.
+    """
+    conn = None
+    try:
+        conn, cursor = database.get_database_connection()
+        changes = _pending(cursor, site)
+        if changes is None:
+            conn.commit()
+            return 0
+
+        if not _seed_products(cursor, site, send, changes['product']):
+            conn.commit()
+            return None
+        pushed = 0
+        for category, entries in _product_payloads(cursor, site, changes['product']).items():
+            for chunk in _chunks(entries):
+                data = send('POST', 'products/bulk/upsert', {'category': category, 'products': [entry for _, entry in chunk]})
+                if data is None:
+                    # keep ids matched so far
+                    conn.commit()
+                    return None
+                pushed += len(chunk)
+
+        if changes['option'] or changes['option_group']:
+            remote_groups = _remote_groups(cursor, site, send, changes['option'])
+            for remote_group, entries in _option_payloads(cursor, site, changes['option'], remote_groups).items():
+                for chunk in _chunks(entries):
+                    data = send('POST', 'options/bulk/upsert', {'group_id': remote_group, 'options': [entry for _, entry in chunk]})
+                    if data is None:
+                        # keep ids matched so far
+                        conn.commit()
+                        return None
+                    pushed += len(chunk)
+
+            if changes['option_group']:
+                cursor.execute("SELECT option_id, is_hidden FROM options WHERE option_id IN (SELECT value FROM json_each(?))",
+                               (json.dumps(list(changes['option_group'])),))
+                for option_id, hidden in cursor.fetchall():
+                    if option_id in remote_groups:
+                        if send('POST', 'options/bulk/stock', {'group_id': remote_groups[option_id], 'stock': 0 if hidden else 1}) is None:
+                            # keep ids matched so far
+                            conn.commit()
+                            return None
+                        pushed += 1
+
+        _set_setting(cursor, f'menu_push_cursor_{site}', str(changes['last_id']))
+        cursor.execute("DELETE FROM menu_changes WHERE created_at < datetime('now', 'localtime', ?)", (f"-{KEEP_DAYS} days",))
+        conn.commit()
+        return pushed
+    except sqlite3.Error as e:
+        log_error(f"Menu push error: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def http_sender(site, token, timeout=15):
+    """send() for push_once against https://{site}/app/v2/; returns the response's data or None."""
+    def send(method, path, body):
+        try:
+            response = requests.request(method, f"https://{site}/app/v2/{path}", json=body,
+                                        headers={'Authorization': f'Bearer {token}'}, timeout=timeout)
+            if not response.ok:
+                logger.info(f"Menu push to {site} {path} failed: {response.status_code}")
+                return None
+            return response.json().get('data') or {}
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.info(f"Menu push to {site} {path} failed: {e}")
+            return None
+    return send
+
+def run_worker(get_sites, interval=2, stop_event=None):
+    """Push every site's changes until stop_event is set; get_sites() -> [(site, token), ...]."""
+    stop_event = stop_event or threading.Event()
+    failures = {}
+    next_try = {}
+    while not stop_event.is_set():
+        try:
+            sites = get_sites() or []
+        except Exception as e:
+            log_error(f"Menu push error: {e}")
+            sites = []
+        for site, token in sites:
+            if next_try.get(site, 0) > time.monotonic():
+                continue
+            try:
+                pushed = push_once(site, http_sender(site, token))
+            except Exception as e:
+                # a malformed response must not end the thread; back off like any failure
+                log_error(f"Menu push to {site} failed: {e}")
+                pushed = None
+            if pushed is None:
+                failures[site] = failures.get(site, 0) + 1
+                delay = min(MAX_BACKOFF, interval * 2 ** failures[site]) * random.uniform(0.5, 1.0)
+                next_try[site] = time.monotonic() + delay
+            else:
+                failures.pop(site, None)
+        stop_event.wait(interval)
+
+def start_push_worker(get_sites, interval=2):
+    stop_event = threading.Event()
+    thread = threading.Thread(target=run_worker, args=(get_sites, interval, stop_event), daemon=True)
+    thread.start()
+    return stop_event
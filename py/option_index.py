@@ -0,0 +1,244 @@
+import json, base64, sqlite3
+from . import database
+from logging_utils import logger, log_error
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+REFRESH_BATCH = 500
+
+def create_option_index(cursor):
+    """
+    option_template_index holds one row per option item that is in a visible
+    group: its groups with their prices, and how many groups use it.
+    Triggers note every option write in option_index_changes; readers fold
+    those in before serving, so every write path keeps the index current
+    without calling anything.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS option_template_index (
+            option_item_id INTEGER PRIMARY KEY,
+            option_item_name TEXT,
+            name_key TEXT NOT NULL,
+            in_price REAL,
+            out_price REAL,
+            groups TEXT NOT NULL,
+            usage_count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_option_template_name ON option_template_index(name_key, option_item_id)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS option_index_changes (option_item_id INTEGER PRIMARY KEY)")
+
+    # only columns the index shows; reordering or recolouring doesn't touch it
+    watched = {
+        'option_items': 'option_item_name',
+        'option_item_groups': 'option_id, option_item_id, option_item_in_price, option_item_out_price'
+    }
+    for table, columns in watched.items():
+        for event, row in (('INSERT', 'NEW'), (f'UPDATE OF {columns}', 'NEW'), ('DELETE', 'OLD')):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS option_index_{table}_{event.split()[0].lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    INSERT OR IGNORE INTO option_index_changes (option_item_id) VALUES ({row}.option_item_id);
+                END
+            ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS option_index_option_item_groups_moved
+        AFTER UPDATE OF option_item_id ON option_item_groups
+        BEGIN
+            INSERT OR IGNORE INTO option_index_changes (option_item_id) VALUES (OLD.option_item_id);
+        END
+    ''')
+    # renaming or hiding a group changes every item in it
+    for event, row in (('UPDATE OF option_name, is_hidden', 'NEW'), ('DELETE', 'OLD')):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS option_index_options_{event.split()[0].lower()}
+            AFTER {event} ON options
+            BEGIN
+                INSERT OR IGNORE INTO option_index_changes (option_item_id)
+                SELECT option_item_id FROM option_item_groups WHERE option_id = {row}.option_id;
+            END
+        ''')
+
+    cursor.execute("SELECT value FROM settings WHERE key = 'option_index_built'")
+    if not cursor.fetchone():
+        cursor.execute("INSERT OR IGNORE INTO option_index_changes (option_item_id) SELECT option_item_id FROM option_items")
+        cursor.execute("INSERT INTO settings (key, value) VALUES ('option_index_built', '1') "
+                       "ON CONFLICT(key) DO UPDATE SET value = excluded.value")
+
+    # prefix search over product names for the same editor
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_name_nocase ON products(product_name COLLATE NOCASE, product_id)")
+
+def _name_key(name):
+    return (name or '').strip().lower()
+
+def refresh(cursor):
+    """Rebuild the index rows of option items changed since the last read. Returns how many."""
+    refreshed = 0
+    while True:
+        cursor.execute("SELECT option_item_id FROM option_index_changes LIMIT ?", (REFRESH_BATCH,))
+        ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            return refreshed
+        ids_json = json.dumps(ids)
+        cursor.execute('''
+            SELECT oi.option_item_id, oi.option_item_name, o.option_id, o.option_name,
+                   oig.option_item_in_price, oig.option_item_out_price
+            FROM option_items oi
+            JOIN option_item_groups oig ON oi.option_item_id = oig.option_item_id
+            JOIN options o ON o.option_id = oig.option_id
+            WHERE o.is_hidden = 0
+              AND oi.option_item_id IN (SELECT value FROM json_each(?))
+            ORDER BY oi.option_item_id, o.option_name
+        ''', (ids_json,))
+        entries = {}
+        for item_id, name, option_id, option_name, in_price, out_price in cursor.fetchall():
+            entry = entries.setdefault(item_id, {'name': name, 'groups': []})
+            entry['groups'].append({'option_id': option_id, 'option_name': option_name,
+                                    'option_item_in_price': in_price, 'option_item_out_price': out_price})
+
+        cursor.execute("DELETE FROM option_template_index WHERE option_item_id IN (SELECT value FROM json_each(?))", (ids_json,))
+        cursor.executemany('''
+            INSERT INTO option_template_index
+                (option_item_id, option_item_name, name_key, in_price, out_price, groups, usage_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(item_id, entry['name'], _name_key(entry['name']),
+               entry['groups'][0]['option_item_in_price'], entry['groups'][0]['option_item_out_price'],
+               json.dumps(entry['groups']), len(entry['groups']))
+              for item_id, entry in entries.items()])
+        cursor.execute("DELETE FROM option_index_changes WHERE option_item_id IN (SELECT value FROM json_each(?))", (ids_json,))
+        refreshed += len(ids)
+
+def _encode_cursor(key, row_id):
+    return base64.urlsafe_b64encode(json.dumps([key, row_id]).encode()).decode().rstrip('=')
+
+def _decode_cursor(token):
+    try:
+        key, row_id = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        return str(key), int(row_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid template cursor")
+
+def _prefix_range(prefix):
+    """(low, high) bounds matching every key that starts with prefix."""
+    return prefix, prefix + '\U0010ffff'
+
+def _connection():
+    """Connection with the index brought up to date."""
+    conn, cursor = database.get_database_connection()
+    try:
+        cursor.execute("SELECT 1 FROM option_index_changes LIMIT 1")
+        if cursor.fetchone():
+            conn.isolation_level = None
+            try:
+                cursor.execute("BEGIN IMMEDIATE")
+                count = refresh(cursor)
+                cursor.execute("COMMIT")
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                conn.isolation_level = ''
+            logger.info(f"Option template index refreshed for {count} items")
+    except Exception:
+        conn.close()
+        raise
+    return conn, cursor
+
+def search_option_templates(prefix='', cursor=None, limit=PAGE_SIZE):
+    """
+    One page of option items whose name starts with prefix (case-insensitive),
+    in name order.
+    {'items': [{'option_item_id': 4, 'option_item_name': 'Cheese', 'in_price': 0.2, 'out_price': 0.5,
+                'usage_count': 2, 'groups': [{'option_id': 1, 'option_name': 'Toppings',
+                                              'option_item_in_price': 0.2, 'option_item_out_price': 0.5}, ...]}, ...],
+     'next_cursor': 'WyJjaGVlc2UiLCA0XQ' or None}
+    """
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    low, high = _prefix_range(_name_key(prefix))
+    params = [low, high]
+    after = ""
+    if cursor:
+        after = "AND (name_key, option_item_id) > (?, ?)"
+        params.extend(_decode_cursor(cursor))
+    conn = None
+    try:
+        conn, db_cursor = _connection()
+        db_cursor.execute(f'''
+            SELECT option_item_id, option_item_name, name_key, in_price, out_price, usage_count, groups
+            FROM option_template_index
+            WHERE name_key >= ? AND name_key < ? {after}
+            ORDER BY name_key, option_item_id
+            LIMIT ?
+        ''', (*params, limit + 1))
+        rows = db_cursor.fetchall()
+        items = [{
+            'option_item_id': item_id, 'option_item_name': name,
+            'in_price': in_price, 'out_price': out_price,
+            'usage_count': usage_count, 'groups': json.loads(groups)
+        } for item_id, name, _, in_price, out_price, usage_count, groups in rows[:limit]]
+        next_cursor = _encode_cursor(rows[limit - 1][2], rows[limit - 1][0]) if len(rows) > limit else None
+        return {'items': items, 'next_cursor': next_cursor}
+    except sqlite3.Error as e:
+        log_error(f"Error searching option templates: {e}")
+        return {'items': [], 'next_cursor': None}
+    finally:
+        if conn:
+            conn.close()
+
+def search_product_templates(prefix='', cursor=None, limit=PAGE_SIZE):
+    """
+    One page of distinct visible product names starting with prefix, for
+    using products as option items.
+    {'items': [{'product_name': 'Chips', 'in_price': 0.4, 'out_price': 1.5}, ...], 'next_cursor': ... or None}
+    """
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    prefix = (prefix or '').strip()
+    params = [prefix, prefix + '\U0010ffff']
+    after = ""
+    if cursor:
+        after = "AND product_name > ? COLLATE NOCASE"
+        params.append(_decode_cursor(cursor)[0])
+    conn = None
+    try:
+        conn, db_cursor = database.get_database_connection()
+        db_cursor.execute(f'''
+            SELECT product_name, MIN(in_price), MIN(out_price)
+            FROM products
+            WHERE is_hidden = 0
+              AND product_name >= ? COLLATE NOCASE AND product_name < ? COLLATE NOCASE {after}
+            GROUP BY product_name COLLATE NOCASE
+            ORDER BY product_name COLLATE NOCASE
+            LIMIT ?
+        ''', (*params, limit + 1))
+        rows = db_cursor.fetchall()
+        items = [{'product_name': name, 'in_price': in_price, 'out_price': out_price}
+                 for name, in_price, out_price in rows[:limit]]
+        next_cursor = _encode_cursor(rows[limit - 1][0], 0) if len(rows) > limit else None
+        return {'items': items, 'next_cursor': next_cursor}
+    except sqlite3.Error as e:
+        log_error(f"Error searching product templates: {e}")
+        return {'items': [], 'next_cursor': None}
+    finally:
+        if conn:
+            conn.close()
+
+def all_option_items():
+    """Every indexed option item as the flat rows get_all_option_templates groups by option_name."""
+    conn = None
+    try:
+        conn, cursor = _connection()
+        cursor.execute("SELECT option_item_id, option_item_name, groups FROM option_template_index ORDER BY name_key, option_item_id")
+        rows = []
+        for item_id, name, groups in cursor.fetchall():
+            for group in json.loads(groups):
+                rows.append({
+                    'option_item_id': item_id,
+                    'option_item_name': name,
+                    'option_item_in_price': group['option_item_in_price'],
+                    'option_item_out_price': group['option_item_out_price'],
+                    'option_name': group['option_name']
+                })
+        return rows
+    finally:
+        if conn:
+            conn.close()
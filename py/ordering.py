@@ -0,0 +1,108 @@
+from bisect import bisect_left
+
+# spacing used when a list has to be renumbered or an item lands past either end
+GAP = 1024
+
+def _kept(keys):
+    """Positions of a longest strictly increasing run of keys; those rows don't need to move."""
+    tails, tail_pos, previous = [], [], [None] * len(keys)
+    for i, key in enumerate(keys):
+        j = bisect_left(tails, key)
+        if j == len(tails):
+            tails.append(key)
+            tail_pos.append(i)
+        else:
+            tails[j] = key
+            tail_pos[j] = i
+        previous[i] = tail_pos[j - 1] if j else None
+    kept = set()
+    i = tail_pos[-1] if tail_pos else None
+    while i is not None:
+        kept.add(i)
+        i = previous[i]
+    return kept
+
+def _between(low, high, count):
+    """count increasing keys strictly between low and high (either may be None)."""
+    if low is None and high is None:
+        return [i * GAP for i in range(count)]
+    if low is None:
+        return [high - (count - i) * GAP for i in range(count)]
+    if high is None:
+        return [low + (i + 1) * GAP for i in range(count)]
+    step = (high - low) / (count + 1)
+    if step >= 1 and float(low).is_integer() and float(high).is_integer():
+        step = int(step)
+    return [low + (i + 1) * step for i in range(count)]
+
+def plan(current, ids):
+    """
+    New ordering keys for ids (the list in its new order) given current
+    {id: key}. Rows already in the right relative order keep their keys, so
+    moving one item changes one key; keys may be fractional. Falls back to
+    renumbering every row GAP apart when there's no room left between two
+    neighbours. Returns {id: new_key} for the rows that change.
+    """
+    ids = [i for i in dict.fromkeys(ids) if i in current]
+    keys = [current[i] for i in ids]
+    kept = _kept(keys)
+    new_keys = list(keys)
+    position = 0
+    while position < len(ids):
+        if position in kept:
+            position += 1
+            continue
+        end = position
+        while end < len(ids) and end not in kept:
+            end += 1
+        low = new_keys[position - 1] if position else None
+        high = keys[end] if end < len(ids) else None
+        new_keys[position:end] = _between(low, high, end - position)
+        position = end
+
+    ordered = all(a < b for a, b in zip(new_keys, new_keys[1:]))
+    if not ordered:
+        new_keys = [i * GAP for i in range(len(ids))]
+    return {item: key for item, key, old in zip(ids, new_keys, keys) if key != old}
+
+def save(cursor, table, key_column, order_column, ids, scope=None, values=None):
+    """
+    Persist a reordered list, writing only rows whose position or values
+    changed in one executemany. scope ({'category_id': 3}) limits the list
+    to part of the table; values ({id: {'product_colour': 'red'}}) are other
+    columns saved alongside. Returns the ids written.
+
+    ordering.save(cursor, 'dining_rooms', 'room_id', 'room_order', [3, 1, 2])
+    """
+    scope = scope or {}
+    values = values or {}
+    value_columns = sorted({column for columns in values.values() for column in columns})
+    where = "".join(f" AND {column} = ?" for column in scope)
+    cursor.execute(
+        f"SELECT {key_column}, {order_column}{''.join(f', {c}' for c in value_columns)} "
+        f"FROM {table} WHERE 1 = 1{where}",
+        tuple(scope.values())
+    )
+    current, current_values = {}, {}
+    for row in cursor.fetchall():
+        current[row[0]] = row[1] if row[1] is not None else 0
+        current_values[row[0]] = dict(zip(value_columns, row[2:]))
+
+    moves = plan(current, ids)
+    changed = set(moves)
+    for item, columns in values.items():
+        if item in current_values and any(current_values[item].get(c) != v for c, v in columns.items()):
+            changed.add(item)
+    if not changed:
+        return []
+
+    rows = []
+    for item in changed:
+        merged = dict(current_values[item], **values.get(item, {}))
+        rows.append((moves.get(item, current[item]), *(merged[c] for c in value_columns), item, *scope.values()))
+    cursor.executemany(
+        f"UPDATE {table} SET {order_column} = ?{''.join(f', {c} = ?' for c in value_columns)} "
+        f"WHERE {key_column} = ?{where}",
+        rows
+    )
+    return sorted(changed)
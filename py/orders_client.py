@@ -0,0 +1,232 @@
+import json, time, threading, requests
+from datetime import datetime
+from pos import database as posdb
+from logging_utils import logger, log_error
+
+PAGE_LIMIT = 50
+# a walk needing more pages than this is handed to v1 for that poll
+MAX_PAGES = 40
+REQUEST_TIMEOUT = (3.05, 15)
+# sites answering 404 on v2 are polled over v1 and re-probed this often
+V1_RECHECK_SECONDS = 3600
+# the API has no updated-since filter, so status changes on orders past the
+# first changed pages are only seen by walking every page this often
+FULL_WALK_SECONDS = 300
+
+_lock = threading.Lock()
+_cache = {}       # site -> {'date': '2025-12-20', 'orders': {order_id: order}}
+_v1_until = {}    # site -> time.monotonic() before which v2 isn't tried
+_full_walk_at = {}  # site -> time.monotonic() of the last walk over every page
+
+class V2Unavailable(Exception):
+    pass
+
+class PageLimitReached(V2Unavailable):
+    """More of today's orders than MAX_PAGES holds; this poll goes over v1."""
+
+def create_sync_state_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS order_sync_state (
+            site TEXT PRIMARY KEY,
+            watermark TEXT,
+            etag TEXT,
+            last_modified TEXT,
+            updated_at DATETIME DEFAULT (datetime('now', 'localtime'))
+        )
+    ''')
+    # today's orders as last fetched, so a restart doesn't fetch every order in full again
+    cursor.execute("PRAGMA table_info(order_sync_state)")
+    columns = [col[1] for col in cursor.fetchall()]
+    if 'orders_date' not in columns:
+        cursor.execute("ALTER TABLE order_sync_state ADD COLUMN orders_date TEXT")
+        cursor.execute("ALTER TABLE order_sync_state ADD COLUMN orders TEXT")
+
+def v2_enabled():
+    return posdb.get_setting_str('orders_api', 'v1') == 'v2'
+
+def use_v2(site):
+    return v2_enabled() and _v1_until.get(site, 0) <= time.monotonic()
+
+def _load_state(site):
+    conn = None
+    try:
+        conn, cursor = posdb.get_database_connection()
+        cursor.execute("SELECT watermark, etag, last_modified, orders_date, orders FROM order_sync_state WHERE site = ?", (site,))
+        row = cursor.fetchone()
+        if not row:
+            return {'watermark': None, 'etag': None, 'last_modified': None, 'orders_date': None, 'orders': {}}
+        # JSON keys are strings; the API's order ids are numbers
+        orders = {order['order_id']: order for order in json.loads(row[4] or '[]')}
+        return {'watermark': row[0], 'etag': row[1], 'last_modified': row[2], 'orders_date': row[3], 'orders': orders}
+    finally:
+        if conn:
+            conn.close()
+
+def _save_state(site, state, date, orders=None):
+    """Store the validators and watermark, and today's orders when given (only after they changed)."""
+    conn = None
+    try:
+        conn, cursor = posdb.get_database_connection()
+        cursor.execute('''
+            INSERT INTO order_sync_state (site, watermark, etag, last_modified, orders_date, orders, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, datetime('now', 'localtime'))
+            ON CONFLICT(site) DO UPDATE SET
+                watermark = excluded.watermark, etag = excluded.etag,
+                last_modified = excluded.last_modified,
+                orders_date = COALESCE(excluded.orders_date, orders_date),
+                orders = COALESCE(excluded.orders, orders),
+                updated_at = excluded.updated_at
+        ''', (site, state['watermark'], state['etag'], state['last_modified'],
+              date if orders is not None else None,
+              json.dumps(list(orders.values()), default=str) if orders is not None else None))
+        conn.commit()
+    finally:
+        if conn:
+            conn.close()
+
+def _get(session, site, token, path, params=None, headers=None):
+    response = session.get(
+        f"https://{site}/app/v2/{path}",
+        params=params,
+        headers={'Authorization': f'Bearer {token}', **(headers or {})},
+        timeout=REQUEST_TIMEOUT
+    )
+    if response.status_code in (404, 405):
+        raise V2Unavailable(f"{site} has no v2 orders endpoint")
+    return response
+
+def _pages(session, site, token, since, conditional):
+    """
+    Yield (response, items) per page, newest first, of orders from since
+    on. Only the first page is sent conditionally; a 304 there means
+    nothing changed and ends the walk. Raises PageLimitReached when more
+    than MAX_PAGES pages would be needed.
+    """
+    for page in range(1, MAX_PAGES + 1):
+        response = _get(session, site, token, 'orders',
+                        params={'from': since, 'limit': PAGE_LIMIT, 'page': page},
+                        headers=conditional if page == 1 else None)
+        if response.status_code == 304:
+            yield response, None
+            return
+        response.raise_for_status()
+        data = response.json().get('data') or {}
+        yield response, data.get('items') or []
+        if not (data.get('pagination') or {}).get('has_more'):
+            return
+    raise PageLimitReached(f"{site} has more than {MAX_PAGES} pages of orders since {since}")
+
+def _order_detail(session, site, token, order_id):
+    response = _get(session, site, token, f"orders/{order_id}")
+    response.raise_for_status()
+    return response.json().get('data') or {}
+
+def _normalise(order, site):
+    # the poller and orders.html sort and group on the v1 field names
+    order = dict(order)
+    order.setdefault('order_time', order.get('created_at'))
+    order['url'] = site
+    return order
+
+def fetch_orders_v2(site, token, session=None):
+    """
+    Today's orders for a site from GET /app/v2/orders, in the same list shape
+    fetch_orders() returns. Polls ask only for orders from the site's
+    watermark (the newest created_at seen) on, with If-None-Match /
+    If-Modified-Since so an idle poll is a single 304. Every
+    FULL_WALK_SECONDS the poll goes unconditional and reads all of today's
+    pages, which picks up cancellations and completions on older orders.
+    New orders are fetched once in full so they can be printed; today's
+    orders are stored, so a restart starts from them rather than fetching
+    each one again.
+
+    Raises V2Unavailable for sites still on v1 and PageLimitReached when
+    the walk needs more than MAX_PAGES pages; the caller uses v1 for that
+    poll. requests errors (including a 401 HTTPError) are left to the caller.
+    """
+    session = session or requests
+    today = datetime.now().strftime('%Y-%m-%d')
+    state = _load_state(site)
+
+    with _lock:
+        cached = _cache.get(site)
+        if cached is None or cached['date'] != today:
+            if state['orders_date'] == today:
+                cached = {'date': today, 'orders': state['orders']}
+            else:
+                # the conditional headers only mean something with today's orders at hand
+                cached = {'date': today, 'orders': {}}
+                state['etag'] = state['last_modified'] = None
+            _cache[site] = cached
+        known = dict(cached['orders'])
+        walk_all = _full_walk_at.get(site, 0) + FULL_WALK_SECONDS <= time.monotonic()
+
+    # the watermark is only a lower bound once its orders are known, and never before today
+    watermark = state['watermark'] or ''
+    since = watermark if known and not walk_all and watermark >= today else today
+
+    conditional = {}
+    # a full walk goes unconditional so a 304 can't end it at the first page
+    if state['etag'] and not walk_all:
+        conditional['If-None-Match'] = state['etag']
+    if state['last_modified'] and not walk_all:
+        conditional['If-Modified-Since'] = state['last_modified']
+
+    any_changed = False
+    try:
+        first = True
+        for response, items in _pages(session, site, token, since, conditional):
+            if items is None:
+                return [_normalise(order, site) for order in known.values()]
+            if first:
+                state['etag'] = response.headers.get('ETag')
+                state['last_modified'] = response.headers.get('Last-Modified')
+                first = False
+
+            changed = False
+            for item in items:
+                order_id = item.get('order_id')
+                previous = known.get(order_id)
+                created_at = item.get('created_at') or ''
+                if previous is None:
+                    known[order_id] = {**_order_detail(session, site, token, order_id), **item}
+                    changed = True
+                elif previous.get('order_status') != item.get('order_status'):
+                    known[order_id] = {**previous, **item}
+                    changed = True
+                if created_at > (state['watermark'] or ''):
+                    state['watermark'] = created_at
+            any_changed = any_changed or changed
+            # between full walks, an unchanged page is taken to mean the older ones are too
+            if not changed and not walk_all:
+                break
+    except PageLimitReached as e:
+        logger.info(f"{e}, using v1 for this poll")
+        raise
+    except V2Unavailable:
+        _v1_until[site] = time.monotonic() + V1_RECHECK_SECONDS
+        logger.info(f"{site} has no v2 orders API, using v1 for the next {V1_RECHECK_SECONDS}s")
+        raise
+
+    with _lock:
+        _cache[site] = {'date': today, 'orders': known}
+        if walk_all:
+            _full_walk_at[site] = time.monotonic()
+    try:
+        _save_state(site, state, today, known if any_changed else None)
+    except Exception as e:
+        log_error(f"Error saving order sync state for {site}: {e}")
+
+    return [_normalise(order, site) for order in known.values()]
+
+def reset(site=None):
+    """Forget cached orders and validators so the next poll is a full fetch."""
+    with _lock:
+        if site:
+            _cache.pop(site, None)
+            _v1_until.pop(site, None)
+            _full_walk_at.pop(site, None)
+        else:
+            _cache.clear()
+            _v1_until.clear()
+            _full_walk_at.clear()
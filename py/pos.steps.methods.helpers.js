@@ -197,6 +197,7 @@
             case 'dine':
                 document.getElementById('inputsForDine').style.display = 'block';
                 generateTableSelection(tables);
+                refreshTableSelection();
                 break;
         }
 
@@ -387,3 +388,75 @@
             `;
         }, 300);
     }
+
+    // Live floor map: /floor_events pushes table changes; without EventSource
+    // (or once the stream gives up) /floor_snapshot is polled instead.
+    const FLOOR_POLL_MS = 10000;
+    let floorTables = null;
+    let floorPollTimer = null;
+
+    function startFloorEvents() {
+        if (!window.EventSource) {
+            startFloorPolling();
+            return;
+        }
+        const source = new EventSource('/floor_events');
+        source.addEventListener('snapshot', e => applyFloorSnapshot(JSON.parse(e.data)));
+        source.addEventListener('tables', e => applyFloorChanges(JSON.parse(e.data).changes));
+        // rooms or tables were edited; the new layout comes from a snapshot
+        source.addEventListener('layout', () => loadFloorSnapshot());
+        source.onerror = () => {
+            // the browser reconnects by itself with Last-Event-ID unless the stream is closed for good
+            if (source.readyState === EventSource.CLOSED) {
+                startFloorPolling();
+            }
+        };
+    }
+
+    function startFloorPolling() {
+        if (floorPollTimer) return;
+        loadFloorSnapshot();
+        floorPollTimer = setInterval(loadFloorSnapshot, FLOOR_POLL_MS);
+    }
+
+    function loadFloorSnapshot() {
+        return fetch('/floor_snapshot')
+            .then(response => response.json())
+            .then(applyFloorSnapshot)
+            .catch(error => console.error('Floor snapshot error:', error));
+    }
+
+    function applyFloorSnapshot(snapshot) {
+        floorTables = snapshot.tables || [];
+        refreshTableSelection();
+    }
+
+    function applyFloorChanges(changes) {
+        if (!floorTables) return;
+        (changes || []).forEach(change => {
+            const table = floorTables.find(t => t.table_id === change.table_id);
+            if (table) {
+                table.cart_id = change.cart_id;
+                table.cover = change.cover;
+            }
+        });
+        refreshTableSelection();
+    }
+
+    // redraw the dine-in table picker, if it is showing, from the live map
+    function refreshTableSelection() {
+        const container = document.getElementById('tableSelectionContainer');
+        const dineInputs = document.getElementById('inputsForDine');
+        if (!floorTables || !container || !dineInputs || dineInputs.style.display === 'none') return;
+
+        const selected = container.querySelector('input[name="selectedTable"]:checked');
+        generateTableSelection(floorTables.map(t => ({
+            table_id: t.table_id,
+            table_number: t.table_number,
+            table_occupied: t.cart_id
+        })));
+        if (selected) {
+            const again = document.getElementById(selected.id);
+            if (again && !again.disabled) again.checked = true;
+        }
+    }
@@ -0,0 +1,268 @@
+import json, threading
+from datetime import datetime, timedelta
+from . import database, archive, caller_lookup, floor_state
+from logging_utils import logger, log_error
+
+CART_CHUNK = 500
+CUSTOMER_CHUNK = 200
+MODES = ('delete', 'anonymise')
+ANONYMISED_NAME = 'Anonymised'
+GUEST_TELEPHONE = '00000'
+# cart_id-keyed rows kept only in the live database
+LIVE_CART_TABLES = ('stock_reservations', 'cart_ledger', 'shift_carts')
+
+_wake = threading.Event()
+_worker = None
+_worker_lock = threading.Lock()
+
+def create_retention_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS retention_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            params TEXT NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'queued',
+            customers_total INTEGER NOT NULL DEFAULT 0,
+            customers_done INTEGER NOT NULL DEFAULT 0,
+            carts_total INTEGER NOT NULL DEFAULT 0,
+            carts_done INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at DATETIME DEFAULT (datetime('now', 'localtime')),
+            finished_at DATETIME
+        )
+    ''')
+    cursor.execute("PRAGMA table_info(customers)")
+    if 'anonymised_at' not in [col[1] for col in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE customers ADD COLUMN anonymised_at DATETIME')
+    # the cascades below look carts and their rows up by these
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cart_customer ON cart(customer_id, cart_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cart_item_cart ON cart_item(cart_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_refunds_cart ON refunds(cart_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cart_dining_tables_cart ON cart_dining_tables(cart_id)")
+
+def _queue(kind, mode, params):
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {', '.join(MODES)}")
+    conn = None
+    try:
+        conn, cursor = database.get_database_connection()
+        cursor.execute("INSERT INTO retention_jobs (kind, mode, params) VALUES (?, ?, ?)",
+                       (kind, mode, json.dumps(params)))
+        job_id = cursor.lastrowid
+        conn.commit()
+    finally:
+        if conn:
+            conn.close()
+    start_worker()
+    _wake.set()
+    return job_id
+
+def queue_customer(customer_id, mode='delete'):
+    """Remove (or anonymise) one customer and everything linked to them in the background; returns the job id."""
+    return _queue('customer', mode, {'customer_id': int(customer_id)})
+
+def queue_inactive_purge(years, mode='anonymise'):
+    """Remove (or anonymise) customers whose last order is more than years old; returns the job id."""
+    return _queue('inactive', mode, {'years': float(years)})
+
+def job_status(job_id):
+    """{'job_id': 4, 'status': 'running', 'carts_done': 1500, 'carts_total': 4200, 'progress': 0.36, ...} or None"""
+    conn = None
+    try:
+        conn, cursor = database.get_database_connection()
+        cursor.execute("SELECT * FROM retention_jobs WHERE job_id = ?", (job_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        job = dict(zip([desc[0] for desc in cursor.description], row))
+        job['params'] = json.loads(job['params'])
+        work = job['carts_total'] + job['customers_total']
+        job['progress'] = round((job['carts_done'] + job['customers_done']) / work, 3) if work else (1.0 if job['status'] == 'done' else 0.0)
+        return job
+    finally:
+        if conn:
+            conn.close()
+
+def _schemas(cursor):
+    cursor.execute("PRAGMA database_list")
+    return [row[1] for row in cursor.fetchall() if row[1] in ('main', 'archive')]
+
+def _tables(cursor, schema):
+    cursor.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type = 'table'")
+    return {row[0] for row in cursor.fetchall()}
+
+def _candidates(cursor, job):
+    params = json.loads(job['params'])
+    if job['kind'] == 'customer':
+        cursor.execute("SELECT customer_id FROM customers WHERE customer_id = ? AND customer_telephone IS NOT ?",
+                       (params['customer_id'], GUEST_TELEPHONE))
+    else:
+        # customers with orders, none of them recent; anonymised ones are done already
+        cutoff = (datetime.now() - timedelta(days=365.25 * params['years'])).strftime('%Y-%m-%d %H:%M:%S')
+        cursor.execute('''
+            SELECT cu.customer_id FROM customers cu
+            WHERE cu.customer_telephone IS NOT ?
+              AND cu.anonymised_at IS NULL
+              AND EXISTS (SELECT 1 FROM all_cart c WHERE c.customer_id = cu.customer_id)
+              AND NOT EXISTS (SELECT 1 FROM all_cart c WHERE c.customer_id = cu.customer_id AND c.order_date >= ?)
+            ORDER BY cu.customer_id
+        ''', (GUEST_TELEPHONE, cutoff))
+    return [row[0] for row in cursor.fetchall()]
+
+def _progress(cursor, job_id, **values):
+    cursor.execute(
+        f"UPDATE retention_jobs SET {', '.join(f'{k} = ?' for k in values)} WHERE job_id = ?",
+        (*values.values(), job_id)
+    )
+
+def _delete_carts(cursor, schema, tables, ids):
+    """Delete one chunk of carts and every row hanging off them; returns how many dining tables were freed."""
+    freed = 0
+    for table, key in archive.ARCHIVED_TABLES.items():
+        if table != 'cart' and table in tables:
+            cursor.execute(f'DELETE FROM {schema}."{table}" WHERE {key} IN (SELECT value FROM json_each(?))', (ids,))
+    if schema == 'main':
+        for table in LIVE_CART_TABLES:
+            if table in tables:
+                cursor.execute(f'DELETE FROM main."{table}" WHERE cart_id IN (SELECT value FROM json_each(?))', (ids,))
+        cursor.execute("UPDATE dining_tables SET table_occupied = 0 WHERE table_occupied IN (SELECT value FROM json_each(?))", (ids,))
+        freed = cursor.rowcount
+        cursor.execute("INSERT INTO sync_outbox (cart_id, change_type) SELECT value, 'deleted' FROM json_each(?)", (ids,))
+    cursor.execute(f"DELETE FROM {schema}.cart WHERE cart_id IN (SELECT value FROM json_each(?))", (ids,))
+    return freed
+
+def _run_job(conn, cursor, job):
+    job_id = job['job_id']
+    customers = _candidates(cursor, job)
+    schemas = _schemas(cursor)
+    carts_total = 0
+    for start in range(0, len(customers), CUSTOMER_CHUNK):
+        chunk = json.dumps(customers[start:start + CUSTOMER_CHUNK])
+        for schema in schemas:
+            condition = "" if job['mode'] == 'delete' else "AND overall_note IS NOT NULL"
+            cursor.execute(f"SELECT COUNT(*) FROM {schema}.cart WHERE customer_id IN (SELECT value FROM json_each(?)) {condition}", (chunk,))
+            carts_total += cursor.fetchone()[0]
+    _progress(cursor, job_id, customers_total=len(customers), carts_total=carts_total)
+    conn.commit()
+
+    carts_done = 0
+    customers_done = 0
+    conn.isolation_level = None
+    for start in range(0, len(customers), CUSTOMER_CHUNK):
+        chunk = json.dumps(customers[start:start + CUSTOMER_CHUNK])
+        for schema in schemas:
+            tables = _tables(cursor, schema)
+            while True:
+                # one bounded transaction per chunk keeps checkouts from waiting long
+                cursor.execute("BEGIN IMMEDIATE")
+                freed = 0
+                if job['mode'] == 'delete':
+                    cursor.execute(f"SELECT cart_id FROM {schema}.cart WHERE customer_id IN (SELECT value FROM json_each(?)) LIMIT ?",
+                                   (chunk, CART_CHUNK))
+                    ids = [row[0] for row in cursor.fetchall()]
+                    if ids:
+                        freed = _delete_carts(cursor, schema, tables, json.dumps(ids))
+                else:
+                    # notes can hold addresses and phone numbers
+                    cursor.execute(f'''
+                        UPDATE {schema}.cart SET overall_note = NULL
+                        WHERE cart_id IN (SELECT cart_id FROM {schema}.cart
+                                          WHERE customer_id IN (SELECT value FROM json_each(?))
+                                            AND overall_note IS NOT NULL LIMIT ?)
+                    ''', (chunk, CART_CHUNK))
+                    ids = range(cursor.rowcount)
+                carts_done += len(ids)
+                _progress(cursor, job_id, carts_done=carts_done)
+                cursor.execute("COMMIT")
+                if freed:
+                    floor_state.mark_changed('close')
+                if len(ids) < CART_CHUNK:
+                    break
+
+        cursor.execute("BEGIN IMMEDIATE")
+        # customer_addresses.customer_id is a TEXT column
+        cursor.execute("DELETE FROM customer_addresses WHERE customer_id IN (SELECT CAST(value AS TEXT) FROM json_each(?))", (chunk,))
+        cursor.execute("DELETE FROM customer_profiles WHERE customer_id IN (SELECT value FROM json_each(?))", (chunk,))
+        if job['mode'] == 'delete':
+            cursor.execute("DELETE FROM customers WHERE customer_id IN (SELECT value FROM json_each(?))", (chunk,))
+        else:
+            cursor.execute('''
+                UPDATE customers
+                SET customer_name = ?, customer_telephone = NULL, customer_telephone_key = NULL,
+                    anonymised_at = datetime('now', 'localtime')
+                WHERE customer_id IN (SELECT value FROM json_each(?))
+            ''', (ANONYMISED_NAME, chunk))
+        customers_done += len(json.loads(chunk))
+        _progress(cursor, job_id, customers_done=customers_done)
+        cursor.execute("COMMIT")
+    caller_lookup.clear_cache()
+    return customers_done, carts_done
+
+def _next_job(cursor):
+    cursor.execute("SELECT * FROM retention_jobs WHERE status = 'queued' ORDER BY job_id LIMIT 1")
+    row = cursor.fetchone()
+    return dict(zip([desc[0] for desc in cursor.description], row)) if row else None
+
+def _schedule_policy(cursor):
+    """Queue the inactive-customer purge once a day when retention_inactive_years is set."""
+    cursor.execute("SELECT key, value FROM settings WHERE key IN ('retention_inactive_years', 'retention_mode', 'retention_last_run')")
+    settings = dict(cursor.fetchall())
+    try:
+        years = float(settings.get('retention_inactive_years') or 0)
+    except ValueError:
+        years = 0
+    today = datetime.now().strftime('%Y-%m-%d')
+    if years <= 0 or settings.get('retention_last_run') == today:
+        return
+    mode = settings.get('retention_mode') if settings.get('retention_mode') in MODES else 'anonymise'
+    cursor.execute("INSERT INTO retention_jobs (kind, mode, params) VALUES ('inactive', ?, ?)",
+                   (mode, json.dumps({'years': years})))
+    cursor.execute("INSERT INTO settings (key, value) VALUES ('retention_last_run', ?) "
+                   "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (today,))
+
+def _run():
+    conn, cursor = database.get_database_connection()
+    try:
+        # a job interrupted by a restart starts again; finished chunks are already gone
+        cursor.execute("UPDATE retention_jobs SET status = 'queued' WHERE status = 'running'")
+        conn.commit()
+    finally:
+        conn.close()
+
+    while True:
+        _wake.clear()
+        conn = None
+        try:
+            conn, cursor = archive.history_connection()
+            _schedule_policy(cursor)
+            job = _next_job(cursor)
+            if job:
+                _progress(cursor, job['job_id'], status='running')
+            conn.commit()
+            if job:
+                try:
+                    customers, carts = _run_job(conn, cursor, job)
+                    _progress(cursor, job['job_id'], status='done', finished_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                    logger.info(f"Retention job {job['job_id']} ({job['kind']}, {job['mode']}): {customers} customers, {carts} carts")
+                except Exception as e:
+                    # any error fails the job; left 'running' it would be retried on every restart
+                    if conn.in_transaction:
+                        conn.rollback()
+                    _progress(cursor, job['job_id'], status='failed', error=str(e))
+                    conn.commit()
+                    log_error(f"Retention job {job['job_id']} failed: {e}")
+                continue
+        except Exception as e:
+            log_error(f"Retention worker error: {e}")
+        finally:
+            if conn:
+                conn.close()
+        _wake.wait(3600)
+
+def start_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, daemon=True)
+            _worker.start()
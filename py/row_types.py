@@ -0,0 +1,10 @@
+def columns(cursor):
+    """Column names of the cursor's last query, read once per query rather than per row."""
+    return tuple(desc[0] for desc in cursor.description)
+
+def dicts(cursor, rows=None):
+    """Rows as dicts keyed by column name; fetches the rest of the cursor when rows isn't given."""
+    names = columns(cursor)
+    if rows is None:
+        rows = cursor.fetchall()
+    return [dict(zip(names, row)) for row in rows]
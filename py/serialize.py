@@ -0,0 +1,33 @@
+import json, dataclasses
+from datetime import date, datetime
+from decimal import Decimal
+
+# orjson is optional; without it responses go through the standard library
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if dataclasses.is_dataclass(value):
+        return dataclasses.asdict(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def dumps(data):
+    """UTF-8 JSON bytes for plain data returned by the data layer."""
+    if orjson is not None:
+        return orjson.dumps(data, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=_default, separators=(',', ':')).encode()
+
+def response(data, status=200):
+    """
+    The HTTP edge: one encode of plain data into a JSON response, in place
+    of jsonify. Data functions stay free of Flask so workers and scripts can
+    call them without an app context.
+    """
+    from flask import Response
+    return Response(dumps(data), status=status, mimetype='application/json')
@@ -0,0 +1,359 @@
+import json, sqlite3
+from datetime import datetime, timedelta
+from . import database, archive
+from logging_utils import logger, log_error
+
+# accumulator columns, named as fetch_totals returns them so print_pos_totals takes either
+COUNTERS = (
+    'grand_total', 'total_orders',
+    'dine_count', 'takeaway_count', 'delivery_count', 'waiting_count', 'sale_count',
+    'card_payments_count', 'card_payments_total', 'cash_payments_count', 'cash_payments_total',
+    'refunded_orders_count', 'total_refunds', 'total_vat_amount',
+    'void_count', 'void_total'
+)
+ORDER_TYPES = ('dine', 'takeaway', 'delivery', 'waiting', 'sale')
+REFUNDED_STATUSES = ('refunded', 'partial_refund')
+
+def create_shift_tables(cursor):
+    columns = ",\n".join(f"            {name} REAL NOT NULL DEFAULT 0" for name in COUNTERS)
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS shift_totals (
+            business_date TEXT PRIMARY KEY,
+{columns},
+            updated_at DATETIME DEFAULT (datetime('now', 'localtime'))
+        )
+    ''')
+    # what each completed cart added to its day, so a void can take exactly that back out
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shift_carts (
+            cart_id INTEGER PRIMARY KEY,
+            business_date TEXT NOT NULL,
+            order_type TEXT,
+            total REAL NOT NULL DEFAULT 0,
+            card_count INTEGER NOT NULL DEFAULT 0,
+            card_total REAL NOT NULL DEFAULT 0,
+            cash_count INTEGER NOT NULL DEFAULT 0,
+            cash_total REAL NOT NULL DEFAULT 0,
+            vat_amount REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS z_reports (
+            report_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            business_date TEXT NOT NULL UNIQUE,
+            totals TEXT NOT NULL,
+            closed_at DATETIME DEFAULT (datetime('now', 'localtime')),
+            closed_by INTEGER
+        )
+    ''')
+    # snapshots are written once and never edited
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS z_reports_immutable
+        BEFORE UPDATE ON z_reports
+        BEGIN
+            SELECT RAISE(ABORT, 'Z reports cannot be changed');
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS z_reports_undeletable
+        BEFORE DELETE ON z_reports
+        BEGIN
+            SELECT RAISE(ABORT, 'Z reports cannot be deleted');
+        END
+    ''')
+
+def _cut_off_hour(cursor):
+    cursor.execute("SELECT value FROM settings WHERE key = 'cut_off_hour'")
+    row = cursor.fetchone()
+    try:
+        return int(row[0]) if row else 0
+    except (ValueError, TypeError):
+        return 0
+
+def business_date(cursor, timestamp=None):
+    """'YYYY-MM-DD' of the trading day a 'YYYY-MM-DD HH:MM:SS' time falls in, as fetch_totals windows it."""
+    moment = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S') if timestamp else datetime.now()
+    return (moment - timedelta(hours=_cut_off_hour(cursor))).strftime('%Y-%m-%d')
+
+def _is_closed(cursor, date):
+    cursor.execute("SELECT 1 FROM z_reports WHERE business_date = ?", (date,))
+    return cursor.fetchone() is not None
+
+def _open_date(cursor, date):
+    """date, or the first day after it without a Z report; sales after a close roll forward."""
+    while _is_closed(cursor, date):
+        date = (datetime.strptime(date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+    return date
+
+def _add(cursor, date, **amounts):
+    """Add to one day's counters in a single upsert."""
+    names = [name for name in amounts if name in COUNTERS]
+    cursor.execute(f'''
+        INSERT INTO shift_totals (business_date, {", ".join(names)})
+        VALUES (?, {", ".join("?" * len(names))})
+        ON CONFLICT(business_date) DO UPDATE SET
+            {", ".join(f"{name} = {name} + excluded.{name}" for name in names)},
+            updated_at = datetime('now', 'localtime')
+    ''', (date, *(amounts[name] for name in names)))
+
+def _ensure_day(cursor, date, prefix=''):
+    """Seed date from the cart tables if it has no accumulator row yet; True if it did."""
+    cursor.execute("SELECT 1 FROM shift_totals WHERE business_date = ?", (date,))
+    if cursor.fetchone():
+        return False
+    _rebuild_day(cursor, date, prefix)
+    return True
+
+def record_sale(cursor, cart_id, timestamp=None, prefix=''):
+    """
+    Add a completed cart to its business day. Call inside the checkout
+    transaction after payments and VAT are written. A cart is only
+    counted once.
+    """
+    date = _open_date(cursor, business_date(cursor, timestamp))
+    _ensure_day(cursor, date, prefix)
+    cursor.execute("SELECT 1 FROM shift_carts WHERE cart_id = ?", (cart_id,))
+    if cursor.fetchone():
+        return
+    cursor.execute(f'''
+        SELECT c.order_type, COALESCE(c.vat_amount, 0),
+               COALESCE(SUM(cp.discounted_total), 0),
+               SUM(CASE WHEN cp.payment_method LIKE 'Card%' THEN 1 ELSE 0 END),
+               COALESCE(SUM(CASE WHEN cp.payment_method LIKE 'Card%' THEN cp.discounted_total END), 0),
+               SUM(CASE WHEN cp.payment_method = 'Cash' THEN 1 ELSE 0 END),
+               COALESCE(SUM(CASE WHEN cp.payment_method = 'Cash' THEN cp.discounted_total END), 0),
+               COUNT(cp.cart_id)
+        FROM {prefix}cart c
+        LEFT JOIN {prefix}cart_payments cp ON cp.cart_id = c.cart_id
+        WHERE c.cart_id = ?
+        GROUP BY c.cart_id
+    ''', (cart_id,))
+    row = cursor.fetchone()
+    if not row or not row[7]:
+        # fetch_totals only counts carts with a payment row
+        return
+    order_type, vat_amount, total, card_count, card_total, cash_count, cash_total, _ = row
+    cursor.execute('''
+        INSERT INTO shift_carts (cart_id, business_date, order_type, total,
+                                 card_count, card_total, cash_count, cash_total, vat_amount)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (cart_id, date, order_type, total, card_count, card_total, cash_count, cash_total, vat_amount))
+    amounts = {
+        'grand_total': total,
+        'total_orders': 1,
+        'card_payments_count': card_count,
+        'card_payments_total': card_total,
+        'cash_payments_count': cash_count,
+        'cash_payments_total': cash_total,
+        'total_vat_amount': vat_amount
+    }
+    if order_type in ORDER_TYPES:
+        amounts[f'{order_type}_count'] = 1
+    _add(cursor, date, **amounts)
+
+def record_refund(cursor, amount, first_refund, timestamp=None, has_refund_row=True):
+    """
+    Add a refund to the business day it's made on; earlier days, closed or
+    not, keep their sales. first_refund is whether the cart wasn't already
+    refunded, so split refunds count the order once. has_refund_row is
+    whether the refund was written to refunds in this transaction; a day
+    seeded now picks those up itself.
+    """
+    date = _open_date(cursor, business_date(cursor, timestamp))
+    if _ensure_day(cursor, date) and has_refund_row:
+        # the seed already picked this refund up
+        return
+    _add(cursor, date, total_refunds=amount or 0, refunded_orders_count=1 if first_refund else 0)
+
+def void_cart(cursor, cart_id):
+    """
+    Take a completed cart that's being deleted back out of the totals,
+    every figure it added reversed together so payments still add up to
+    the grand total. Reversed on its own day while that day is open; once
+    the day has a Z report the reversal is booked against today instead.
+    """
+    cursor.execute('''
+        SELECT business_date, order_type, total, card_count, card_total,
+               cash_count, cash_total, vat_amount
+        FROM shift_carts WHERE cart_id = ?
+    ''', (cart_id,))
+    row = cursor.fetchone()
+    if not row:
+        return
+    date, order_type, total, card_count, card_total, cash_count, cash_total, vat_amount = row
+    if _is_closed(cursor, date):
+        date = _open_date(cursor, business_date(cursor))
+        _ensure_day(cursor, date)
+    amounts = {
+        'grand_total': -total,
+        'total_orders': -1,
+        'card_payments_count': -card_count,
+        'card_payments_total': -card_total,
+        'cash_payments_count': -cash_count,
+        'cash_payments_total': -cash_total,
+        'total_vat_amount': -vat_amount,
+        'void_count': 1,
+        'void_total': total
+    }
+    if order_type in ORDER_TYPES:
+        amounts[f'{order_type}_count'] = -1
+    _add(cursor, date, **amounts)
+    cursor.execute("DELETE FROM shift_carts WHERE cart_id = ?", (cart_id,))
+
+def _rebuild_day(cursor, date, prefix=''):
+    """
+    Seed a day with no accumulator row from the cart tables, for days
+    traded before the accumulators existed. prefix 'all_' reads through
+    the archive views of archive.history_connection(). Refunds count on
+    the day they were made (refunds.timestamp is UTC); carts refunded
+    before the accumulators existed count on their refund day, as
+    fetch_totals has them.
+    """
+    cursor.execute("INSERT OR IGNORE INTO shift_totals (business_date) VALUES (?)", (date,))
+    cut_off = _cut_off_hour(cursor)
+    start = datetime.strptime(date, '%Y-%m-%d') + timedelta(hours=cut_off)
+    start_str = start.strftime('%Y-%m-%d %H:%M:%S')
+    end_str = (start + timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
+    cursor.execute(f'''
+        SELECT c.cart_id, c.cart_charge_updated FROM {prefix}cart c
+        WHERE c.cart_charge_updated >= ? AND c.cart_charge_updated < ?
+          AND c.cart_status IN ('completed', 'refunded', 'partial_refund')
+          AND c.cart_id NOT IN (SELECT cart_id FROM shift_carts)
+    ''', (start_str, end_str))
+    for cart_id, charged in cursor.fetchall():
+        record_sale(cursor, cart_id, charged, prefix)
+    cursor.execute(f'''
+        SELECT COALESCE(SUM(amount), 0), COUNT(DISTINCT cart_id) FROM {prefix}refunds
+        WHERE datetime(timestamp, 'localtime') >= ? AND datetime(timestamp, 'localtime') < ?
+    ''', (start_str, end_str))
+    refunded, refunded_orders = cursor.fetchone()
+    _add(cursor, date, total_refunds=refunded, refunded_orders_count=refunded_orders)
+
+def _processing(cursor):
+    """Open orders right now; live rather than accumulated, as in fetch_totals."""
+    cursor.execute('''
+        SELECT
+            (SELECT COUNT(*) FROM cart WHERE cart_status = 'processing'),
+            COALESCE((SELECT SUM(ci.price) FROM cart_item ci
+                      JOIN cart c ON ci.cart_id = c.cart_id
+                      WHERE c.cart_status = 'processing'), 0)
+    ''')
+    count, total = cursor.fetchone()
+    return {'processing_orders_count': count, 'processing_orders_total': total}
+
+def _read(cursor, date):
+    cursor.execute(f"SELECT {', '.join(COUNTERS)} FROM shift_totals WHERE business_date = ?", (date,))
+    row = cursor.fetchone()
+    totals = dict(zip(COUNTERS, row)) if row else dict.fromkeys(COUNTERS, 0)
+    for name in COUNTERS:
+        if name.endswith('_count') or name == 'total_orders':
+            totals[name] = int(totals[name])
+        else:
+            totals[name] = round(totals[name], 2)
+    totals.update(_processing(cursor))
+    totals['start_date'] = totals['end_date'] = date
+    return totals
+
+def x_read(date=None):
+    """
+    Running totals for a business day (default: the current one) without
+    closing it. Same keys as fetch_totals plus void_count/void_total,
+    start_date and end_date.
+    """
+    conn = None
+    try:
+        conn, cursor = archive.history_connection()
+        date = date or business_date(cursor)
+        cursor.execute("SELECT totals FROM z_reports WHERE business_date = ?", (date,))
+        closed = cursor.fetchone()
+        if closed:
+            return json.loads(closed[0])
+        cursor.execute("SELECT 1 FROM shift_totals WHERE business_date = ?", (date,))
+        if cursor.fetchone() is None:
+            conn.isolation_level = None
+            cursor.execute("BEGIN IMMEDIATE")
+            _ensure_day(cursor, date, 'all_')
+            cursor.execute("COMMIT")
+        return _read(cursor, date)
+    except sqlite3.Error as e:
+        if conn and conn.in_transaction:
+            conn.rollback()
+        log_error(f"Error reading shift totals: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def close_day(date=None, employee_id=0):
+    """
+    Write the Z report for a business day. Returns
+    {'report_id': 3, 'business_date': '2024-05-01', 'totals': {...}, 'closed_at': ..., 'closed_by': 1}
+    with already_closed True if the day had been closed before.
+    """
+    conn = None
+    try:
+        conn, cursor = archive.history_connection()
+        date = date or business_date(cursor)
+        conn.isolation_level = None
+        cursor.execute("BEGIN IMMEDIATE")
+        existing = _report(cursor, 'business_date', date)
+        if existing:
+            cursor.execute("COMMIT")
+            existing['already_closed'] = True
+            return existing
+        _ensure_day(cursor, date, 'all_')
+        totals = _read(cursor, date)
+        cursor.execute("INSERT INTO z_reports (business_date, totals, closed_by) VALUES (?, ?, ?)",
+                       (date, json.dumps(totals), employee_id))
+        report = _report(cursor, 'report_id', cursor.lastrowid)
+        cursor.execute("COMMIT")
+        logger.info(f"Z report {report['report_id']} closed for {date}")
+        report['already_closed'] = False
+        return report
+    except sqlite3.Error as e:
+        if conn and conn.in_transaction:
+            conn.rollback()
+        log_error(f"Error closing business day: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def _report(cursor, column, value):
+    cursor.execute(f"SELECT report_id, business_date, totals, closed_at, closed_by FROM z_reports WHERE {column} = ?", (value,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    report = dict(zip([desc[0] for desc in cursor.description], row))
+    report['totals'] = json.loads(report['totals'])
+    return report
+
+def get_z_report(report_id):
+    """A stored Z report as it was closed; reprinting reads only this."""
+    conn = None
+    try:
+        conn, cursor = database.get_database_connection()
+        return _report(cursor, 'report_id', report_id)
+    except sqlite3.Error as e:
+        log_error(f"Error reading Z report: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def list_z_reports(limit=30):
+    conn = None
+    try:
+        conn, cursor = database.get_database_connection()
+        cursor.execute('''
+            SELECT report_id, business_date, closed_at, closed_by,
+                   json_extract(totals, '$.grand_total') AS grand_total
+            FROM z_reports ORDER BY business_date DESC LIMIT ?
+        ''', (limit,))
+        return [dict(zip([desc[0] for desc in cursor.description], row)) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        log_error(f"Error listing Z reports: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
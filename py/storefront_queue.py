@@ -0,0 +1,275 @@
+import json, time, random, threading, requests
+from concurrent.futures import ThreadPoolExecutor
+from pos import database as posdb
+from logging_utils import logger, log_error
+
+MAX_BACKOFF = 300
+REQUEST_TIMEOUT = (3.05, 10)
+# sent commands are kept this long so the backlog page can show recent history
+KEEP_SENT_DAYS = 7
+
+_wake = threading.Event()
+_worker = None
+_worker_lock = threading.Lock()
+
+def create_queue_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS storefront_commands (
+            command_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            site TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            order_id TEXT NOT NULL,
+            url TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at DATETIME DEFAULT (datetime('now', 'localtime')),
+            sent_at DATETIME
+        )
+    ''')
+    # one pending command per order and kind, later updates replace its payload
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_storefront_commands_pending
+        ON storefront_commands(site, kind, order_id) WHERE status = 'pending'
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_storefront_commands_status ON storefront_commands(status, site, command_id)")
+
+def _insert(cursor, site, kind, order_id, url, payload):
+    cursor.execute('''
+        INSERT INTO storefront_commands (site, kind, order_id, url, payload)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(site, kind, order_id) WHERE status = 'pending'
+        DO UPDATE SET url = excluded.url, payload = excluded.payload,
+                      attempts = 0, next_attempt_at = 0, last_error = NULL
+        RETURNING command_id
+    ''', (site, kind, str(order_id), url, payload))
+    return cursor.fetchone()[0]
+
+def enqueue(site, kind, order_id, url, payload):
+    """
+    Store a storefront call and return straight away with its command_id;
+    the worker delivers it and command_status() reports how that went.
+    """
+    conn = None
+    try:
+        conn, cursor = posdb.get_database_connection()
+        command_id = _insert(cursor, site, kind, order_id, url, json.dumps(payload))
+        conn.commit()
+    finally:
+        if conn:
+            conn.close()
+    start_worker()
+    _wake.set()
+    return command_id
+
+def _next_per_site(cursor):
+    """Head of each site's queue; later commands wait so delivery stays in order."""
+    cursor.execute('''
+        SELECT command_id, site, kind, order_id, url, payload, attempts, next_attempt_at
+        FROM storefront_commands
+        WHERE command_id IN (
+            SELECT MIN(command_id) FROM storefront_commands
+            WHERE status = 'pending'
+            GROUP BY site
+        )
+    ''')
+    return cursor.fetchall()
+
+def _deliver(command):
+    command_id, site, kind, order_id, url, payload, attempts, _ = command
+    conn = None
+    try:
+        conn, cursor = posdb.get_database_connection()
+        # 'sending' takes it out of the coalescing index while in flight
+        cursor.execute("UPDATE storefront_commands SET status = 'sending' WHERE command_id = ? AND status = 'pending'", (command_id,))
+        conn.commit()
+        if cursor.rowcount == 0:
+            return
+
+        error = None
+        permanent = False
+        try:
+            response = requests.post(url, json=json.loads(payload),
+                                     headers={"Content-Type": "application/json"}, timeout=REQUEST_TIMEOUT)
+            if response.status_code != 200:
+                error = f"Status code: {response.status_code}"
+                # client errors won't succeed on retry and would block the site's queue
+                permanent = 400 <= response.status_code < 500 and response.status_code not in (408, 429)
+        except requests.exceptions.RequestException as e:
+            error = str(e)
+
+        if error is None:
+            cursor.execute('''
+                UPDATE storefront_commands
+                SET status = 'sent', attempts = attempts + 1, last_error = NULL, sent_at = datetime('now', 'localtime')
+                WHERE command_id = ?
+            ''', (command_id,))
+        elif permanent:
+            log_error(f"Storefront {kind} for order {order_id} on {site} rejected: {error}")
+            cursor.execute('''
+                UPDATE storefront_commands SET status = 'failed', attempts = attempts + 1, last_error = ?
+                WHERE command_id = ?
+            ''', (error, command_id))
+        else:
+            delay = min(MAX_BACKOFF, 2 ** attempts) * random.uniform(0.5, 1.0)
+            logger.info(f"Storefront {kind} for order {order_id} on {site} failed, retrying in {delay:.0f}s: {error}")
+            # OR IGNORE: a newer update for the same order may have been queued meanwhile
+            cursor.execute('''
+                UPDATE OR IGNORE storefront_commands
+                SET status = 'pending', attempts = attempts + 1, next_attempt_at = ?, last_error = ?
+                WHERE command_id = ?
+            ''', (time.time() + delay, error, command_id))
+            cursor.execute("UPDATE storefront_commands SET status = 'superseded' WHERE command_id = ? AND status = 'sending'", (command_id,))
+        conn.commit()
+    except Exception as e:
+        log_error(f"Storefront queue error: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+def _run():
+    # commands left 'sending' by a crash are retried
+    conn, cursor = posdb.get_database_connection()
+    try:
+        cursor.execute("UPDATE OR IGNORE storefront_commands SET status = 'pending' WHERE status = 'sending'")
+        cursor.execute("UPDATE storefront_commands SET status = 'superseded' WHERE status = 'sending'")
+        conn.commit()
+    finally:
+        conn.close()
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        while True:
+            _wake.clear()
+            wait = 30
+            try:
+                conn, cursor = posdb.get_database_connection()
+                try:
+                    heads = _next_per_site(cursor)
+                    cursor.execute(
+                        "DELETE FROM storefront_commands WHERE status IN ('sent', 'superseded') AND created_at < datetime('now', 'localtime', ?)",
+                        (f"-{KEEP_SENT_DAYS} days",)
+                    )
+                    conn.commit()
+                finally:
+                    conn.close()
+
+                now = time.time()
+                due = [command for command in heads if command[7] <= now]
+                if due:
+                    # sites in parallel, each site's commands one at a time
+                    list(executor.map(_deliver, due))
+                    wait = 0
+                elif heads:
+                    wait = min(wait, max(0.5, min(command[7] for command in heads) - now))
+            except Exception as e:
+                log_error(f"Storefront queue error: {e}")
+            if wait:
+                _wake.wait(wait)
+
+def start_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, daemon=True)
+            _worker.start()
+
+def backlog():
+    """
+    Undelivered commands for the staff backlog view.
+    {'pending': 3, 'failed': 1, 'sites': [{'site': 'shop.example', 'pending': 3, 'oldest': '...', 'last_error': '...'}],
+     'failed_commands': [...]}
+    """
+    conn = None
+    try:
+        conn, cursor = posdb.get_database_connection()
+        cursor.execute('''
+            SELECT site, COUNT(*) AS pending, MIN(created_at) AS oldest, MAX(attempts) AS attempts,
+                   (SELECT last_error FROM storefront_commands s2
+                    WHERE s2.site = s.site AND s2.status = 'pending' AND s2.last_error IS NOT NULL
+                    ORDER BY command_id LIMIT 1) AS last_error
+            FROM storefront_commands s
+            WHERE status IN ('pending', 'sending')
+            GROUP BY site
+        ''')
+        columns = [col[0] for col in cursor.description]
+        sites = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+        cursor.execute('''
+            SELECT command_id, site, kind, order_id, last_error, created_at
+            FROM storefront_commands WHERE status = 'failed'
+            ORDER BY command_id DESC LIMIT 50
+        ''')
+        columns = [col[0] for col in cursor.description]
+        failed = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+        return {
+            'pending': sum(site['pending'] for site in sites),
+            'failed': len(failed),
+            'sites': sites,
+            'failed_commands': failed
+        }
+    finally:
+        if conn:
+            conn.close()
+
+def command_status(command_id):
+    """
+    Where a queued command stands, or None if it's unknown (sent and
+    pruned, or never queued).
+    {'command_id': 41, 'status': 'failed', 'attempts': 1, 'last_error': 'Status code: 422', 'sent_at': None}
+    """
+    conn = None
+    try:
+        conn, cursor = posdb.get_database_connection()
+        cursor.execute('''
+            SELECT command_id, status, attempts, last_error, sent_at
+            FROM storefront_commands WHERE command_id = ?
+        ''', (command_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        return dict(zip([col[0] for col in cursor.description], row))
+    finally:
+        if conn:
+            conn.close()
+
+def retry_failed(command_id):
+    """
+    Queue a rejected command again as a new command, so it is delivered
+    after anything already queued for its site. If a newer command for the
+    same order has been queued since, the rejected one is stale and is
+    dropped instead. Returns 'queued', 'superseded' or None if there is no
+    such failed command.
+    """
+    conn = None
+    try:
+        conn, cursor = posdb.get_database_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        cursor.execute('''
+            SELECT site, kind, order_id, url, payload FROM storefront_commands
+            WHERE command_id = ? AND status = 'failed'
+        ''', (command_id,))
+        command = cursor.fetchone()
+        if not command:
+            conn.rollback()
+            return None
+        site, kind, order_id, url, payload = command
+        cursor.execute('''
+            SELECT 1 FROM storefront_commands
+            WHERE site = ? AND kind = ? AND order_id = ? AND command_id > ?
+            LIMIT 1
+        ''', (site, kind, order_id, command_id))
+        result = 'superseded' if cursor.fetchone() else 'queued'
+        if result == 'queued':
+            _insert(cursor, site, kind, order_id, url, payload)
+        cursor.execute("UPDATE storefront_commands SET status = 'superseded' WHERE command_id = ?", (command_id,))
+        conn.commit()
+    finally:
+        if conn:
+            conn.close()
+    if result == 'queued':
+        start_worker()
+        _wake.set()
+    return result
@@ -0,0 +1,212 @@
+import json, gzip, random, uuid, threading, sqlite3, requests
+from . import database
+from logging_utils import logger, log_error
+
+BATCH_SIZE = 500
+MAX_BACKOFF = 300
+# receiving endpoint, relative to the licence server. The licence server has no
+# documented batch endpoint yet, so remote sync stays on helpers.start_sync_thread
+# and the pending flag; the outbox is only recorded and trimmed until this is set.
+SYNC_PATH = None
+# shipped rows are kept this long for troubleshooting before pruning
+KEEP_DAYS = 2
+
+def create_outbox_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sync_outbox (
+            outbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cart_id INTEGER NOT NULL,
+            change_type TEXT NOT NULL,
+            created_at DATETIME DEFAULT (datetime('now', 'localtime'))
+        )
+    ''')
+
+def record(cursor, cart_id, change_type):
+    """Append a cart change; call inside the transaction making the change."""
+    cursor.execute(
+        "INSERT INTO sync_outbox (cart_id, change_type) VALUES (?, ?)",
+        (cart_id, change_type)
+    )
+
+def record_item(cursor, cart_item_id, change_type):
+    """record() for the cart holding a cart line; call before deleting the line."""
+    cursor.execute("SELECT cart_id FROM cart_item WHERE cart_item_id = ?", (cart_item_id,))
+    row = cursor.fetchone()
+    if row:
+        record(cursor, row[0], change_type)
+
+def _get_setting(cursor, key):
+    cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def _set_setting(cursor, key, value):
+    cursor.execute("INSERT INTO settings (key, value) VALUES (?, ?) "
+                   "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                   (key, value))
+
+def terminal_id(cursor):
+    """Stable id for this till, used to namespace idempotency keys."""
+    value = _get_setting(cursor, 'sync_terminal_id')
+    if not value:
+        value = uuid.uuid4().hex
+        _set_setting(cursor, 'sync_terminal_id', value)
+    return value
+
+def next_batch(cursor, limit=BATCH_SIZE):
+    """
+    Changes after the stored cursor, coalesced to one entry per cart.
+    Returns None when there is nothing to ship, otherwise
+    {'first_id': 101, 'last_id': 180, 'orders': [...], 'deleted': [12, 15]}
+    """
+    position = int(_get_setting(cursor, 'sync_outbox_cursor') or 0)
+    cursor.execute('''
+        SELECT outbox_id, cart_id, change_type FROM sync_outbox
+        WHERE outbox_id > ?
+        ORDER BY outbox_id
+        LIMIT ?
+    ''', (position, limit))
+    rows = cursor.fetchall()
+    if not rows:
+        return None
+
+    latest = {}
+    for _, cart_id, change_type in rows:
+        latest[cart_id] = change_type
+    deleted = [cart_id for cart_id, change_type in latest.items() if change_type == 'deleted']
+    live = [cart_id for cart_id, change_type in latest.items() if change_type != 'deleted']
+
+    orders = []
+    if live:
+        cursor.execute('''
+            SELECT
+                c.cart_id,
+                c.order_date,
+                c.cart_status,
+                c.cart_discount,
+                c.vat_amount,
+                c.cart_discount_type,
+                COALESCE(t.total_amount, 0) AS total_amount,
+                COALESCE(t.item_count, 0) AS item_count
+            FROM cart c
+            LEFT JOIN (
+                SELECT cart_id,
+                    SUM(CASE
+                        WHEN product_discount_type = 'percentage' THEN
+                            (price * quantity) * (1 - product_discount/100)
+                        ELSE
+                            (price * quantity) - product_discount
+                    END) AS total_amount,
+                    COUNT(*) AS item_count
+                FROM cart_item
+                WHERE cart_id IN (SELECT value FROM json_each(?))
+                GROUP BY cart_id
+            ) t ON t.cart_id = c.cart_id
+            WHERE c.cart_id IN (SELECT value FROM json_each(?))
+        ''', (json.dumps(live), json.dumps(live)))
+        columns = [col[0] for col in cursor.description]
+        orders = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    return {'first_id': rows[0][0], 'last_id': rows[-1][0], 'orders': orders, 'deleted': deleted}
+
+def encode_batch(batch, terminal):
+    """Gzipped JSON body and headers; the idempotency key lets the server drop replays."""
+    idempotency_key = f"{terminal}-{batch['first_id']}-{batch['last_id']}"
+    body = gzip.compress(json.dumps({
+        'terminal': terminal,
+        'idempotency_key': idempotency_key,
+        'orders': batch['orders'],
+        'deleted': batch['deleted']
+    }, default=str).encode('utf-8'))
+    headers = {
+        'Content-Type': 'application/json',
+        'Content-Encoding': 'gzip',
+        'Idempotency-Key': idempotency_key
+    }
+    return body, headers
+
+def trim_unsent(cursor):
+    """Drop rows older than KEEP_DAYS while no worker ships them; call at startup."""
+    if SYNC_PATH is None:
+        cursor.execute("DELETE FROM sync_outbox WHERE created_at < datetime('now', 'localtime', ?)",
+                       (f"-{KEEP_DAYS} days",))
+
+def _prune(cursor, shipped_id):
+    cursor.execute(
+        "DELETE FROM sync_outbox WHERE outbox_id <= ? AND created_at < datetime('now', 'localtime', ?)",
+        (shipped_id, f"-{KEEP_DAYS} days")
+    )
+
+def ship_once(send):
+    """
+    Send one batch with send(body, headers) -> bool. The cursor only moves
+    after the server accepted it. Returns the number of carts shipped,
+    0 when idle, or None if sending failed.
+    """
+    conn = None
+    try:
+        conn, cursor = database.get_database_connection()
+        batch = next_batch(cursor)
+        if batch is None:
+            _prune(cursor, int(_get_setting(cursor, 'sync_outbox_cursor') or 0))
+            conn.commit()
+            return 0
+        body, headers = encode_batch(batch, terminal_id(cursor))
+        conn.commit()
+
+        if not send(body, headers):
+            return None
+
+        _set_setting(cursor, 'sync_outbox_cursor', str(batch['last_id']))
+        _prune(cursor, batch['last_id'])
+        conn.commit()
+        return len(batch['orders']) + len(batch['deleted'])
+    except sqlite3.Error as e:
+        log_error(f"Sync outbox error: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def http_sender(url, token=None, timeout=10):
+    """send() for ship_once posting to url; 2xx and 409 (already received) count as delivered."""
+    def send(body, headers):
+        if token:
+            headers = dict(headers, Authorization=f"Bearer {token}")
+        try:
+            response = requests.post(url, data=body, headers=headers, timeout=timeout)
+            return response.ok or response.status_code == 409
+        except requests.exceptions.RequestException as e:
+            logger.info(f"Sync outbox send failed: {e}")
+            return False
+    return send
+
+def run_worker(send, interval=15, stop_event=None):
+    """Ship batches until stop_event is set, backing off exponentially on failure."""
+    stop_event = stop_event or threading.Event()
+    failures = 0
+    while not stop_event.is_set():
+        shipped = ship_once(send)
+        if shipped is None:
+            failures += 1
+            delay = min(MAX_BACKOFF, interval * 2 ** failures) * random.uniform(0.5, 1.0)
+        else:
+            failures = 0
+            # keep draining while there is a backlog
+            delay = 0 if shipped else interval
+        stop_event.wait(delay)
+
+def start_sync_worker(base_url, token=None, interval=15):
+    """
+    Ship the outbox to base_url's sync endpoint in the background; set the
+    returned event to stop. Returns None without starting while SYNC_PATH
+    is unset.
+    """
+    if SYNC_PATH is None:
+        logger.info("Sync outbox worker not started: no sync endpoint configured")
+        return None
+    stop_event = threading.Event()
+    sender = http_sender(f"{base_url.rstrip('/')}/{SYNC_PATH}", token)
+    thread = threading.Thread(target=run_worker, args=(sender, interval, stop_event), daemon=True)
+    thread.start()
+    return stop_event
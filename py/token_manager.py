@@ -0,0 +1,144 @@
+import base64, json, time, random, threading, requests, config, database
+from logging_utils import logger, log_error
+
+# tokens are renewed this long before they expire, by the background refresher if it's running
+REFRESH_AHEAD = 600
+# a caller finding a token this close to expiry refreshes it itself
+REFRESH_MARGIN = 60
+MAX_ATTEMPTS = 3
+REQUEST_TIMEOUT = (3.05, 10)
+
+_lock = threading.Lock()
+_site_locks = {}
+_tokens = {}      # site -> {'token': 'eyJ...', 'exp': 1734567890 or None}
+_loaded = False
+
+def decode_expiry(token):
+    """The exp claim of a JWT as a unix timestamp, or None if it can't be read."""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        return int(exp) if exp else None
+    except (IndexError, ValueError, TypeError, AttributeError):
+        return None
+
+def _load():
+    global _loaded
+    with _lock:
+        if _loaded:
+            return
+        for site, token in database.get_tokens() or []:
+            _tokens[site] = {'token': token, 'exp': decode_expiry(token)}
+        _loaded = True
+
+def _site_lock(site):
+    with _lock:
+        return _site_locks.setdefault(site, threading.Lock())
+
+def _expiring(entry, within):
+    return entry['exp'] is not None and entry['exp'] - time.time() < within
+
+def _login(site):
+    """POST the shared secret to the site's login endpoint; returns a new JWT or None."""
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            response = requests.post(
+                f"https://{site}/app/v1/login.php",
+                json={'secret': config.SECRET_KEY, 'username': config.USERNAME_SIM},
+                headers={'Content-Type': 'application/json'},
+                timeout=REQUEST_TIMEOUT
+            )
+            if response.status_code == 200:
+                jwt = response.json().get('jwt')
+                if jwt:
+                    return jwt
+                log_error(f"Token refresh for {site}: JWT not found in the response")
+                return None
+            if response.status_code in (401, 403):
+                # credentials are wrong, retrying won't help
+                log_error(f"Token refresh for {site} rejected: {response.status_code}")
+                return None
+            logger.info(f"Token refresh for {site} failed: {response.status_code}")
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.info(f"Token refresh for {site} failed: {e}")
+        if attempt < MAX_ATTEMPTS - 1:
+            time.sleep(min(8, 2 ** attempt) * random.uniform(0.5, 1.0))
+    return None
+
+def refresh(site, stale_token=None):
+    """
+    Log in again for one site and store the new token. Concurrent callers
+    for the same site wait on one refresh; a caller whose stale_token has
+    already been replaced gets the new token without another login.
+    Returns the token, or None if the site couldn't be reached.
+    """
+    _load()
+    with _site_lock(site):
+        entry = _tokens.get(site)
+        if entry and stale_token is not None and entry['token'] != stale_token:
+            return entry['token']
+        if entry and stale_token is None and not _expiring(entry, REFRESH_AHEAD):
+            return entry['token']
+
+        jwt = _login(site)
+        if not jwt:
+            return None
+        database.insert_token(site, jwt)
+        with _lock:
+            _tokens[site] = {'token': jwt, 'exp': decode_expiry(jwt)}
+        logger.info(f"Token refreshed for {site}")
+        return jwt
+
+def get(site):
+    """Current token for a site, refreshed first if it's about to expire."""
+    _load()
+    entry = _tokens.get(site)
+    if entry is None:
+        return None
+    if _expiring(entry, REFRESH_MARGIN):
+        return refresh(site, entry['token']) or entry['token']
+    return entry['token']
+
+def on_unauthorized(site, token):
+    """Call after a 401 with the token that was rejected."""
+    return refresh(site, token)
+
+def tokens():
+    """[(site, token), ...] like database.get_tokens(), from the in-memory cache."""
+    _load()
+    with _lock:
+        return [(site, entry['token']) for site, entry in _tokens.items()]
+
+def add(site, token):
+    """Keep the cache in step with a token stored outside the manager."""
+    with _lock:
+        _tokens[site] = {'token': token, 'exp': decode_expiry(token)}
+
+def refresh_all():
+    """Refresh every site now; returns [(site, token), ...] for the sites that succeeded."""
+    _load()
+    refreshed = []
+    for site, token in tokens():
+        new_token = refresh(site, token)
+        if new_token:
+            refreshed.append((site, new_token))
+    return refreshed
+
+def _run(interval, stop_event):
+    while not stop_event.is_set():
+        try:
+            _load()
+            for site, token in tokens():
+                entry = _tokens.get(site)
+                if entry and _expiring(entry, REFRESH_AHEAD):
+                    refresh(site)
+        except Exception as e:
+            log_error(f"Token refresher error: {e}")
+        stop_event.wait(interval)
+
+def start_refresher(interval=60):
+    """Renew tokens in the background before they expire, off the polling path."""
+    stop_event = threading.Event()
+    threading.Thread(target=_run, args=(interval, stop_event), daemon=True).start()
+    return stop_event